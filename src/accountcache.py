@@ -0,0 +1,126 @@
+"""Local cache of open orders and balances.
+
+Fed by the user-data stream, so ticks read order and balance state from
+memory instead of REST:
+
+- executionReport: an order was placed, (partially) filled, canceled, ...
+- outboundAccountPosition: new free/locked amounts of the changed assets.
+- balanceUpdate: deposit/withdrawal delta of one asset.
+
+Missed events (reconnects) are corrected by a low-frequency REST
+reconciliation (`get_open_orders` and `get_account`, every `reconcile_s`
+seconds and whenever the stream reports an error). Responses of our own
+order requests can be applied right away with `apply_order`.
+
+REST weight therefore scales with order events, not with market data.
+"""
+import time
+import threading
+
+from utils import printv
+
+from binance.websockets import BinanceSocketManager
+
+open_statuses = ('NEW', 'PARTIALLY_FILLED')
+
+# executionReport field -> REST order field
+report_dict = {'symbol': 's', 'orderId': 'i', 'clientOrderId': 'c',
+               'price': 'p', 'origQty': 'q', 'executedQty': 'z',
+               'status': 'X', 'timeInForce': 'f', 'type': 'o', 'side': 'S',
+               'stopPrice': 'P', 'time': 'O', 'updateTime': 'T'}
+
+
+class AccountCache():
+    def __init__(self, client, reconcile_s=300, verbose=0):
+        """Initialize (empty) cache; fill it with `reconcile` or `start`."""
+        self.client = client
+        self.reconcile_s = reconcile_s
+        self.verbose = verbose
+
+        self.lock = threading.Lock()
+        self.orders = {}
+        self.balances = {}
+        self.closed = set()
+        self.t_reconcile = None
+        self.bm = None
+        self.stopped = threading.Event()
+
+    def open_orders(self, symbol):
+        """Open orders of symbol (e.g. 'ETH_BTC' or 'ETHBTC'), oldest first."""
+        with self.lock:
+            orders = self.orders.get(symbol.replace('_', ''), {})
+            return sorted((dict(o) for o in orders.values()), key=lambda o: o['orderId'])
+
+    def get_holding(self, symbol):
+        """Free balance of an asset (as `utils.get_holding`, e.g. 'ETH_BTC' -> ETH)."""
+        with self.lock:
+            return self.balances.get(symbol.replace('_BTC', ''), {}).get('free', '0')
+
+    def apply_order(self, order):
+        """Apply a REST order dict (response or query result) to the cache."""
+        symbol = order['symbol']
+        with self.lock:
+            if order.get('status', 'NEW') in open_statuses:
+                # Keep a newer state (e.g. a stream update before the response).
+                cached = self.orders.get(symbol, {}).get(order['orderId'])
+                if (symbol, order['orderId']) in self.closed:
+                    return
+                if cached is None or cached.get('updateTime', 0) <= order.get('updateTime', 0):
+                    self.orders.setdefault(symbol, {})[order['orderId']] = order
+            else:
+                self.orders.get(symbol, {}).pop(order['orderId'], None)
+                self.closed.add((symbol, order['orderId']))
+
+    def reconcile(self):
+        """Replace the cached state by a REST snapshot (2 requests)."""
+        orders = self.client.get_open_orders()
+        balances = self.client.get_account()['balances']
+
+        by_symbol = {}
+        for o in orders:
+            by_symbol.setdefault(o['symbol'], {})[o['orderId']] = o
+        with self.lock:
+            self.orders = by_symbol
+            self.closed = set()
+            self.balances = dict((b['asset'], {'free': b['free'], 'locked': b['locked']})
+                                 for b in balances)
+        self.t_reconcile = time.time()
+        printv('Reconciled {} open orders'.format(len(orders)), self.verbose)
+
+    def process_message(self, msg):
+        """User-data stream callback."""
+        event = msg.get('e')
+        if event == 'executionReport':
+            self.apply_order(dict((k, msg[v]) for k, v in report_dict.items() if v in msg))
+        elif event == 'outboundAccountPosition':
+            with self.lock:
+                for b in msg['B']:
+                    self.balances[b['a']] = {'free': b['f'], 'locked': b['l']}
+        elif event == 'balanceUpdate':
+            with self.lock:
+                b = self.balances.setdefault(msg['a'], {'free': '0', 'locked': '0'})
+                b['free'] = str(float(b['free']) + float(msg['d']))
+        elif event == 'error':
+            print('User data stream error: {}'.format(msg.get('m')))
+            self.reconcile()
+
+    def _reconcile_loop(self):
+        while not self.stopped.wait(self.reconcile_s):
+            try:
+                self.reconcile()
+            except Exception as e:
+                print('Reconciliation failed: {}'.format(e))
+
+    def start(self):
+        """Reconcile, then follow the user-data stream (and reconcile periodically)."""
+        self.reconcile()
+        self.bm = BinanceSocketManager(self.client)
+        self.bm.start_user_socket(self.process_message)
+        self.bm.start()
+        threading.Thread(target=self._reconcile_loop, daemon=True).start()
+
+    def stop(self):
+        """Close the user-data stream and stop reconciling."""
+        self.stopped.set()
+        if self.bm is not None:
+            self.bm.close()
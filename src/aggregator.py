@@ -0,0 +1,70 @@
+"""Incremental aggregation of 1T klines into coarser candles.
+
+Equivalent to `utils.resample` (first open, max high, min low, last close,
+summed volume and n_trades) but only the open bucket is kept: each 1T update
+costs O(1) and a new bucket is opened only when a 1T candle crosses the
+bucket boundary.
+"""
+import pandas as pd
+
+
+def freq_2_ms(freq):
+    """Convert a pandas frequency string (e.g. '5T', '4H') to milliseconds."""
+    return int(pd.Timedelta(freq).total_seconds() * 1000)
+
+
+class CandleAggregator():
+    def __init__(self, freq):
+        """Initialize aggregator of 1T klines into freq candles."""
+        self.freq = freq
+        self.ms = freq_2_ms(freq)
+        self.bucket = None
+        self.closed = None
+        self.pending = None
+
+    def bucket_of(self, t):
+        """Return start (ms) of the bucket the kline starting at t falls in."""
+        t = int(t)
+        return t - t % self.ms
+
+    def reset(self, rows):
+        """Rebuild the open bucket from its 1T rows; return the bucket candle."""
+        self.bucket, self.closed, self.pending = None, None, None
+        candle = None
+        for row in rows:
+            candle = self.update(row)
+        return candle
+
+    def update(self, row):
+        """Revise/append the 1T kline row; return the candle of its bucket.
+
+        The still-open 1T kline is kept apart from the bucket's closed klines,
+        so it can be revised any number of times. Klines older than the open
+        one are stale and return None.
+        """
+        if self.pending is not None and row['start_t'] != self.pending['start_t']:
+            if row['start_t'] < self.pending['start_t']:
+                return None
+            self.closed = self._merge(self.closed, self.pending)
+
+        bucket = self.bucket_of(row['start_t'])
+        if bucket != self.bucket:
+            self.bucket, self.closed = bucket, None
+
+        self.pending = dict(row)
+        return self._merge(self.closed, self.pending)
+
+    @staticmethod
+    def _merge(candle, row):
+        """Fold 1T kline row into candle (None for an empty bucket)."""
+        if candle is None:
+            return dict((k, row[k]) for k in ['start_t', 'end_t', 'open', 'high',
+                                              'low', 'close', 'volume', 'n_trades'])
+        return {'start_t': candle['start_t'],
+                'end_t': row['end_t'],
+                'open': candle['open'],
+                'high': max(candle['high'], row['high']),
+                'low': min(candle['low'], row['low']),
+                'close': row['close'],
+                'volume': candle['volume'] + row['volume'],
+                'n_trades': candle['n_trades'] + row['n_trades']}
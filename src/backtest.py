@@ -0,0 +1,123 @@
+"""Vectorized backtest of signals over stored kline history.
+
+Loads the saved 1T klines of each symbol, resamples every frequency and
+computes all indicators once in batch, then evaluates each signal as a
+boolean series over every candle. A trigger is a candle where the signal
+turns true (rising edge), timestamped by the candle's close. For every
+trigger the forward return over each horizon (in candles of that frequency)
+is measured from the trigger candle's close.
+
+cmd:
+cd binance-tracker/
+python src/backtest.py --symbols ETHBTC XRPBTC --freqs 1T 5T 1H --horizons 1 5 15
+"""
+import os
+import sys
+sys.path.append('./src')
+
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from utils import get_config, resample
+from indicator import Indicator
+from cryptoklines import load_klines, all_freqs, names
+from signals import signal_series
+from signalspec import spec_series
+
+parser = argparse.ArgumentParser(description='Backtest signals.')
+
+parser.add_argument('--symbols', nargs='+', default=['ETHBTC', 'XRPBTC'], help='List of symbols (e.g. ETHBTC).')
+parser.add_argument('--freqs', nargs='+', default=all_freqs, help='List of frequencies to test.')
+parser.add_argument('--signals', nargs='+', default=list(signal_series.keys()), help='Names of signals in signals.signal_series.')
+parser.add_argument('--horizons', nargs='+', type=int, default=[1, 5, 15], help='Forward return horizons (in candles).')
+parser.add_argument('--data_path', type=str, default='./output/data', help='Path to stored kline data.')
+parser.add_argument('--out_path', type=str, default='./output/backtest', help='Path to write triggers and summary.')
+parser.add_argument('--config', type=str, default='configs/indicators.yaml', help='Path to the config file.')
+parser.add_argument('--signal_config', type=str, default=None, help='Path to a signal config file (adds its signals).')
+
+
+def forward_returns(df, horizons):
+    """Return close-to-close return over each horizon (nan past the end)."""
+    close = df['close'].astype(np.float64)
+    return pd.DataFrame(dict(('fwd_{}'.format(h), close.shift(-h) / close - 1.) for h in horizons),
+                        index=df.index)
+
+
+def backtest_frame(df, signals, horizons):
+    """Evaluate signals over every candle of df (with indicators).
+
+    Returns (triggers, summary): one row per trigger with its forward returns,
+    and one row per signal with trigger count, hit rate (share of positive
+    forward returns) and mean/median forward return per horizon, next to the
+    unconditional mean over all candles.
+    """
+    fwd = forward_returns(df, horizons)
+    triggers, summary = [], []
+    for nm in signals:
+        active = signal_series[nm](df).fillna(False).astype(bool)
+        fired = active & ~active.shift(1, fill_value=False)
+
+        trig = fwd.loc[fired.values].copy()
+        trig.insert(0, 'close_t', pd.to_datetime(df['end_t'].values[fired.values], unit='ms'))
+        trig.insert(0, 'signal', nm)
+        triggers.append(trig)
+
+        stats = {'signal': nm, 'n_triggers': int(fired.sum()), 'active_share': active.mean()}
+        for h in horizons:
+            r = trig['fwd_{}'.format(h)].dropna()
+            stats['hit_rate_{}'.format(h)] = (r > 0).mean() if len(r) else np.nan
+            stats['mean_{}'.format(h)] = r.mean()
+            stats['median_{}'.format(h)] = r.median()
+            stats['base_mean_{}'.format(h)] = fwd['fwd_{}'.format(h)].mean()
+        summary.append(stats)
+
+    return pd.concat(triggers), pd.DataFrame(summary)
+
+
+def backtest(symbol, indicator, freqs, signals, horizons, data_path):
+    """Backtest signals over all freqs of a symbol's stored history."""
+    df_1T = load_klines(data_path, symbol).loc[:, names]
+    triggers, summary = [], []
+    for freq in freqs:
+        df = df_1T if freq == '1T' else resample(df_1T, freq).dropna(subset=['start_t'])
+        df = indicator(df, full_df=True, d1=False, d2=False, smooth_periods=[5])
+
+        trig, stats = backtest_frame(df, signals, horizons)
+        trig.insert(0, 'freq', freq)
+        stats.insert(0, 'freq', freq)
+        triggers.append(trig)
+        summary.append(stats)
+
+    triggers, summary = pd.concat(triggers), pd.concat(summary, ignore_index=True)
+    triggers.insert(0, 'symbol', symbol)
+    summary.insert(0, 'symbol', symbol)
+    return triggers, summary
+
+
+def main(args):
+    """Backtest signals for all symbols and save triggers and summary."""
+    indicator = Indicator(get_config(args.config))
+    if args.signal_config is not None:
+        for nm, spec in get_config(args.signal_config).items():
+            signal_series[nm] = lambda df, spec=spec: spec_series(spec, df)
+            if nm not in args.signals:
+                args.signals.append(nm)
+    os.makedirs(args.out_path, exist_ok=True)
+
+    summary = []
+    for sym in args.symbols:
+        sym = sym.upper().replace('_', '')
+        triggers, stats = backtest(sym, indicator, args.freqs, args.signals,
+                                   args.horizons, args.data_path)
+        triggers.to_csv(os.path.join(args.out_path, sym + '_triggers.csv'))
+        summary.append(stats)
+
+    summary = pd.concat(summary, ignore_index=True)
+    summary.to_csv(os.path.join(args.out_path, 'summary.csv'), index=False)
+    print(summary.to_string())
+
+
+if __name__ == "__main__":
+    main(parser.parse_args())
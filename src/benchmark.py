@@ -0,0 +1,254 @@
+"""Offline benchmarks of the tick hot path.
+
+Runs on synthetic klines (loaded from a scratch kline file) and websocket
+messages (see `synthetic.py`), so results are reproducible and need no
+network or keys. Timed:
+
+- warmup: `CryptoKlines.__init__` (load, resample, indicators)
+- indicator_call: `Indicator.__call__` on the full 1T history
+- process_klines: `KLineTracker.process_klines` per message
+- resample_for_update: `KLineTracker.resample_for_update` per message
+- bot_call: `TradingBot.__call__` per message
+
+over a grid of history lengths, numbers of frequencies and numbers of
+indicators (the first n of `--config`). Results (mean/median/p95/min ms per
+call) are saved as JSON named after the git commit; `--compare` prints the
+median ratios against an earlier result file.
+
+cmd:
+cd binance-tracker/
+python src/benchmark.py --histories 1440 10080 --n_freqs 1 4 11 --n_indicators 1 8
+python src/benchmark.py --compare output/benchmarks/<old commit>.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import itertools
+import subprocess
+import contextlib
+sys.path.append('./src')
+
+import numpy as np
+import pandas as pd
+
+from utils import get_config
+from indicator import Indicator
+from cryptoklines import CryptoKlines, all_freqs
+from klinebuffer import fields
+from klinetracker import KLineTracker
+from tradingbot import TradingBot
+from accountcache import AccountCache
+from klinestore import KlineStore
+from synthetic import synthetic_klines, kline_messages
+
+parser = argparse.ArgumentParser(description='Benchmark the tick hot path.')
+
+parser.add_argument('--benches', nargs='+', default=['warmup', 'indicator_call', 'process_klines',
+                                                     'resample_for_update', 'bot_call'], help='Benchmarks to run.')
+parser.add_argument('--histories', nargs='+', type=int, default=[1440, 10080], help='1T history lengths.')
+parser.add_argument('--n_freqs', nargs='+', type=int, default=[1, 4, 11], help='Numbers of tracked frequencies.')
+parser.add_argument('--n_indicators', nargs='+', type=int, default=[1, 8], help='Numbers of indicators (first n of config).')
+parser.add_argument('--n_messages', type=int, default=400, help='Websocket messages per run.')
+parser.add_argument('--ticks_per_candle', type=int, default=4, help='Messages per 1T candle.')
+parser.add_argument('--repeats', type=int, default=3, help='Repeats of the warmup and indicator_call benchmarks.')
+parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic klines.')
+parser.add_argument('--config', type=str, default='configs/indicators.yaml', help='Path to the indicator config file.')
+parser.add_argument('--out_path', type=str, default='output/benchmarks', help='Directory of the result files.')
+parser.add_argument('--compare', type=str, default=None, help='Result file to compare with.')
+
+symbol = 'SYN_BTC'
+# Never fires, so the bot evaluates signals without notifying.
+signal_config = {'never': {'lt': ['close', 0]}}
+
+
+def sub_config(config, n):
+    """First n (indicator, period) pairs of an indicator config."""
+    pairs = [(k, v) for k, vs in config.items() for v in vs][:n]
+    out = {}
+    for k, v in pairs:
+        out.setdefault(k, []).append(v)
+    return out
+
+
+def summarize(samples):
+    """Stats (ms) of per-call durations (s)."""
+    ms = np.array(samples) * 1000
+    return {'n': len(ms), 'mean_ms': float(ms.mean()), 'median_ms': float(np.median(ms)),
+            'p95_ms': float(np.percentile(ms, 95)), 'min_ms': float(ms.min())}
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+class Bench():
+    def __init__(self, args, config):
+        self.args = args
+        self.config = config
+        self.klines = {}
+        self.results = []
+
+    def data(self, history):
+        """Synthetic history and the websocket messages that follow it."""
+        if history not in self.klines:
+            n_candles = self.args.n_messages // self.args.ticks_per_candle + 1
+            df = synthetic_klines(history + n_candles, seed=self.args.seed)
+            msgs = list(kline_messages(df.iloc[history:], symbol.replace('_', ''),
+                                       self.args.ticks_per_candle, seed=self.args.seed))
+            self.klines[history] = (df.iloc[:history], msgs[:self.args.n_messages])
+        return self.klines[history]
+
+    def klines_path(self, df):
+        """Fresh kline file of df in the scratch directory; return it as a load_path."""
+        path = os.path.join('output', 'synthetic')
+        file = os.path.join(path, symbol.replace('_', '') + '.klines')
+        if os.path.isfile(file):
+            os.remove(file)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        KlineStore(file).append(df)
+        return path
+
+    def record(self, bench, params, samples):
+        res = dict(bench=bench, params=params, **summarize(samples))
+        self.results.append(res)
+        print('{:<20} {:<50} median {:8.3f} ms  p95 {:8.3f} ms'.format(
+            bench, json.dumps(params), res['median_ms'], res['p95_ms']))
+
+    def setup(self, history, n_freqs, n_indicators):
+        """Warmed-up CryptoKlines, tracker and bot (run in a scratch directory)."""
+        df, msgs = self.data(history)
+        indicator = Indicator(sub_config(self.config, n_indicators))
+        with open(os.devnull, 'w') as f, contextlib.redirect_stdout(f):
+            ck = CryptoKlines(symbol, indicator, None, load_path=self.klines_path(df), fill=False,
+                              freqs=all_freqs[:n_freqs], verbose=0)
+            # No orders or balances.
+            account = AccountCache(None)
+            bot = TradingBot([symbol], ck.df_freqs, None, signal_config=signal_config, account=account,
+                             known=list(fields) + indicator.names())
+        tracker = KLineTracker(symbol, indicator, ck, bot, verbose=0)
+        return ck, tracker, bot, msgs
+
+    def warmup(self, history, n_indicators):
+        df, _ = self.data(history)
+        indicator = Indicator(sub_config(self.config, n_indicators))
+        samples = []
+        for _ in range(self.args.repeats):
+            path = self.klines_path(df)
+            with open(os.devnull, 'w') as f, contextlib.redirect_stdout(f):
+                t = time.perf_counter()
+                CryptoKlines(symbol, indicator, None, load_path=path, fill=False, verbose=0)
+                samples.append(time.perf_counter() - t)
+        self.record('warmup', {'history': history, 'n_indicators': n_indicators}, samples)
+
+    def indicator_call(self, history, n_indicators):
+        df, _ = self.data(history)
+        indicator = Indicator(sub_config(self.config, n_indicators))
+        samples = []
+        for _ in range(self.args.repeats):
+            t = time.perf_counter()
+            indicator(df, full_df=True, d1=False, d2=False, smooth_periods=[5])
+            samples.append(time.perf_counter() - t)
+        self.record('indicator_call', {'history': history, 'n_indicators': n_indicators}, samples)
+
+    def ticks(self, history, n_freqs, n_indicators):
+        """process_klines, resample_for_update and bot_call on fresh setups."""
+        params = {'history': history, 'n_freqs': n_freqs, 'n_indicators': n_indicators}
+        benches = [b for b in ['process_klines', 'resample_for_update', 'bot_call'] if b in self.args.benches]
+        for bench in benches:
+            ck, tracker, bot, msgs = self.setup(history, n_freqs, n_indicators)
+            samples = []
+            with open(os.devnull, 'w') as f, contextlib.redirect_stdout(f):
+                for msg in msgs:
+                    if bench == 'process_klines':
+                        t = time.perf_counter()
+                        tracker.process_klines(msg['k'])
+                        samples.append(time.perf_counter() - t)
+                        continue
+
+                    row = tracker.parse(msg['k'])
+                    tracker.ws_hist.upsert(row)
+                    if bench == 'resample_for_update':
+                        t = time.perf_counter()
+                        tracker.resample_for_update(row)
+                        samples.append(time.perf_counter() - t)
+                    else:
+                        tracker.resample_for_update(row)
+                        t = time.perf_counter()
+                        bot(ck, symbol, 0)
+                        samples.append(time.perf_counter() - t)
+            self.record(bench, params, samples)
+
+    def run(self):
+        args = self.args
+        n_max = sum(len(v) for v in self.config.values())
+        n_indicators = sorted(set(min(n, n_max) for n in args.n_indicators))
+        for history, n_ind in itertools.product(args.histories, n_indicators):
+            if 'warmup' in args.benches:
+                self.warmup(history, n_ind)
+            if 'indicator_call' in args.benches:
+                self.indicator_call(history, n_ind)
+            for n_freqs in args.n_freqs:
+                self.ticks(history, n_freqs, n_ind)
+        return self.results
+
+
+def compare(results, path):
+    """Print median ratios (new / old) of matching benchmarks."""
+    with open(path, 'r') as f:
+        old = json.load(f)
+    old = dict(((r['bench'], json.dumps(r['params'], sort_keys=True)), r) for r in old['results'])
+    print('Compared to {}:'.format(path))
+    for r in results:
+        key = (r['bench'], json.dumps(r['params'], sort_keys=True))
+        if key in old:
+            print('{:<20} {:<50} {:6.2f}x  ({:.3f} -> {:.3f} ms)'.format(
+                key[0], key[1], r['median_ms'] / old[key]['median_ms'],
+                old[key]['median_ms'], r['median_ms']))
+
+
+def main(args):
+    config = get_config(args.config)
+    meta = {'commit': git_commit(),
+            'time': pd.Timestamp.now().isoformat(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+            'platform': platform.platform(),
+            'args': vars(args)}
+
+    out_path = os.path.abspath(args.out_path)
+    compare_path = os.path.abspath(args.compare) if args.compare else None
+    cwd = os.getcwd()
+    scratch = tempfile.mkdtemp()
+    os.makedirs(os.path.join(scratch, 'output', 'data'))
+    try:
+        # CryptoKlines saves to ./output/data; keep that out of the repo.
+        os.chdir(scratch)
+        results = Bench(args, config).run()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(scratch)
+
+    if not os.path.isdir(out_path):
+        os.makedirs(out_path)
+    path = os.path.join(out_path, '{}.json'.format(meta['commit']))
+    with open(path, 'w') as f:
+        json.dump({'meta': meta, 'results': results}, f, indent=2)
+    print('Saved results to {}'.format(path))
+
+    if compare_path is not None:
+        compare(results, compare_path)
+
+
+if __name__ == "__main__":
+    main(parser.parse_args())
@@ -1,12 +1,19 @@
 """Object to track and record klines of crypto trading pair."""
 import os
 import sys
+import json
+import time
 sys.path.append('./src')
 
+from collections import OrderedDict
+
 import pandas as pd
 import numpy as np
 
-from utils import printv, klines_2_df
+from utils import printv, klines_2_df, kline_ranges_2_df, resample
+from klinebuffer import KlineBuffer, fields
+from klinestore import KlineStore
+from aggregator import freq_2_ms
 
 names = ['start_t', 'end_t', 'open', 'high', 'low', 'close', 'volume', 'n_trades']
 all_freqs = ['1T', '3T', '5T', '15T', '30T', '1H', '2H', '4H', '6H', '12H', '24H']
@@ -19,37 +26,243 @@ class CryptoKlines():
                  client,
                  start_time='1 Jan, 2017',
                  load_path=None,
+                 capacity=None,
+                 indicators=True,
+                 checkpoint_path=None,
+                 freqs=None,
+                 lookback=None,
+                 dtype=np.float64,
+                 fill=True,
                  verbose=1):
+        """Load klines of symbol and compute its indicators.
+
+        With indicators=False the indicator columns are left out, e.g. to
+        compute them for many symbols at once with `batch_indicators`.
+
+        Only the frames of freqs (default: `all_freqs`) are built and kept up
+        to date; others are built when subscribed to (see `subscribe`).
+
+        If checkpoint_path holds a checkpoint of symbol (see `checkpoint`), all
+        frames are restored from it and only the klines since are fetched and
+        computed (`restored` is then True, whatever indicators).
+
+        args:
+            lookback: if given, each frame keeps only the klines needed to warm
+                up the indicators plus lookback (see `retention`), once built
+                from the full history. Older closed 1T klines are in the kline
+                file (see `save`) and are read back when a frame is built.
+            dtype: dtype of the indicator columns (e.g. np.float32).
+            fill: fetch the klines since the loaded or restored ones (and
+                their gaps) from client. False works offline (client unused).
+        """
         self.symbol = symbol.upper().replace('_', '')
         self.indicator = indicator
         self.verbose = verbose
         self.client = client
+        self.capacity = capacity
+        self.lookback = lookback
+        self.dtype = dtype
+        self.store = None
+        self.buffers = {}
+        self.restored = False
+        # Missing 1T ranges {start: end} (ms) the exchange has no klines for.
+        self.gap_map = {}
+        # Start times (ms) from which `catch_up` recomputed the frames, in order.
+        self.rewrites = []
+        # Number of consumers of each freq (1T, the source, is always kept).
+        self.subscribers = dict((freq, 1) for freq in (freqs or all_freqs) if freq != '1T')
 
-        if load_path:
+        t_checkpoint = None
+        if checkpoint_path and os.path.isfile(checkpoint_file(checkpoint_path, self.symbol)):
+            t_checkpoint = self.restore(checkpoint_path)
+
+        if self.restored:
+            t_repaired = self.fill_2_present() if fill else None
+            self.catch_up(t_checkpoint if t_repaired is None else min(t_checkpoint, t_repaired))
+            # Subscribed freqs the checkpoint did not hold.
+            self.resample_all()
+            self.retain()
+            return
+        elif t_checkpoint is not None:
+            # Indicator config changed: only the 1T klines were restored.
+            if fill:
+                self.fill_2_present()
+        elif load_path:
             self.load(load_path)
-            self.fill_2_present()
+            if fill:
+                self.fill_2_present()
         else:
             # Get klines
-            self.df_1T = klines_2_df(self.symbol, start_time, self.client)
+            df = klines_2_df(self.symbol, start_time, self.client)
+            self.set_frame('1T', df, max(len(df.index), 1440))
             self.save(load_path or './output/data/')
             self.fill_2_present()
 
         # Get indicators
-        self.df_1T = self.indicator(self.df_1T, full_df=True, d1=False, d2=False, smooth_periods=[5])
+        if indicators:
+            self.set_frame('1T', self.indicator(self.df_1T, full_df=True, d1=False, d2=False, smooth_periods=[5]),
+                           self.buffers['1T'].capacity)
         self.df_freqs = ['1T']
-        self.resample_all()
+        self.resample_all(indicators)
+        self.retain()
+
+    def __getattr__(self, name):
+        """Expose `df_<freq>` of subscribed freqs as a zero-copy dataframe view of its buffer."""
+        buffers = self.__dict__.get('buffers', {})
+        if name.startswith('df_') and name[3:] in buffers:
+            return buffers[name[3:]].to_frame()
+        if name.startswith('df_') and name[3:] in all_freqs:
+            raise AttributeError("'CryptoKlines' frame '{}' is not subscribed to (see `subscribe`)".format(name[3:]))
+        raise AttributeError("'CryptoKlines' object has no attribute '{}'".format(name))
+
+    def buffer(self, freq):
+        """Kline buffer of freq (KeyError if not subscribed to, see `subscribe`)."""
+        if freq not in self.buffers:
+            raise KeyError('Freq {} is not subscribed to (see `subscribe`).'.format(freq))
+        return self.buffers[freq]
+
+    def subscribe(self, freq, indicators=True):
+        """Add a consumer of freq; build its frame if it is not kept yet.
+
+        Frames are updated (by `KLineTracker`) while they have subscribers.
+        """
+        if freq not in all_freqs:
+            raise ValueError('Unknown freq: {}'.format(freq))
+        if freq == '1T':
+            return
+        self.subscribers[freq] = self.subscribers.get(freq, 0) + 1
+        if freq not in self.df_freqs:
+            self.resample(freq, indicators)
+
+    def unsubscribe(self, freq):
+        """Remove a consumer of freq; drop its frame when none are left."""
+        n = self.subscribers.get(freq, 0) - 1
+        if n > 0:
+            self.subscribers[freq] = n
+            return
+        self.subscribers.pop(freq, None)
+        if freq != '1T' and freq in self.df_freqs:
+            printv('Dropping freq: {}'.format(freq), self.verbose)
+            self.df_freqs = [f for f in self.df_freqs if f != freq]
+            self.buffers.pop(freq, None)
+
+    def set_frame(self, freq, df, capacity=None):
+        """Replace the klines of freq by df (stored in a fixed-capacity buffer)."""
+        capacity = capacity or self.capacity or self.retention() or max(len(df.index), 1440)
+        self.buffers[freq] = KlineBuffer.from_frame(df, capacity, self.dtype)
+
+    def retention(self):
+        """Klines kept per freq: indicator warmup plus lookback (None: unbounded)."""
+        warmup = self.indicator.warmup([5])
+        if self.lookback is None or warmup is None:
+            return None
+        return warmup + self.lookback
+
+    def retain(self):
+        """Shrink the buffers of all freqs to `retention` klines."""
+        n = self.capacity or self.retention()
+        for freq in self.df_freqs:
+            if n is not None and self.buffers[freq].capacity > n:
+                self.set_frame(freq, self.buffers[freq].to_frame(), n)
+
+    def history(self, n=None):
+        """Last n 1T klines (default: the ones in memory).
+
+        Klines older than the 1T buffer are read from the kline file.
+        """
+        df = self.buffers['1T'].to_frame(columns=names)
+        if n is None or n <= len(df.index) or self.store is None or not os.path.isfile(self.store):
+            return df
+        old = KlineStore(self.store).to_frame()
+        if len(df.index):
+            old = old.iloc[:np.searchsorted(old['start_t'].values, df['start_t'].values[0])]
+        return pd.concat([old.iloc[max(len(old.index) - (n - len(df.index)), 0):], df])
+
+    def memory(self):
+        """Rows, capacity and bytes of the buffer of every freq."""
+        return dict((freq, {'rows': len(buf), 'capacity': buf.capacity, 'bytes': buf.nbytes()})
+                    for freq, buf in self.buffers.items())
+
+    def tail(self, freq='1T', n=1, columns=None):
+        """Zero-copy dataframe view of the last n klines of freq."""
+        return self.buffer(freq).to_frame(n, columns)
 
     def fill_2_present(self):
-        """Fill klines from most recent recorded date to present."""
-        t_last = self.df_1T['end_t'].values[-1].item()
-        klines = klines_2_df(self.symbol, t_last)
+        """Fill klines from most recent recorded date to present, then repair gaps.
+
+        Returns the start time (ms) of the earliest repaired kline, or None.
+        """
+        t_last = self.buffers['1T'].get('end_t').item()
+        self.merge(klines_2_df(self.symbol, t_last, self.client))
+        return self.repair_gaps()
+
+    def gaps(self, since=None):
+        """Missing [(start, end)] ranges (ms, first and last missing start times)
+        of the 1T klines (from since on)."""
+        start_t = self.buffers['1T'].tail(column='start_t')
+        if since is not None:
+            start_t = start_t[max(int(np.searchsorted(start_t, since)) - 1, 0):]
+        i = np.nonzero(np.diff(start_t) > 60000)[0]
+        return [(int(start_t[j]) + 60000, int(start_t[j + 1]) - 60000) for j in i]
+
+    def repair_gaps(self, since=None):
+        """Fetch the missing 1T ranges (see `gaps`) in one batch and merge them.
+
+        Ranges the exchange has no klines for (e.g. during maintenance) are
+        kept in `gap_map` and not fetched again. Returns the start time (ms) of
+        the earliest repaired kline, or None.
+        """
+        missing = self.missing(since)
+        if not missing:
+            return None
+        return self.apply_gaps(missing, self.fetch_gaps(missing))
+
+    def missing(self, since=None):
+        """`gaps` (from since on) not known to be unfillable."""
+        return [g for g in self.gaps(since) if self.gap_map.get(g[0]) != g[1]]
 
-        self.update(klines, '1T', drop_dups=True)
+    def fetch_gaps(self, missing):
+        """Fetch the klines of missing ranges (REST only, safe on any thread)."""
+        printv('Repairing {} gaps of {}'.format(len(missing), self.symbol), self.verbose)
+        return kline_ranges_2_df(self.symbol, missing, self.client)
+
+    def apply_gaps(self, missing, x):
+        """Merge klines x fetched for missing; return the start time (ms) of the
+        earliest repaired kline, or None."""
+        self.merge(x)
+        for a, b in self.gaps(missing[0][0]):
+            if any(a >= a0 and b <= b0 for a0, b0 in missing):
+                self.gap_map[a] = b
+        return int(x['start_t'].values[0]) if len(x.index) else None
+
+    def merge(self, x, freq='1T'):
+        """Merge klines x (sorted by `start_t`) into the buffer of freq.
+
+        Rows after the held ones are appended; held rows with the same start
+        time are overwritten and missing ones inserted in order. The first row
+        of x is located by binary search and only the held rows from there on
+        are rewritten, so the cost follows the overlap, not the history.
+        """
+        buf = self.buffers[freq]
+        t = np.asarray(x['start_t'])
+        if not len(t):
+            return
+        held = buf.tail(column='start_t')
+        i = int(np.searchsorted(held, t[0]))
+        if i < len(held):
+            old = buf.tail(len(held) - i)
+            keep = ~np.isin(old['start_t'], t)
+            rows = OrderedDict((k, np.concatenate([a[keep], np.asarray(x[k]) if k in x.keys() else np.full(len(t), np.nan)]))
+                               for k, a in old.items())
+            order = np.argsort(rows['start_t'], kind='stable')
+            x = OrderedDict((k, a[order]) for k, a in rows.items())
+            buf.truncate(len(held) - i)
+        buf.extend(x)
 
     def reindex_all(self, n=100):
         """Reindex the frequencies of all dataframes to 1T."""
         out = {'1T': self.df_1T.tail(n)}
-        for freq in all_freqs[1:]:
+        for freq in self.df_freqs[1:]:
             printv('Interpolating {}'.format(freq), self.verbose)
             df = getattr(self, 'df_' + freq)
             df = df.copy()
@@ -57,75 +270,224 @@ class CryptoKlines():
             df = df.interpolate(method='index')
             out.update({freq: df.tail(n)})
 
-    def resample(self, freq):
+    def resample(self, freq, indicators=True):
         """Resample 1T klines to freq by binning."""
         if freq not in all_freqs:
             raise ValueError('inappropriate provided')
 
-        df = self.df_1T.loc[:, names].copy()
-
         printv('Resampling', self.verbose)
-        df = pd.concat([df['start_t'].resample(freq).first(),
-                        df['end_t'].resample(freq).last(),
-                        df['open'].resample(freq).first(),
-                        df['high'].resample(freq).max(),
-                        df['low'].resample(freq).min(),
-                        df['close'].resample(freq).last(),
-                        df['volume'].resample(freq).sum(),
-                        df['n_trades'].resample(freq).sum()], axis=1)
-
-        printv('Calculating indicators', self.verbose)
-        df = self.indicator(df, full_df=True, d1=False, d2=False, smooth_periods=[5])
-
-        setattr(self, 'df_' + freq, df)
-        self.df_freqs.append(freq)
-
-    def resample_all(self):
-        """Resample 1T klines to all frequencies by binning."""
+        n = self.retention()
+        df = self.history(None if n is None else n * freq_2_ms(freq) // 60000)
+        df = resample(df, freq).dropna(subset=['start_t'])
+
+        if indicators:
+            printv('Calculating indicators', self.verbose)
+            df = self.indicator(df, full_df=True, d1=False, d2=False, smooth_periods=[5])
+
+        self.set_frame(freq, df)
+        if freq not in self.df_freqs:
+            self.df_freqs = self.df_freqs + [freq]
+
+    def resample_all(self, indicators=True):
+        """Resample 1T klines to all subscribed frequencies not built yet."""
         for freq in all_freqs[1:]:
-            printv('Resample freq: {}'.format(freq), self.verbose)
-            self.resample(freq)
+            if freq in self.subscribers and freq not in self.df_freqs:
+                printv('Resample freq: {}'.format(freq), self.verbose)
+                self.resample(freq, indicators)
         printv('Done resampling!', self.verbose)
 
     def update(self, x, df_attr, drop_dups=False):
-        """Update kline dataframe."""
+        """Update kline buffer (with drop_dups, merged by `start_t`: see `merge`)."""
         printv('Update datatable', self.verbose)
-        df = getattr(self, 'df_' + df_attr)
-
-        df = df.append(x)
         if drop_dups:
-            df.drop_duplicates(inplace=True)
-
-        setattr(self, 'df_' + df_attr, df)
+            self.merge(x, df_attr)
+        else:
+            self.buffers[df_attr].extend(x)
 
     def get_recent(self, n):
         """Get last n 1T klines."""
         return self.df_1T.tail(n).copy()
 
     def save(self, path):
-        """Save 1T klines."""
+        """Save closed 1T klines.
+
+        Klines are appended to a binary kline file (see `klinestore`), so only
+        rows newer than the last save are written. The open candle (last row)
+        is left out. Paths ending in .csv are rewritten in full as before.
+        """
         if os.path.splitext(path)[1] == '':
-            path = os.path.join(path, self.symbol + '.csv')
+            path = os.path.join(path, self.symbol + '.klines')
 
         print('Saving to {}'.format(path))
-        self.df_1T.loc[:, names].to_csv(path)
+        if os.path.splitext(path)[1] == '.csv':
+            self.df_1T.loc[:, names].to_csv(path)
+        else:
+            closed = dict((k, a[:-1]) for k, a in self.buffers['1T'].tail().items())
+            KlineStore(path).append(closed)
+            self.store = path
 
     def load(self, path):
-        """Load 1T klines from path."""
-        if os.path.splitext(path)[1] == '':
-            path = os.path.join(path, self.symbol + '.csv')
+        """Load 1T klines from path (binary kline file, else csv)."""
+        df = load_klines(path, self.symbol)
+        self.set_frame('1T', df, max(len(df.index), 1440))
+        path = os.path.join(path, self.symbol + '.klines') if os.path.splitext(path)[1] == '' else path
+        if os.path.isfile(path) and os.path.splitext(path)[1] != '.csv':
+            self.store = path
+
+    def checkpoint(self, path):
+        """Save klines and indicators of all freqs (and `gap_map`) to <path>/<symbol>.npz.
+
+        The file is replaced atomically, so a crash while saving leaves the
+        previous checkpoint intact.
+        """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        arrays = {}
+        for freq in self.df_freqs:
+            for k, a in self.buffers[freq].tail().items():
+                arrays['{}/{}'.format(freq, k)] = a
+        meta = {'symbol': self.symbol, 'freqs': self.df_freqs, 'time': time.time(),
+                'indicators': self.indicator.fingerprint([5]),
+                'capacity': dict((freq, self.buffers[freq].capacity) for freq in self.df_freqs),
+                'store': self.store,
+                'gap_map': sorted(self.gap_map.items())}
+        arrays['meta'] = np.array(json.dumps(meta))
+
+        file = checkpoint_file(path, self.symbol)
+        with open(file + '.tmp', 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(file + '.tmp', file)
+
+    def restore(self, path):
+        """Restore the frames of a checkpoint; return start_t of its last 1T kline.
+
+        If the checkpoint was computed with other indicators (or smoothing),
+        only its 1T klines are restored and `restored` stays False.
+        """
+        with np.load(checkpoint_file(path, self.symbol)) as f:
+            meta = json.loads(str(f['meta']))
+            self.store = meta.get('store')
+            self.gap_map = dict((int(a), int(b)) for a, b in meta.get('gap_map', []))
+            self.restored = meta['indicators'] == self.indicator.fingerprint([5])
+            self.df_freqs = ['1T']
+            if self.restored:
+                self.df_freqs += [freq for freq in meta['freqs'] if freq in self.subscribers]
+            for freq in self.df_freqs:
+                keys = [k for k in f.files if k.split('/')[0] == freq]
+                df = pd.DataFrame(OrderedDict((k.split('/')[1], f[k]) for k in keys))
+                self.set_frame(freq, df if self.restored else df.loc[:, names], meta['capacity'][freq])
+
+        print('Restored {} from checkpoint of {}'.format(self.symbol, pd.to_datetime(meta['time'], unit='s')))
+        return self.buffers['1T'].get('start_t')
+
+    def catch_up(self, t0, warmup=None):
+        """Recompute all freqs from the 1T kline starting at t0 (ms) on.
+
+        The bucket holding t0 and all later ones are binned again from the 1T
+        klines, and their indicators are computed over them and the `warmup`
+        rows before (default: `Indicator.warmup`), so the cost follows the gap,
+        not the history. t0 is recorded in `rewrites`.
+        """
+        warmup = warmup or self.indicator.warmup([5])
+        self.rewrites.append(int(t0))
+        for freq in self.df_freqs:
+            printv('Catching up freq: {}'.format(freq), self.verbose)
+            buf = self.buffers[freq]
+            start_t = buf.tail(column='start_t')
+            i = max(int(np.searchsorted(start_t, t0, side='right')) - 1, 0)
+
+            df = self.df_1T.loc[self.df_1T['start_t'].values >= start_t[i], names]
+            df = df.copy() if freq == '1T' else resample(df, freq).dropna(subset=['start_t'])
+            hist = buf.to_frame(columns=names).iloc[0 if warmup is None else max(i - warmup, 0):i]
+            df = self.indicator(pd.concat([hist, df]), full_df=True, d1=False, d2=False, smooth_periods=[5])
+
+            buf.truncate(len(buf) - i)
+            buf.extend(df.iloc[len(hist.index):])
+
+
+def checkpoint_file(path, symbol):
+    return os.path.join(path, symbol + '.npz')
+
+
+def memory_report(crypto_klines):
+    """Print the buffer memory of each CryptoKlines; return total bytes."""
+    crypto_klines = list(crypto_klines)
+    total = 0
+    for ck in crypto_klines:
+        memory = ck.memory()
+        n_bytes = sum(m['bytes'] for m in memory.values())
+        total += n_bytes
+        print('{}: {:.1f} MB ({})'.format(ck.symbol, n_bytes / 1e6, ', '.join(
+            '{} {}/{}'.format(freq, m['rows'], m['capacity']) for freq, m in sorted(
+                memory.items(), key=lambda e: freq_2_ms(e[0])))))
+    n = len(crypto_klines)
+    if n:
+        print('Total: {:.1f} MB for {} symbols ({:.1f} MB per symbol)'.format(total / 1e6, n, total / 1e6 / n))
+    return total
+
+
+def batch_indicators(crypto_klines, freqs=None):
+    """Compute the indicators of many CryptoKlines (of one `Indicator`) at once.
+
+    Per frequency, the klines of all symbols go through one
+    `Indicator.batch` call and the results are written back to each
+    symbol's buffer.
+    """
+    crypto_klines = list(crypto_klines)
+    if not crypto_klines:
+        return
+    indicator = crypto_klines[0].indicator
+    for freq in freqs or crypto_klines[0].df_freqs:
+        printv('Calculating indicators: {}'.format(freq), crypto_klines[0].verbose)
+        dfs = indicator.batch([ck.buffers[freq].to_frame(columns=names) for ck in crypto_klines],
+                              smooth_periods=[5])
+        for ck, df in zip(crypto_klines, dfs):
+            ck.set_frame(freq, df)
+
+
+def load_klines(path, symbol):
+    """Load stored 1T klines of symbol (path: file, or dir of <symbol>.klines/.csv)."""
+    if os.path.splitext(path)[1] == '':
+        path = os.path.join(path, symbol + '.klines')
         if not os.path.isfile(path):
-            raise ValueError('load_path={} does not exist.'.format(path))
-
-        dtypes = {'start_t': np.int64,
-                  'end_t': np.int64,
-                  'open': np.float32,
-                  'high': np.float32,
-                  'low': np.float32,
-                  'close': np.float32,
-                  'volume': np.float32,
-                  'n_trades': np.int64}
-
-        self.df_1T = pd.read_csv(path, index_col=0, dtype=dtypes)
-        print('Data loaded from {}'.format(path))
-        self.df_1T.index = pd.to_datetime(self.df_1T.index)
+            path = os.path.splitext(path)[0] + '.csv'
+    if not os.path.isfile(path):
+        raise ValueError('load_path={} does not exist.'.format(path))
+
+    if os.path.splitext(path)[1] == '.csv':
+        # As the kline buffers and files (see `klinebuffer.fields`).
+        dtypes = dict((k, np.dtype(dt)) for k, dt in fields.items())
+
+        df = pd.read_csv(path, index_col=0, dtype=dtypes)
+        df.index = pd.to_datetime(df.index)
+    else:
+        df = KlineStore(path).to_frame()
+    print('Data loaded from {}'.format(path))
+    return df
+
+
+class KlinesSnapshot():
+    """Copy of the last n klines of some frequencies of a CryptoKlines.
+
+    Offers the read side of CryptoKlines (`buffer`, `tail`, `df_<freq>`) to
+    consumers running concurrently with the thread that updates the buffers.
+    """
+    def __init__(self, crypto_klines, freqs, n=100):
+        self.symbol = crypto_klines.symbol
+        self.buffers = dict((freq, KlineBuffer.from_frame(crypto_klines.tail(freq, n), n,
+                                                          crypto_klines.buffer(freq).dtype))
+                            for freq in freqs)
+
+    def __getattr__(self, name):
+        buffers = self.__dict__.get('buffers', {})
+        if name.startswith('df_') and name[3:] in buffers:
+            return buffers[name[3:]].to_frame()
+        raise AttributeError("'KlinesSnapshot' object has no attribute '{}'".format(name))
+
+    def buffer(self, freq):
+        """Kline buffer (copy) of freq."""
+        return self.buffers[freq]
+
+    def tail(self, freq='1T', n=1, columns=None):
+        """Last n klines of freq."""
+        return self.buffer(freq).to_frame(n, columns)
@@ -0,0 +1,211 @@
+"""Shared gateway for all Binance REST requests.
+
+One `RestGateway` per process owns:
+
+- a pooled keep-alive HTTP session,
+- the request-weight budget (synced with `X-MBX-USED-WEIGHT-1M`) and the
+  order-rate budget (`X-MBX-ORDER-COUNT-10S`); a 429/418 pauses every
+  request for `Retry-After` seconds,
+- a priority queue served by a few worker threads: orders go before account
+  queries, market data and backfill. Backfill also leaves `reserve` weight
+  unused, so a large backfill can't starve the order path or get the key
+  banned,
+- coalescing: identical unsigned GETs that are in flight share one request.
+
+`GatewayClient` is a python-binance `Client` whose requests all go through a
+gateway, so existing `client.<method>` calls need no changes:
+
+    client = GatewayClient(api_key, api_secret)
+    client.get_open_orders()            # queued with ACCOUNT priority
+    client.gateway.stats()
+"""
+import hmac
+import time
+import queue
+import hashlib
+import itertools
+import threading
+from concurrent.futures import Future
+from urllib.parse import urlencode
+
+from utils import printv, pooled_session, WeightBudget, API_URL
+from metrics import metrics
+
+from binance.client import Client
+from binance.exceptions import BinanceAPIException
+
+ORDER, ACCOUNT, MARKET, BACKFILL = 0, 1, 2, 3
+
+# Request weights of endpoints (path suffix) the bot uses; others weigh 1.
+weights = {'/account': 10, '/openOrders': 3, '/allOrders': 10, '/klines': 2,
+           '/exchangeInfo': 10, '/ticker/price': 2, '/ticker/24hr': 40}
+
+
+def _priority(method, url):
+    """Default priority of a request."""
+    if url.endswith('/order') or url.endswith('/order/oco'):
+        return ORDER
+    if method.lower() != 'get' or '/account' in url or 'Orders' in url:
+        return ACCOUNT
+    return MARKET
+
+
+def _weight(url, params):
+    path = url.split('?')[0]
+    for k, w in weights.items():
+        if path.endswith(k):
+            # Without a symbol, open orders of all symbols weigh 40.
+            return 40 if k == '/openOrders' and not params.get('symbol') else w
+    return 1
+
+
+class RestGateway():
+    def __init__(self, api_key='', api_secret='', base_url=API_URL, n_workers=4,
+                 weight_per_minute=1200, orders_per_10s=50, reserve=0.2,
+                 timeout=10, retries=5, verbose=0):
+        """Initialize gateway and start its worker threads.
+
+        args:
+            reserve: share of the weight budget backfill requests leave unused.
+        """
+        self.api_key = api_key
+        self.api_secret = api_secret
+        self.base_url = base_url
+        self.timeout = timeout
+        self.retries = retries
+        self.verbose = verbose
+
+        self.session = pooled_session(n_workers)
+        self.session.headers.update({'Accept': 'application/json', 'X-MBX-APIKEY': api_key})
+        self.weight = WeightBudget(weight_per_minute)
+        self.order_rate = WeightBudget(orders_per_10s, period=10.)
+        self.reserve = reserve * weight_per_minute
+
+        self.queue = queue.PriorityQueue()
+        self.seq = itertools.count()
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        self.paused_until = 0.
+        self.n_requests, self.n_coalesced, self.n_limited = 0, 0, 0
+
+        for _ in range(n_workers):
+            threading.Thread(target=self._work, daemon=True).start()
+
+    def request(self, method, url, params=None, signed=False, priority=None, weight=None,
+                raw=False):
+        """Queue a request; return a `Future` of its decoded json response.
+
+        args:
+            url: full url, or path relative to `base_url`.
+            raw: the future holds the response body (bytes) instead, e.g. for
+                `utils.process_klines` to parse without decoding json.
+        """
+        if not url.startswith('http'):
+            url = self.base_url + url
+        params = dict((k, v) for k, v in (params or {}).items() if v is not None)
+        priority = _priority(method, url) if priority is None else priority
+        weight = _weight(url, params) if weight is None else weight
+
+        key = None
+        if method.lower() == 'get' and not signed:
+            key = (url, tuple(sorted(params.items())), raw)
+            with self.lock:
+                if key in self.in_flight:
+                    self.n_coalesced += 1
+                    return self.in_flight[key]
+                future = self.in_flight[key] = Future()
+        else:
+            future = Future()
+
+        job = (method.lower(), url, params, signed, priority, weight, raw, key, future)
+        self.queue.put((priority, next(self.seq), job))
+        return future
+
+    def get(self, url, params=None, **kwargs):
+        """Blocking GET."""
+        return self.request('get', url, params, **kwargs).result()
+
+    def _work(self):
+        while True:
+            _, _, job = self.queue.get()
+            method, url, params, signed, priority, weight, raw, key, future = job
+            try:
+                result = self._send(method, url, params, signed, priority, weight, raw)
+            except Exception as e:
+                self._done(key)
+                future.set_exception(e)
+            else:
+                self._done(key)
+                future.set_result(result)
+
+    def _done(self, key):
+        if key is not None:
+            with self.lock:
+                self.in_flight.pop(key, None)
+
+    def _send(self, method, url, params, signed, priority, weight, raw=False):
+        """Send a request within the budgets, retrying when rate limited."""
+        for i in range(self.retries):
+            wait = self.paused_until - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            self.weight.acquire(weight, reserve=self.reserve if priority == BACKFILL else 0)
+            if priority == ORDER and method == 'post':
+                self.order_rate.acquire(1)
+
+            query = dict(params)
+            if signed:
+                query['timestamp'] = int(time.time() * 1000)
+                query['signature'] = hmac.new(self.api_secret.encode('utf-8'),
+                                              urlencode(query).encode('utf-8'),
+                                              hashlib.sha256).hexdigest()
+            start = time.perf_counter()
+            r = self.session.request(method, url, params=query, timeout=self.timeout)
+            metrics.since('rest_latency', start, method=method, endpoint=url.split('/api/')[-1])
+            self.n_requests += 1
+
+            if 'X-MBX-USED-WEIGHT-1M' in r.headers:
+                self.weight.sync(r.headers['X-MBX-USED-WEIGHT-1M'])
+            if 'X-MBX-ORDER-COUNT-10S' in r.headers:
+                self.order_rate.sync(r.headers['X-MBX-ORDER-COUNT-10S'])
+
+            if r.status_code in [418, 429]:
+                self.n_limited += 1
+                pause = float(r.headers.get('Retry-After', 2 ** i))
+                self.paused_until = max(self.paused_until, time.time() + pause)
+                printv('Rate limited ({}), pausing {}s'.format(r.status_code, pause), self.verbose)
+                continue
+            if not str(r.status_code).startswith('2'):
+                raise BinanceAPIException(r)
+            return r.content if raw else r.json()
+        raise IOError('Rate limited requesting {} {}.'.format(url, params))
+
+    def stats(self):
+        """Return request counters and queue length."""
+        return {'requests': self.n_requests, 'coalesced': self.n_coalesced,
+                'rate_limited': self.n_limited, 'queued': self.queue.qsize()}
+
+
+class GatewayClient(Client):
+    """python-binance `Client` that sends every request through a `RestGateway`."""
+    def __init__(self, api_key='', api_secret='', gateway=None, **kwargs):
+        self.gateway = gateway or RestGateway(api_key or '', api_secret or '')
+        super(GatewayClient, self).__init__(api_key, api_secret, **kwargs)
+
+    def _request(self, method, uri, signed, force_params=False, **kwargs):
+        params = dict(kwargs.get('data') or {})
+        params.pop('requests_params', None)
+        return self.gateway.request(method, uri, params, signed=signed).result()
+
+
+def gateway_client(client_path, weight_per_minute=1200):
+    """`GatewayClient` with the keys in client_path (api key, secret: one per line).
+
+    args:
+        weight_per_minute: request-weight budget of this process, e.g. its
+            share when several processes use the same key (see `shards`).
+    """
+    with open(client_path, 'r') as f:
+        client_keys = [line.rstrip('\n') for line in f]
+    gateway = RestGateway(client_keys[0], client_keys[1], weight_per_minute=weight_per_minute)
+    return GatewayClient(client_keys[0], client_keys[1], gateway=gateway)
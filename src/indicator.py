@@ -1,16 +1,25 @@
-"""TODO.
-
-TODO LR:
-[ ] Docstrings
-[ ] Get more indicators. E.g.:
-    [ ] First and second derivatives
-    [ ] Smooth indicators
-    [ ] Dummies and interactions (maybe this should be done by trading bot...)
+"""Technical indicators of kline frames (functions of `ta`).
+
+Each configurable indicator is declared once in `registry` as an
+`IndicatorSpec`: its ta module (imported on first use), input columns, the
+keyword its period is passed as and its warm-up length. An `Indicator` holds
+the (indicator, period) pairs of a config and computes them
+
+- in batch: `__call__` on one kline frame, `batch` on the frames of many
+  symbols at once (NumPy kernels in `batch_fns`, others through ta),
+- streaming: `stream` returns a `StreamingIndicator` that updates the values
+  of the open candle in O(1) (kernels in `streaming_fns`), matching the
+  batch values after the warm-up.
 """
+import json
+import hashlib
+import importlib
+from collections import deque
+
 import numpy as np
+import pandas as pd
 
-from utils import create_fn_hlc, create_fn_c,  create_fn_hl, smooth, \
-    get_first_derivative, get_second_derivative
+from utils import smooth, get_first_derivative, get_second_derivative
 
 
 def config_error_handling(config):
@@ -25,164 +34,122 @@ def config_error_handling(config):
                 raise ValueError('All elements of kwargs arguments must be ints')
 
 
-def import_and_init(config):
-    """Import and repackage indicator function from ta.
+ewm_tol = 1e-8
+
 
-    Repackage indicator:
-    - If the indicators expects (close, ...), repackage with create_fn_c
-    - If the indicators expects (high, low, ...), repackage with create_fn_hl
-    - If the indicators expects (high, low, close, ...), repackage with create_fn_hlc
+def _ewm_rows(alpha):
+    """Rows after which older values weigh less than `ewm_tol` in an ewm mean."""
+    return int(np.ceil(np.log(ewm_tol) / np.log(1. - alpha)))
 
-    Note that some of the functions require extra arguments that cannot be passed in.
 
-    TODO: this is quite an ugly hack. could use ta.TAFeaturesTransform
-    (https://github.com/bukosabino/ta/blob/master/ta/pipeline_wrapper.py)
+def _span(n):
+    """ewm alpha of span n (as `ta` EMAs)."""
+    return 2. / (n + 1)
+
+
+class IndicatorSpec():
+    """Metadata of an indicator function of ta.
+
+    args:
+        name: function name in ta (and config key).
+        module: ta module holding the function, imported on first use.
+        inputs: kline columns the function takes (positional, in order).
+        param: keyword the configured period is passed as (None: no period,
+            it only names the column).
+        warmup: fn(period) -> number of klines after which a value no longer
+            depends on older ones (None: on the full history).
     """
-    ifns = {}
-    for k in config:
-        if k == 'rsi':
-            from ta import rsi
-            ifns.update({'rsi': create_fn_c(rsi)})
-        elif k == 'money_flow_index':
-            from ta import money_flow_index
-            ifns.update({'money_flow_index': create_fn_hlc(money_flow_index)})
-        elif k == 'tsi':
-            from ta import tsi
-            ifns.update({'tsi': create_fn_c(tsi)})
-        elif k == 'uo':
-            from ta import uo
-            ifns.update({'uo': create_fn_hlc(uo)})
-        elif k == 'stoch':
-            from ta import stoch
-            ifns.update({'stoch': create_fn_hlc(stoch)})
-        elif k == 'stoch_signal':
-            from ta import stoch_signal
-            ifns.update({'stoch_signal': create_fn_hlc(stoch_signal)})
-        elif k == 'wr':
-            from ta import wr
-            ifns.update({'wr': create_fn_hlc(wr)})
-        elif k == 'ao':
-            from ta import ao
-            ifns.update({'ao': create_fn_hl(ao)})
-        elif k == 'daily_return':
-            from ta import daily_return
-            ifns.update({'daily_return': create_fn_c(daily_return)})
-        elif k == 'daily_log_return':
-            from ta import daily_log_return
-            ifns.update({'daily_log_return': create_fn_c(daily_log_return)})
-        elif k == 'cumulative_return':
-            from ta import cumulative_return
-            ifns.update({'cumulative_return': create_fn_c(cumulative_return)})
-        elif k == 'macd':
-            from ta import macd
-            ifns.update({'macd': create_fn_c(macd)})
-        elif k == 'macd_signal':
-            from ta import macd_signal
-            ifns.update({'macd_signal': create_fn_c(macd_signal)})
-        elif k == 'macd_diff':
-            from ta import macd_diff
-            ifns.update({'macd_diff': create_fn_c(macd_diff)})
-        elif k == 'ema_indicator':
-            from ta import ema_indicator
-            ifns.update({'ema_indicator': create_fn_c(ema_indicator)})
-        elif k == 'adx':
-            from ta import adx
-            ifns.update({'adx': create_fn_hlc(adx)})
-        elif k == 'adx_pos':
-            from ta import adx_pos
-            ifns.update({'adx_pos': create_fn_hlc(adx_pos)})
-        elif k == 'adx_neg':
-            from ta import adx_neg
-            ifns.update({'adx_neg': create_fn_hlc(adx_neg)})
-        elif k == 'vortex_indicator_pos':
-            from ta import vortex_indicator_pos
-            ifns.update({'vortex_indicator_pos': create_fn_hlc(vortex_indicator_pos)})
-        elif k == 'vortex_indicator_neg':
-            from ta import vortex_indicator_neg
-            ifns.update({'vortex_indicator_neg': create_fn_hlc(vortex_indicator_neg)})
-        elif k == 'trix':
-            from ta import trix
-            ifns.update({'trix': create_fn_c(trix)})
-        elif k == 'mass_index':
-            from ta import mass_index
-            ifns.update({'mass_index': create_fn_hl(mass_index)})
-        elif k == 'ci':
-            from ta import ci
-            ifns.update({'ci': create_fn_hlc(ci)})
-        elif k == 'dpo':
-            from ta import dpo
-            ifns.update({'dpo': create_fn_c(dpo)})
-        elif k == 'kst':
-            from ta import kst
-            ifns.update({'kst': create_fn_c(kst)})
-        elif k == 'kst_sig':
-            from ta import kst_sig
-            ifns.update({'kst_sig': create_fn_c(kst_sig)})
-        elif k == 'ichimoku_a':
-            from ta import ichimoku_a
-            ifns.update({'ichimoku_a': create_fn_hlc(ichimoku_a)})
-        elif k == 'ichimoku_b':
-            from ta import ichimoku_b
-            ifns.update({'ichimoku_b': create_fn_hlc(ichimoku_b)})
-        elif k == 'aroon_up':
-            from ta import aroon_up
-            ifns.update({'aroon_up': create_fn_c(aroon_up)})
-        elif k == 'aroon_down':
-            from ta import aroon_down
-            ifns.update({'aroon_down': create_fn_c(aroon_down)})
-        elif k == 'average_true_range':
-            from ta import average_true_range
-            ifns.update({'average_true_range': create_fn_hlc(average_true_range)})
-        elif k == 'bollinger_mavg':
-            from ta import bollinger_mavg
-            ifns.update({'bollinger_mavg': create_fn_c(bollinger_mavg)})
-        elif k == 'bollinger_hband':
-            from ta import bollinger_hband
-            ifns.update({'bollinger_hband': create_fn_c(bollinger_hband)})
-        elif k == 'bollinger_lband':
-            from ta import bollinger_lband
-            ifns.update({'bollinger_lband': create_fn_c(bollinger_lband)})
-        elif k == 'bollinger_hband_indicator':
-            from ta import bollinger_hband_indicator
-            ifns.update({'bollinger_hband_indicator': create_fn_c(bollinger_hband_indicator)})
-        elif k == 'bollinger_lband_indicator':
-            from ta import bollinger_lband_indicator
-            ifns.update({'bollinger_lband_indicator': create_fn_c(bollinger_lband_indicator)})
-        elif k == 'keltner_channel_central':
-            from ta import keltner_channel_central
-            ifns.update({'keltner_channel_central': create_fn_hlc(keltner_channel_central)})
-        elif k == 'keltner_channel_hband':
-            from ta import keltner_channel_hband
-            ifns.update({'keltner_channel_hband': create_fn_hlc(keltner_channel_hband)})
-        elif k == 'keltner_channel_lband':
-            from ta import keltner_channel_lband
-            ifns.update({'keltner_channel_lband': create_fn_hlc(keltner_channel_lband)})
-        elif k == 'keltner_channel_hband_indicator':
-            from ta import keltner_channel_hband_indicator
-            ifns.update({'keltner_channel_hband_indicator': create_fn_hlc(keltner_channel_hband_indicator)})
-        elif k == 'keltner_channel_lband_indicator':
-            from ta import keltner_channel_lband_indicator
-            ifns.update({'keltner_channel_lband_indicator': create_fn_hlc(keltner_channel_lband_indicator)})
-        elif k == 'donchian_channel_hband':
-            from ta import donchian_channel_hband
-            ifns.update({'donchian_channel_hband': create_fn_c(donchian_channel_hband)})
-        elif k == 'donchian_channel_lband':
-            from ta import donchian_channel_lband
-            ifns.update({'donchian_channel_lband': create_fn_c(donchian_channel_lband)})
-        elif k == 'donchian_channel_hband_indicator':
-            from ta import donchian_channel_hband_indicator
-            ifns.update({'donchian_channel_hband_indicator': create_fn_c(donchian_channel_hband_indicator)})
-        elif k == 'donchian_channel_lband_indicator':
-            from ta import donchian_channel_lband_indicator
-            ifns.update({'donchian_channel_lband_indicator': create_fn_c(donchian_channel_lband_indicator)})
-    return ifns
+    def __init__(self, name, module, inputs, param='n', warmup=lambda n: n):
+        self.name = name
+        self.module = module
+        self.inputs = inputs
+        self.param = param
+        self.warmup = warmup
+        self.fn = None
+
+    def load(self):
+        """Import the indicator function (once)."""
+        if self.fn is None:
+            self.fn = getattr(importlib.import_module('ta.' + self.module), self.name)
+        return self.fn
+
+    def init(self, period):
+        """Return fn(df) computing the indicator with period on a kline dataframe."""
+        kwargs = {} if self.param is None else {self.param: period}
+
+        def f(df):
+            return self.load()(*[df[k] for k in self.inputs], **kwargs)
+        return f
+
+    def streaming(self):
+        """Whether `StreamingIndicator` supports it (O(1) updates per candle)."""
+        return self.name in streaming_fns
+
+    def batch(self):
+        """Whether `Indicator.batch` computes it for all symbols in one call."""
+        return self.name in batch_fns
+
+
+hlc = ['high', 'low', 'close']
+
+# Indicators of ta that can be configured (see configs/indicators.yaml).
+registry = dict((spec.name, spec) for spec in [
+    IndicatorSpec('rsi', 'momentum', ['close'], warmup=lambda n: _ewm_rows(1. / n) + 1),
+    IndicatorSpec('money_flow_index', 'momentum', hlc + ['volume'], warmup=lambda n: n + 1),
+    IndicatorSpec('tsi', 'momentum', ['close'], 'r',
+                  warmup=lambda n: _ewm_rows(1. / (n + 1)) + _ewm_rows(1. / 14) + 1),
+    IndicatorSpec('uo', 'momentum', hlc, 's', warmup=lambda n: max(n, 28) + 1),
+    IndicatorSpec('stoch', 'momentum', hlc),
+    IndicatorSpec('stoch_signal', 'momentum', hlc, warmup=lambda n: n + 2),
+    IndicatorSpec('wr', 'momentum', hlc, 'lbp'),
+    IndicatorSpec('ao', 'momentum', ['high', 'low'], 's', warmup=lambda n: max(n, 34)),
+    IndicatorSpec('daily_return', 'others', ['close'], None, warmup=lambda n: 2),
+    IndicatorSpec('daily_log_return', 'others', ['close'], None, warmup=lambda n: 2),
+    IndicatorSpec('cumulative_return', 'others', ['close'], None, warmup=lambda n: None),
+    IndicatorSpec('macd', 'trend', ['close'], 'n_fast', warmup=lambda n: _ewm_rows(_span(max(n, 26)))),
+    IndicatorSpec('macd_signal', 'trend', ['close'], 'n_fast',
+                  warmup=lambda n: _ewm_rows(_span(max(n, 26))) + _ewm_rows(_span(9))),
+    IndicatorSpec('macd_diff', 'trend', ['close'], 'n_fast',
+                  warmup=lambda n: _ewm_rows(_span(max(n, 26))) + _ewm_rows(_span(9))),
+    IndicatorSpec('ema_indicator', 'trend', ['close'], warmup=lambda n: _ewm_rows(_span(n))),
+    IndicatorSpec('adx', 'trend', hlc, warmup=lambda n: 2 * _ewm_rows(1. / n) + n),
+    IndicatorSpec('adx_pos', 'trend', hlc, warmup=lambda n: _ewm_rows(1. / n) + n),
+    IndicatorSpec('adx_neg', 'trend', hlc, warmup=lambda n: _ewm_rows(1. / n) + n),
+    IndicatorSpec('vortex_indicator_pos', 'trend', hlc, warmup=lambda n: n + 1),
+    IndicatorSpec('vortex_indicator_neg', 'trend', hlc, warmup=lambda n: n + 1),
+    IndicatorSpec('trix', 'trend', ['close'], warmup=lambda n: 3 * _ewm_rows(_span(n)) + 1),
+    IndicatorSpec('mass_index', 'trend', ['high', 'low'], warmup=lambda n: 2 * _ewm_rows(_span(n)) + 25),
+    IndicatorSpec('cci', 'trend', hlc),
+    IndicatorSpec('dpo', 'trend', ['close']),
+    IndicatorSpec('kst', 'trend', ['close'], 'r1', warmup=lambda n: max(n, 30) + 15),
+    IndicatorSpec('kst_sig', 'trend', ['close'], 'r1', warmup=lambda n: max(n, 30) + 24),
+    IndicatorSpec('ichimoku_a', 'trend', ['high', 'low'], 'n1', warmup=lambda n: max(n, 26)),
+    IndicatorSpec('ichimoku_b', 'trend', ['high', 'low'], 'n3'),
+    IndicatorSpec('aroon_up', 'trend', ['close']),
+    IndicatorSpec('aroon_down', 'trend', ['close']),
+    IndicatorSpec('average_true_range', 'volatility', hlc, warmup=lambda n: _ewm_rows(1. / n) + 1),
+    IndicatorSpec('bollinger_mavg', 'volatility', ['close']),
+    IndicatorSpec('bollinger_hband', 'volatility', ['close']),
+    IndicatorSpec('bollinger_lband', 'volatility', ['close']),
+    IndicatorSpec('bollinger_hband_indicator', 'volatility', ['close']),
+    IndicatorSpec('bollinger_lband_indicator', 'volatility', ['close']),
+    IndicatorSpec('keltner_channel_central', 'volatility', hlc),
+    IndicatorSpec('keltner_channel_hband', 'volatility', hlc),
+    IndicatorSpec('keltner_channel_lband', 'volatility', hlc),
+    IndicatorSpec('keltner_channel_hband_indicator', 'volatility', hlc),
+    IndicatorSpec('keltner_channel_lband_indicator', 'volatility', hlc),
+    IndicatorSpec('donchian_channel_hband', 'volatility', ['close']),
+    IndicatorSpec('donchian_channel_lband', 'volatility', ['close']),
+    IndicatorSpec('donchian_channel_hband_indicator', 'volatility', ['close']),
+    IndicatorSpec('donchian_channel_lband_indicator', 'volatility', ['close'])])
 
 
 class Indicator():
     def __init__(self, config):
         """Initialize indicators object."""
-        self.ifns = import_and_init(config)
         self.indicators = {}
+        self.specs = {}
+        self.periods = {}
         self.update_indicators(config)
         if len(self.indicators) == 0:
             raise ValueError('no kwargs provided')
@@ -192,8 +159,11 @@ class Indicator():
         config_error_handling(config)
         for k, v in config.items():
             for vi in v:
-                if k in self.ifns.keys():
-                    self.indicators.update({k + '_' + str(vi): self.ifns[k](vi)})
+                if k in registry:
+                    nm = k + '_' + str(vi)
+                    self.indicators[nm] = registry[k].init(vi)
+                    self.specs[nm] = registry[k]
+                    self.periods[nm] = vi
                 else:
                     raise NotImplementedError('{} not in indicator_functions.'.format(k))
 
@@ -201,6 +171,35 @@ class Indicator():
         """Return names of indicators (format: nm_period)."""
         return list(self.indicators.keys())
 
+    def inputs(self, batch=False):
+        """Kline columns the indicators take (e.g. ['high', 'low', 'close']).
+
+        With batch, only those of the indicators computed by `batch_fns`.
+        """
+        needed = set(k for spec in self.specs.values() if spec.batch() or not batch for k in spec.inputs)
+        return [k for k in ['open', 'high', 'low', 'close', 'volume', 'n_trades'] if k in needed]
+
+    def warmup(self, smooth_periods=None):
+        """Klines needed before all values (and smoothings) settle.
+
+        None if an indicator depends on the full history.
+        """
+        rows = [self.specs[nm].warmup(n) for nm, n in self.periods.items()]
+        if None in rows:
+            return None
+        if isinstance(smooth_periods, int):
+            smooth_periods = [smooth_periods]
+        return max(rows) + max(smooth_periods or [1]) - 1
+
+    def streaming(self):
+        """Whether all indicators have streaming implementations."""
+        return all(spec.streaming() for spec in self.specs.values())
+
+    def fingerprint(self, smooth_periods=None):
+        """Hash of the indicator columns computed (names and smooth periods)."""
+        key = json.dumps([sorted(self.names()), smooth_periods or []])
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
     def __call__(self, df, full_df=False, d1=False, d2=False, smooth_periods=None):
         """Calculate indicators on df.
 
@@ -210,8 +209,7 @@ class Indicator():
         df = df.copy()
         n = len(df.index)
         for k, v in self.indicators.items():
-            periods = int(k.split('_')[-1])
-            df[k] = v(df.high, df.low, df.close) if n >= periods else np.full((n, ), np.nan)
+            df[k] = v(df) if n >= self.periods[k] else np.full((n, ), np.nan)
 
         if d1:
             df = self.get_derivatives(df, d2, full_df)
@@ -224,6 +222,55 @@ class Indicator():
         else:
             return df.tail(1)
 
+    def batch(self, dfs, smooth_periods=None):
+        """Calculate indicators on many kline frames at once.
+
+        Equivalent to `[self(df, full_df=True, smooth_periods=...) for df in dfs]`,
+        e.g. for the frames of all symbols at one frequency. Their high, low
+        and close are stacked into (symbol, time) arrays so that each indicator
+        in `batch_fns` is one vectorized call across symbols; others are
+        computed per frame.
+
+        args:
+            dfs: list of kline dataframes.
+            smooth_periods: list of smooth periods.
+        """
+        lengths = np.array([len(df.index) for df in dfs])
+        length = lengths.max() if len(dfs) else 0
+        # Only the columns the batch kernels take are stacked.
+        stacked = dict((k, _stack([df[k].values for df in dfs], length)) for k in self.inputs(batch=True))
+        high, low, close = [stacked.get(k) for k in ['high', 'low', 'close']]
+
+        values = {}
+        for k, v in self.indicators.items():
+            spec, periods = self.specs[k], self.periods[k]
+            if spec.batch():
+                values[k] = batch_fns[spec.name](periods)(high, low, close)
+            else:
+                values[k] = _stack([np.asarray(v(df)) if len(df.index) else [] for df in dfs], length)
+            values[k][lengths < periods] = np.nan
+
+        if isinstance(smooth_periods, int):
+            smooth_periods = [smooth_periods]
+        smoothed = {}
+        for i in smooth_periods or []:
+            for k in self.names():
+                smoothed[k + '_smooth'] = _rolling_2d(values[k], i)[0]
+        values.update(smoothed)
+
+        out = []
+        for j, df in enumerate(dfs):
+            new = pd.DataFrame(dict((k, a[j, length - lengths[j]:]) for k, a in values.items()), index=df.index)
+            out.append(pd.concat([df.drop(columns=[k for k in new.columns if k in df.columns]), new], axis=1))
+        return out
+
+    def stream(self, df=None, smooth_periods=None):
+        """Return a `StreamingIndicator`, warmed up on df if provided."""
+        si = StreamingIndicator(self, smooth_periods)
+        if df is not None:
+            si.warmup(df)
+        return si
+
     def get_derivatives(self, df, d2=False, full_df=False):
         """Calculate (first and second) derivatives of df indicators."""
         df = df.copy()
@@ -266,3 +313,419 @@ class Indicator():
             return df
         else:
             return df.tail(1)
+
+
+def _div(a, b):
+    """Divide like numpy/pandas: x/0 gives +-inf and 0/0 gives nan."""
+    if b == 0:
+        if a == 0 or np.isnan(a):
+            return np.nan
+        return np.inf if a > 0 else -np.inf
+    return a / b
+
+
+class _Ewm():
+    """Incremental `Series.ewm(alpha=alpha, min_periods=...).mean()`.
+
+    Mirrors pandas' default `adjust=True, ignore_na=False` weighting: nan
+    inputs decay the weights but do not count as observations.
+    """
+    def __init__(self, alpha, min_periods=0):
+        self.decay = 1. - alpha
+        self.min_periods = max(min_periods, 1)
+        self.num, self.den, self.nobs = 0., 0., 0
+
+    def _step(self, x):
+        num, den, nobs = self.num * self.decay, self.den * self.decay, self.nobs
+        if not np.isnan(x):
+            num, den, nobs = num + x, den + 1., nobs + 1
+        return num, den, nobs
+
+    def peek(self, x):
+        """Return the mean as if x were the next value."""
+        num, den, nobs = self._step(x)
+        return num / den if nobs >= self.min_periods else np.nan
+
+    def push(self, x):
+        """Commit x as the next value."""
+        self.num, self.den, self.nobs = self._step(x)
+
+
+class _Rolling():
+    """Incremental `Series.rolling(n, min_periods=...)` mean and std (ddof=0).
+
+    Holds the last n-1 committed values, so `peek` can evaluate the window
+    ending at a not yet committed value. Sums are kept around a shift (the
+    window mean at the last resync) to avoid cancellation on small prices,
+    and are recomputed from the window every `resync` pushes to stop drift.
+    """
+    def __init__(self, n, min_periods=None, resync=1000):
+        self.n = n
+        self.min_periods = n if min_periods is None else max(min_periods, 1)
+        self.window = deque()
+        self.shift = None
+        self.s, self.ss, self.count = 0., 0., 0
+        self.resync, self.pushes = resync, 0
+
+    def _stats(self, x):
+        s, ss, count = self.s, self.ss, self.count
+        shift = x if self.shift is None else self.shift
+        if not np.isnan(x):
+            s, ss, count = s + x - shift, ss + (x - shift) ** 2, count + 1
+        return s, ss, count, shift
+
+    def peek(self, x):
+        """Return (mean, std) of the window ending at x."""
+        s, ss, count, shift = self._stats(x)
+        if count < self.min_periods:
+            return np.nan, np.nan
+        mean = s / count
+        return mean + shift, np.sqrt(max(ss / count - mean ** 2, 0.))
+
+    def push(self, x):
+        """Commit x as the next value."""
+        if self.n == 1:
+            return
+        if self.shift is None and not np.isnan(x):
+            self.shift = x
+        self.window.append(x)
+        if not np.isnan(x):
+            self.s += x - self.shift
+            self.ss += (x - self.shift) ** 2
+            self.count += 1
+        if len(self.window) > self.n - 1:
+            old = self.window.popleft()
+            if not np.isnan(old):
+                self.s -= old - self.shift
+                self.ss -= (old - self.shift) ** 2
+                self.count -= 1
+
+        self.pushes += 1
+        if self.pushes >= self.resync:
+            self._resync()
+
+    def _resync(self):
+        values = [x for x in self.window if not np.isnan(x)]
+        self.shift = sum(values) / len(values) if values else None
+        self.s = sum(x - self.shift for x in values)
+        self.ss = sum((x - self.shift) ** 2 for x in values)
+        self.count = len(values)
+        self.pushes = 0
+
+
+class _RollingExtreme():
+    """Incremental `Series.rolling(n, min_periods=0).max()` (or min).
+
+    Monotonic deque of (position, value) over the last n-1 committed values.
+    """
+    def __init__(self, n, f='max'):
+        self.n = n
+        self.better = (lambda a, b: a >= b) if f == 'max' else (lambda a, b: a <= b)
+        self.window = deque()
+        self.pos = 0
+
+    def peek(self, x):
+        """Return the extreme of the window ending at x."""
+        if not self.window:
+            return x
+        front = self.window[0][1]
+        if np.isnan(x):
+            return front
+        return x if self.better(x, front) else front
+
+    def push(self, x):
+        """Commit x as the next value."""
+        if not np.isnan(x):
+            while self.window and self.better(x, self.window[-1][1]):
+                self.window.pop()
+            self.window.append((self.pos, x))
+        self.pos += 1
+        while self.window and self.window[0][0] < self.pos - (self.n - 1):
+            self.window.popleft()
+
+
+class _StreamEMA():
+    """Streaming `ta.ema_indicator`."""
+    def __init__(self, n):
+        self.ema = _Ewm(2. / (n + 1), min_periods=n)
+
+    def peek(self, high, low, close):
+        return self.ema.peek(close)
+
+    def push(self, high, low, close):
+        self.ema.push(close)
+
+
+class _StreamRSI():
+    """Streaming `ta.rsi` (ewm of gains and losses with com=n-1)."""
+    def __init__(self, n):
+        self.up = _Ewm(1. / n)
+        self.dn = _Ewm(1. / n)
+        self.prev = np.nan
+
+    def _moves(self, close):
+        diff = close - self.prev
+        if np.isnan(diff):
+            return np.nan, np.nan
+        return max(diff, 0.), max(-diff, 0.)
+
+    def peek(self, high, low, close):
+        up, dn = self._moves(close)
+        up, dn = self.up.peek(up), self.dn.peek(dn)
+        return 100 * _div(up, up + dn)
+
+    def push(self, high, low, close):
+        up, dn = self._moves(close)
+        self.up.push(up)
+        self.dn.push(dn)
+        self.prev = close
+
+
+class _StreamStoch():
+    """Streaming `ta.stoch` (%K), optionally smoothed to `ta.stoch_signal` (%D)."""
+    def __init__(self, n, d_n=None):
+        self.high = _RollingExtreme(n, 'max')
+        self.low = _RollingExtreme(n, 'min')
+        self.signal = None if d_n is None else _Rolling(d_n, min_periods=0)
+
+    def _k(self, high, low, close):
+        smin, smax = self.low.peek(low), self.high.peek(high)
+        return 100 * _div(close - smin, smax - smin)
+
+    def peek(self, high, low, close):
+        k = self._k(high, low, close)
+        return k if self.signal is None else self.signal.peek(k)[0]
+
+    def push(self, high, low, close):
+        k = self._k(high, low, close)
+        self.high.push(high)
+        self.low.push(low)
+        if self.signal is not None:
+            self.signal.push(k)
+
+
+class _StreamBollinger():
+    """Streaming `ta.bollinger_mavg` / `bollinger_hband` / `bollinger_lband`."""
+    def __init__(self, n, ndev=0):
+        self.roll = _Rolling(n, min_periods=0)
+        self.ndev = ndev
+
+    def peek(self, high, low, close):
+        mavg, mstd = self.roll.peek(close)
+        return mavg + self.ndev * mstd
+
+    def push(self, high, low, close):
+        self.roll.push(close)
+
+
+streaming_fns = {'rsi': _StreamRSI,
+                 'ema_indicator': _StreamEMA,
+                 'stoch': _StreamStoch,
+                 'stoch_signal': lambda n: _StreamStoch(n, d_n=3),
+                 'bollinger_mavg': _StreamBollinger,
+                 'bollinger_hband': lambda n: _StreamBollinger(n, ndev=2),
+                 'bollinger_lband': lambda n: _StreamBollinger(n, ndev=-2)}
+
+
+class StreamingIndicator():
+    """Stateful, O(1)-per-candle counterpart of `Indicator.__call__`.
+
+    Candles are keyed by `start_t`. Feeding the `start_t` of the open candle
+    again revises it (state is only peeked, never mutated); a later `start_t`
+    commits the open candle and opens the new one. After the warm-up
+    (`Indicator.warmup` candles) values match the batch path, `_smooth`
+    columns included; before it they can differ (e.g. nan where batch has a
+    value).
+    """
+    def __init__(self, indicator, smooth_periods=None):
+        missing = [nm for nm, spec in indicator.specs.items() if not spec.streaming()]
+        if missing:
+            raise NotImplementedError('No streaming implementation for {}.'.format(missing))
+
+        self.kernels = {}
+        self.periods = dict(indicator.periods)
+        for nm, spec in indicator.specs.items():
+            self.kernels[nm] = streaming_fns[spec.name](self.periods[nm])
+
+        if isinstance(smooth_periods, int):
+            smooth_periods = [smooth_periods]
+        # Batch smoothing writes every period to `nm_smooth`: the last one wins.
+        self.smoothers = {}
+        if smooth_periods:
+            self.smoothers = dict((nm, _Rolling(smooth_periods[-1])) for nm in self.kernels)
+
+        self.n = 0
+        self.open = None
+        self.last_t = None
+        self.raw = {}
+        self.values = {}
+
+    def warmup(self, df):
+        """Feed historical candles from df; its last row is left open."""
+        for row in zip(df['start_t'].values, df['high'].values,
+                       df['low'].values, df['close'].values):
+            self.update(*row)
+        return self.values
+
+    def update(self, start_t, high, low, close, closed=False):
+        """Revise the open candle or append a new one; return indicator values.
+
+        Candles older than the open one (or the last committed one) are stale
+        and leave the state untouched.
+        """
+        if self.open is not None and start_t != self.open[0]:
+            if start_t < self.open[0]:
+                return self.values
+            self.commit()
+        if self.last_t is not None and start_t <= self.last_t:
+            return self.values
+
+        self.open = (start_t, high, low, close)
+        self._peek()
+        if closed:
+            self.commit()
+        return self.values
+
+    def commit(self):
+        """Close the open candle and fold it into the running state."""
+        if self.open is None:
+            return
+        _, high, low, close = self.open
+        for nm, kernel in self.kernels.items():
+            kernel.push(high, low, close)
+        for nm, smoother in self.smoothers.items():
+            smoother.push(self.raw[nm])
+        self.n += 1
+        self.last_t = self.open[0]
+        self.open = None
+
+    def _peek(self):
+        _, high, low, close = self.open
+        values = {}
+        for nm, kernel in self.kernels.items():
+            self.raw[nm] = kernel.peek(high, low, close)
+            ready = self.n + 1 >= self.periods[nm]
+            values[nm] = self.raw[nm] if ready else np.nan
+            if nm in self.smoothers:
+                values[nm + '_smooth'] = self.smoothers[nm].peek(self.raw[nm])[0] if ready else np.nan
+        self.values = values
+
+
+def _ewm_2d(x, alpha, min_periods=0):
+    """`ewm(alpha=alpha, min_periods=...).mean()` along the rows of a 2-D array.
+
+    Uses the adjust=True weights of pandas (`num / den`, nan inputs decay the
+    weights but do not count). The recursions are solved in blocks of columns
+    with cumulative sums, so every step works on all rows at once and the
+    w^-k scaling stays bounded within a block.
+    """
+    w = 1. - alpha
+    valid = ~np.isnan(x)
+    xv = np.where(valid, x, 0.)
+    block = max(1, int(np.log(1e4) / -np.log(w))) if 0 < w < 1 else 1
+
+    length = x.shape[-1]
+    num, den = np.empty(x.shape), np.empty(x.shape)
+    num_0, den_0 = np.zeros(x.shape[:-1] + (1,)), np.zeros(x.shape[:-1] + (1,))
+    for i in range(0, length, block):
+        j = min(i + block, length)
+        k = np.arange(j - i)
+        wk, scale = w ** k, w ** -k.astype(float)
+        num[:, i:j] = wk * (np.cumsum(xv[:, i:j] * scale, axis=-1) + w * num_0)
+        den[:, i:j] = wk * (np.cumsum(valid[:, i:j] * scale, axis=-1) + w * den_0)
+        num_0, den_0 = num[:, j - 1:j], den[:, j - 1:j]
+
+    out = num / np.where(den > 0, den, np.nan)
+    out[np.cumsum(valid, axis=-1) < max(min_periods, 1)] = np.nan
+    return out
+
+
+def _window_sum(x, n):
+    """Sums over the last n columns (fewer at the start) of a 2-D array."""
+    c = np.cumsum(x, axis=-1)
+    c[:, n:] -= c[:, :-n].copy()
+    return c
+
+
+def _rolling_2d(x, n, min_periods=None):
+    """`rolling(n, min_periods=...)` mean and std (ddof=0) along the rows.
+
+    nans are skipped. Rows are shifted by their first valid value before
+    the running sums, so the variance does not suffer from cancellation.
+    """
+    min_periods = n if min_periods is None else min_periods
+    valid = ~np.isnan(x)
+    first = x[np.arange(len(x)), valid.argmax(axis=-1)][:, None]
+    xc = np.where(valid, x - np.nan_to_num(first), 0.)
+
+    count = _window_sum(valid.astype(float), n)
+    count[count < max(min_periods, 1)] = np.nan
+    mean_c = _window_sum(xc, n) / count
+    var = np.maximum(_window_sum(xc * xc, n) / count - mean_c * mean_c, 0.)
+    return mean_c + np.nan_to_num(first), np.sqrt(var)
+
+
+def _rolling_extreme_2d(x, n, f):
+    """`rolling(n, min_periods=0).max()` (f=np.fmax) or min (np.fmin) along the rows."""
+    pad = np.full((len(x), n - 1), np.nan)
+    windows = np.lib.stride_tricks.sliding_window_view(np.concatenate([pad, x], axis=-1), n, axis=-1)
+    return f.reduce(windows, axis=-1)
+
+
+def _batch_rsi(n):
+    def f(high, low, close):
+        diff = np.diff(close, axis=-1, prepend=np.nan)
+        emaup = _ewm_2d(np.clip(diff, 0, None), 1. / n)
+        emadn = _ewm_2d(np.clip(-diff, 0, None), 1. / n)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return 100 * emaup / (emaup + emadn)
+    return f
+
+
+def _batch_ema(n):
+    def f(high, low, close):
+        return _ewm_2d(close, 2. / (n + 1), min_periods=n)
+    return f
+
+
+def _batch_stoch(n, d_n=None):
+    def f(high, low, close):
+        smin = _rolling_extreme_2d(low, n, np.fmin)
+        smax = _rolling_extreme_2d(high, n, np.fmax)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            stoch_k = 100 * (close - smin) / (smax - smin)
+        if d_n is None:
+            return stoch_k
+        return _rolling_2d(stoch_k, d_n, min_periods=0)[0]
+    return f
+
+
+def _batch_bollinger(n, ndev=0):
+    def f(high, low, close):
+        mavg, mstd = _rolling_2d(close, n, min_periods=0)
+        return mavg + ndev * mstd
+    return f
+
+
+# Same formulas as ta on (symbol, time) arrays: one call per indicator covers
+# every symbol.
+batch_fns = {'rsi': _batch_rsi,
+             'ema_indicator': _batch_ema,
+             'stoch': _batch_stoch,
+             'stoch_signal': lambda n: _batch_stoch(n, d_n=3),
+             'bollinger_mavg': _batch_bollinger,
+             'bollinger_hband': lambda n: _batch_bollinger(n, ndev=2),
+             'bollinger_lband': lambda n: _batch_bollinger(n, ndev=-2)}
+
+
+def _stack(rows, length):
+    """Stack 1-D arrays into a (len(rows), length) array, aligned at the end.
+
+    Shorter ones are padded with leading nans, which the kernels skip, so
+    every row gets the values of its own series.
+    """
+    out = np.full((len(rows), length), np.nan)
+    for j, a in enumerate(rows):
+        if len(a):
+            out[j, length - len(a):] = a
+    return out
@@ -0,0 +1,194 @@
+"""Fixed-capacity columnar kline store.
+
+Klines are kept in one contiguous NumPy array per field (integer-ms
+timestamps, float prices/volume, integer trade counts) plus any float
+columns added later (e.g. indicators). The arrays are twice the capacity:
+rows are appended at the end and, once the end is reached, the last
+`capacity` rows are moved back to the front. Appends are therefore amortized
+O(1), memory is fixed, and the last n <= capacity rows are always one
+contiguous slice that can be handed out without copying.
+
+Views (`tail`, `to_frame`) share memory with the buffer: they are meant to be
+read right away and are invalidated by the next append that compacts.
+
+Added columns are float64 unless the buffer is created with another `dtype`
+(e.g. float32 halves the memory of indicator columns).
+"""
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+fields = OrderedDict([('start_t', np.int64),
+                      ('end_t', np.int64),
+                      ('open', np.float64),
+                      ('high', np.float64),
+                      ('low', np.float64),
+                      ('close', np.float64),
+                      ('volume', np.float64),
+                      ('n_trades', np.int64)])
+
+
+class KlineBuffer():
+    def __init__(self, capacity, columns=(), dtype=np.float64):
+        """Initialize an empty buffer holding at most `capacity` rows."""
+        if capacity < 1:
+            raise ValueError('`capacity` must be positive.')
+        self.capacity = capacity
+        self.size = 2 * capacity
+        self.lo, self.hi = 0, 0
+        self.dtype = dtype
+
+        self.arrays = OrderedDict((k, np.zeros(self.size, dtype=dt)) for k, dt in fields.items())
+        self._time = np.zeros(self.size, dtype=np.int64)
+        for k in columns:
+            self.add_column(k)
+
+    @classmethod
+    def from_frame(cls, df, capacity=None, dtype=np.float64):
+        """Create buffer from a kline dataframe (keeps its last `capacity` rows)."""
+        capacity = capacity or max(len(df.index), 1)
+        columns = [k for k in df.columns if k not in fields]
+        buf = cls(capacity, columns, dtype)
+        buf.extend(df)
+        return buf
+
+    def __len__(self):
+        return self.hi - self.lo
+
+    def columns(self):
+        """Return column names (kline fields first)."""
+        return list(self.arrays.keys())
+
+    def add_column(self, name, dtype=None):
+        """Add a (nan-filled) column, e.g. for an indicator."""
+        if name not in self.arrays:
+            self.arrays[name] = np.full(self.size, np.nan, dtype=dtype or self.dtype)
+
+    def nbytes(self):
+        """Memory held by the arrays (twice the capacity, see module docstring)."""
+        return sum(a.nbytes for a in self.arrays.values()) + self._time.nbytes
+
+    def _compact(self, room=1):
+        """Move the retained rows to the front so `room` rows fit after them."""
+        keep = min(len(self), self.capacity - room)
+        if self.hi + room <= self.size:
+            return
+        start = self.hi - keep
+        for a in list(self.arrays.values()) + [self._time]:
+            a[:keep] = a[start:self.hi]
+        self.lo, self.hi = 0, keep
+
+    def _set(self, i, row):
+        for k, v in row.items():
+            if k in self.arrays:
+                self.arrays[k][i] = v
+        if 'start_t' in row:
+            self._time[i] = self.arrays['start_t'][i] * 1000000
+
+    def append(self, row):
+        """Append a row (mapping of column -> value); drops the oldest if full."""
+        self._compact()
+        i = self.hi
+        for k, a in self.arrays.items():
+            if k not in fields:
+                a[i] = np.nan
+        self._set(i, row)
+        self.hi += 1
+        if len(self) > self.capacity:
+            self.lo += 1
+
+    def extend(self, df):
+        """Append many rows at once from a dataframe or dict of arrays."""
+        n = len(df['start_t'])
+        if n == 0:
+            return
+        if n >= self.capacity:
+            df = dict((k, np.asarray(df[k])[-self.capacity:]) for k in df.keys())
+            n = self.capacity
+            self.lo, self.hi = 0, 0
+        self._compact(room=n)
+
+        i = self.hi
+        for k, a in self.arrays.items():
+            a[i:i + n] = np.asarray(df[k])[-n:] if k in df.keys() else np.nan
+        self._time[i:i + n] = self.arrays['start_t'][i:i + n] * 1000000
+        self.hi += n
+        if len(self) > self.capacity:
+            self.lo = self.hi - self.capacity
+
+    def update(self, pos, row):
+        """Update row at position pos (negative counts from the end) in place."""
+        n = len(self)
+        if not -n <= pos < n:
+            raise IndexError('pos {} out of range for {} rows.'.format(pos, n))
+        self._set(self.lo + pos % n, row)
+
+    def truncate(self, n):
+        """Drop the last n rows (O(1)), e.g. before extending with revised ones."""
+        self.hi -= min(n, len(self))
+
+    def get(self, column, pos=-1):
+        """Return a single value (default: of the last row)."""
+        return self.tail(column=column)[pos]
+
+    def tail(self, n=None, column=None):
+        """Zero-copy views of the last n rows: one array or dict of arrays."""
+        n = len(self) if n is None else min(n, len(self))
+        if column is not None:
+            return self.arrays[column][self.hi - n:self.hi]
+        return OrderedDict((k, a[self.hi - n:self.hi]) for k, a in self.arrays.items())
+
+    def to_frame(self, n=None, columns=None):
+        """Zero-copy dataframe of the last n rows, indexed by kline start time."""
+        n = len(self) if n is None else min(n, len(self))
+        columns = self.columns() if columns is None else columns
+        index = pd.DatetimeIndex(self._time[self.hi - n:self.hi].view('M8[ns]'), name='time')
+        data = OrderedDict((k, self.arrays[k][self.hi - n:self.hi]) for k in columns)
+        return pd.DataFrame(data, index=index, columns=columns, copy=False)
+
+    def locate(self, t):
+        """Return position of the row with `start_t` t, or None.
+
+        Rows are sorted by `start_t`, so this is a binary search (O(log n)).
+        """
+        start_t = self.tail(column='start_t')
+        pos = np.searchsorted(start_t, t)
+        if pos < len(start_t) and start_t[pos] == t:
+            return int(pos)
+        return None
+
+    def insert(self, row):
+        """Insert a row at its sorted `start_t` position.
+
+        O(rows after it); meant for the rare late candle that fills a hole.
+        """
+        self.append(row)
+        i = self.lo + int(np.searchsorted(self.tail(column='start_t')[:-1], row['start_t']))
+        for a in list(self.arrays.values()) + [self._time]:
+            last = a[self.hi - 1]
+            a[i + 1:self.hi] = a[i:self.hi - 1].copy()
+            a[i] = last
+
+    def upsert(self, row):
+        """Update the row with the same `start_t` in place, or add it.
+
+        The open candle (last row) and new candles are O(1); late candles are
+        located by binary search and holes are filled in sorted position.
+        Returns True if a row was added.
+        """
+        t = row['start_t']
+        if len(self):
+            t_last = self.arrays['start_t'][self.hi - 1]
+            if t == t_last:
+                self._set(self.hi - 1, row)
+                return False
+            if t < t_last:
+                pos = self.locate(t)
+                if pos is None:
+                    self.insert(row)
+                    return True
+                self.update(pos, row)
+                return False
+        self.append(row)
+        return True
@@ -0,0 +1,111 @@
+"""Append-only binary kline files.
+
+Layout: a fixed 128 byte header followed by fixed-width little-endian
+records (one per closed 1T kline, sorted by start_t):
+
+    magic    8 bytes   b'BTKLINES'
+    version  uint16
+    header   uint16    header size in bytes (128)
+    record   uint32    record size in bytes
+    fields   ascii     comma-separated field names, nul padded
+
+Records are never rewritten, so saving costs O(new rows), and a file is read
+back through `np.memmap` without parsing. The row count follows from the file
+size; a partially written last record (e.g. after a crash) is ignored.
+
+Convert existing csv files with:
+python src/klinestore.py output/data/ETHBTC.csv [output/data/ETHBTC.klines]
+"""
+import os
+import sys
+import struct
+
+import numpy as np
+import pandas as pd
+
+from klinebuffer import fields
+
+MAGIC = b'BTKLINES'
+VERSION = 1
+HEADER_SIZE = 128
+record_dtype = np.dtype([(k, np.dtype(dt).newbyteorder('<')) for k, dt in fields.items()])
+
+
+def _header():
+    names = ','.join(record_dtype.names).encode('ascii')
+    header = MAGIC + struct.pack('<HHI', VERSION, HEADER_SIZE, record_dtype.itemsize) + names
+    if len(header) > HEADER_SIZE:
+        raise ValueError('Too many fields for header.')
+    return header.ljust(HEADER_SIZE, b'\0')
+
+
+class KlineStore():
+    def __init__(self, path):
+        """Open (or create) binary kline file at path."""
+        self.path = path
+        if not os.path.isfile(path) or os.path.getsize(path) == 0:
+            with open(path, 'wb') as f:
+                f.write(_header())
+        else:
+            with open(path, 'rb') as f:
+                header = f.read(HEADER_SIZE)
+            if header != _header():
+                raise ValueError('{} is not a binary kline file of this version.'.format(path))
+
+    def __len__(self):
+        return (os.path.getsize(self.path) - HEADER_SIZE) // record_dtype.itemsize
+
+    def last_start_t(self):
+        """Return start_t of the last stored kline (None if empty)."""
+        n = len(self)
+        if n == 0:
+            return None
+        with open(self.path, 'rb') as f:
+            f.seek(HEADER_SIZE + (n - 1) * record_dtype.itemsize)
+            return int(np.frombuffer(f.read(record_dtype.itemsize), dtype=record_dtype)['start_t'][0])
+
+    def append(self, columns):
+        """Append klines newer than the last stored one; return number written.
+
+        args:
+            columns: dataframe or dict of arrays with (at least) the kline fields.
+        """
+        start_t = np.asarray(columns['start_t'])
+        t_last = self.last_start_t()
+        keep = slice(None) if t_last is None else slice(np.searchsorted(start_t, t_last, side='right'), None)
+
+        rec = np.empty(len(start_t[keep]), dtype=record_dtype)
+        for k in record_dtype.names:
+            rec[k] = np.asarray(columns[k])[keep]
+        if len(rec):
+            with open(self.path, 'ab') as f:
+                f.write(rec.tobytes())
+        return len(rec)
+
+    def read(self):
+        """Memory-map the stored klines as a (read-only) structured array."""
+        n = len(self)
+        if n == 0:
+            return np.empty(0, dtype=record_dtype)
+        return np.memmap(self.path, dtype=record_dtype, mode='r', offset=HEADER_SIZE, shape=(n,))
+
+    def to_frame(self):
+        """Return stored klines as dataframe (columns are views of the mmap)."""
+        rec = self.read()
+        data = dict((k, rec[k]) for k in record_dtype.names)
+        index = pd.DatetimeIndex((rec['start_t'] * 1000000).view('M8[ns]'), name='time')
+        return pd.DataFrame(data, index=index, columns=list(record_dtype.names), copy=False)
+
+
+def csv_2_klines(csv_path, path=None):
+    """Convert a csv file written by `CryptoKlines.save` to a binary kline file."""
+    path = path or os.path.splitext(csv_path)[0] + '.klines'
+    df = pd.read_csv(csv_path, index_col=0)
+    df = df.sort_values('start_t').drop_duplicates(subset=['start_t'], keep='last')
+    n = KlineStore(path).append(df)
+    print('Converted {} klines from {} to {}'.format(n, csv_path, path))
+    return path
+
+
+if __name__ == "__main__":
+    csv_2_klines(*sys.argv[1:3])
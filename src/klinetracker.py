@@ -32,28 +32,58 @@ Ticker stream output:
 
 """
 import time
+import queue
+import threading
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
 import pandas as pd
 
-from utils import printv, format_current_stream, dict_2_df, resample
+from utils import printv, format_current_stream, dict_2_df
+from aggregator import CandleAggregator
+from metrics import metrics
 
 from binance.websockets import BinanceSocketManager
 from binance.enums import *
 
+# REST fetches of missed klines (see `KLineTracker.repair`).
+repairs = ThreadPoolExecutor(max_workers=1)
+
 msg_dict = {'start_t': 't', 'end_t': 'T', 'open': 'o', 'high': 'h',
             'low': 'l', 'close': 'c', 'volume': 'v', 'n_trades': 'n'}
 
 
 class KLineTracker():
-    def __init__(self, symbol, indicator, df_klines, bot, client=None, verbose=1):
+    def __init__(self, symbol, indicator, df_klines, bot, client=None, checkpoint_path=None, verbose=1):
+        """Initialize tracker.
+
+        args:
+            checkpoint_path: if given, the klines, indicators and bot state are
+                checkpointed there whenever the klines are saved.
+        """
         self.counter = 0
+        self.checkpoint_path = checkpoint_path
         self.symbol_nm = symbol.upper()
         self.symbol = symbol.upper().replace('_', '')
         self.indicator = indicator
         self.bot = bot
         self.verbose = verbose
         self.df_klines = df_klines
-        self.ws_hist = self.df_klines.df_1T.copy()
+        self.streams = {}
+        self.aggregators = {}
+        self.frames = {}
+        self.hists = {}
+        self.t_open = self.ws_hist.get('start_t')
+        # Start of missed klines to fetch, and the (ranges, future) being fetched.
+        self.t_gap = None
+        self.pending = None
+
+    @property
+    def ws_hist(self):
+        """1T kline buffer (looked up on each use, `set_frame('1T')` replaces it)."""
+        return self.df_klines.buffers['1T']
 
     def process_message(self, msg):
         """Recieve ticker message (see intro docstrings) from Binance."""
@@ -66,28 +96,59 @@ class KLineTracker():
 
     def process_inputs(self, current_stream, event_time, save_iter=100):
         """Process and evaluate incoming ticker message."""
-        self.counter += 1
-
         self.process_klines(current_stream, save_iter)
 
-        print('current_volume', current_stream['v'])
+        printv('current_volume {}'.format(current_stream['v']), self.verbose)
         self.bot(self.df_klines, self.symbol_nm, self.verbose)
+        metrics.observe('event_lag', time.time() - event_time / 1000., symbol=self.symbol)
 
         if current_stream['x']:
             print('{} candle closed at {}'.format(self.symbol, pd.to_datetime(event_time, unit='ms')))
 
-        if self.counter == save_iter:
+        self.count_and_save(save_iter)
+
+    def count_and_save(self, save_iter=100, path='./output/data'):
+        """Count a processed message; save klines and checkpoint every save_iter."""
+        self.counter += 1
+        if self.counter >= save_iter:
             printv('Save data', self.verbose)
-            self.df_klines.save('./output/data')
+            self.df_klines.save(path)
+            self.checkpoint()
             self.counter = 0
 
-    def get_current_values(self, current_stream, n_tail=500):
+    def checkpoint(self):
+        """Checkpoint klines, indicators and bot state (if checkpoint_path is set).
+
+        Without a bot (e.g. in a `shards.Shard`), its owner saves the bot state.
+        """
+        if self.checkpoint_path is not None:
+            printv('Checkpoint', self.verbose)
+            self.df_klines.checkpoint(self.checkpoint_path)
+            if self.bot is not None:
+                self.bot.save_state(self.checkpoint_path)
+
+    def stream(self, freq, n_tail=None):
+        """Get (and lazily warm up) the streaming indicators of a frequency.
+
+        They are warmed up on the last n_tail klines (default: the warmup
+        length of the indicators, see `Indicator.warmup`).
+        """
+        self.check_frame(freq)
+        if freq not in self.streams:
+            n_tail = n_tail or self.indicator.warmup([5])
+            df = self.df_klines.tail(freq, n_tail)
+            self.streams[freq] = self.indicator.stream(df, smooth_periods=[5])
+        return self.streams[freq]
+
+    def get_current_values(self, current_stream, n_tail=None):
         """Format current values from ticker stream and compute indicators."""
         klines = format_current_stream(current_stream, msg_dict.items())
-        klines = dict_2_df(klines)
-        df = self.df_klines.get_recent(n_tail).loc[:, msg_dict.keys()]
-        df = self.indicator(df.append(klines), full_df=False, d1=False, d2=False, smooth_periods=[5])
-        return df
+        values = self.stream('1T', n_tail).update(klines['start_t'][0],
+                                                  klines['high'][0],
+                                                  klines['low'][0],
+                                                  klines['close'][0])
+        klines.update((k, [v]) for k, v in values.items())
+        return dict_2_df(klines)
 
     def process_klines(self, current_stream, save_iter=100):
         """Update kline while candle is open.
@@ -97,55 +158,182 @@ class KLineTracker():
         candle's entry (not by multiple candles). Once the candle is closed,
         the final price (i.e. close price) needs to be correct, and a new candle
         is opened. Multiple candles for a single freq window cannot be open.
+
+        The open candle is the last row of ws_hist, so the upsert is O(1); late
+        messages for older candles are located by binary search on start_t.
+        Candles missed before the message (e.g. while reconnecting) are
+        fetched in the background and merged in later (see `repair`).
         """
-        df = format_current_stream(current_stream, msg_dict.items())
+        start = time.perf_counter()
+        row = self.parse(current_stream)
+        end = time.perf_counter()
+        self.latency('decode').observe(end - start)
 
-        if self.ws_hist.loc[self.ws_hist['start_t'] == df['start_t']].empty:
-            printv('Append ws_hist', self.verbose)
-            df = dict_2_df(df)
-            self.ws_hist = self.ws_hist.append(df)
+        start = end
+        repaired = self.upsert(row)
+        end = time.perf_counter()
+        self.latency('upsert').observe(end - start)
+        printv('Updating ws_hist time: {}'.format(end - start), self.verbose)
+
+        start = time.perf_counter()
+        if repaired:
+            self.update_indicators(self.rebuild_open_buckets(row))
         else:
-            printv('Update ws_hist', self.verbose)
-            start = time.time()
-            self.ws_hist.loc[self.ws_hist['start_t'] == df['start_t'], 'end_t'] = df['end_t']
-            self.ws_hist.loc[self.ws_hist['start_t'] == df['start_t'], 'open'] = df['open']
-            self.ws_hist.loc[self.ws_hist['start_t'] == df['start_t'], 'high'] = df['high']
-            self.ws_hist.loc[self.ws_hist['start_t'] == df['start_t'], 'low'] = df['low']
-            self.ws_hist.loc[self.ws_hist['start_t'] == df['start_t'], 'close'] = df['close']
-            self.ws_hist.loc[self.ws_hist['start_t'] == df['start_t'], 'volume'] = df['volume']
-            self.ws_hist.loc[self.ws_hist['start_t'] == df['start_t'], 'n_trades'] = df['n_trades']
-
-            printv('Updating ws_hist time: {}'.format(time.time()-start), self.verbose)
-
-        # TODO(lpupp) this doesn't work yet...
-        start = time.time()
-        self.resample_for_update()
-        printv('Resample time: {}'.format(time.time()-start), self.verbose)
+            self.resample_for_update(row)
+        printv('Resample time: {}'.format(time.perf_counter() - start), self.verbose)
 
         if self.counter == save_iter:
             printv('Save websocket history', self.verbose)
             # TODO
 
-    def resample_for_update(self):
+    def upsert(self, row):
+        """Upsert 1T row into ws_hist, queueing the repair of a gap before it.
+
+        Returns True if klines were repaired (see `repair`): the open candles
+        of all freqs then need rebuilding (see `rebuild_open_buckets`).
+        """
+        t_last = self.ws_hist.get('start_t')
+        if self.ws_hist.upsert(row):
+            printv('Append ws_hist', self.verbose)
+        else:
+            printv('Update ws_hist', self.verbose)
+        if row['start_t'] > t_last + 60000:
+            self.t_open = row['start_t']
+            self.t_gap = t_last + 60000 if self.t_gap is None else min(self.t_gap, t_last + 60000)
+        return self.repair()
+
+    def repair(self):
+        """Apply a fetched repair of missed 1T klines; queue the next one.
+
+        Missing klines are fetched on the `repairs` executor, so the REST round
+        trip never stalls the thread processing messages. The fetched rows are
+        merged here, on the tracker's thread, with the first message after they
+        arrived, and all freqs are recomputed from the first of them (see
+        `CryptoKlines.repair_gaps`). Returns True if klines were repaired.
+        """
+        repaired = False
+        if self.pending is not None and self.pending[1].done():
+            (missing, future), self.pending = self.pending, None
+            start = time.perf_counter()
+            try:
+                t0 = self.df_klines.apply_gaps(missing, future.result())
+            except Exception:
+                traceback.print_exc()
+                # Fetch again with the next message.
+                t0, self.t_gap = None, min(self.t_gap or missing[0][0], missing[0][0])
+            if t0 is not None:
+                printv('Repaired klines since {}'.format(pd.to_datetime(t0, unit='ms')), self.verbose)
+                self.df_klines.catch_up(t0)
+                self.aggregators.clear()
+                self.streams.clear()
+                repaired = True
+            self.latency('repair').observe(time.perf_counter() - start)
+
+        if self.t_gap is not None and self.pending is None:
+            missing = self.df_klines.missing(self.t_gap)
+            self.t_gap = None
+            if missing:
+                self.pending = (missing, repairs.submit(self.df_klines.fetch_gaps, missing))
+        return repaired
+
+    def latency(self, stage, freq=None):
+        """Latency histogram of a stage (and freq) of this symbol (see `metrics`)."""
+        h = self.hists.get((stage, freq))
+        if h is None:
+            labels = {'symbol': self.symbol, 'stage': stage}
+            if freq is not None:
+                labels['freq'] = freq
+            h = self.hists[(stage, freq)] = metrics.histogram('stage_latency', **labels)
+        return h
+
+    def parse(self, current_stream):
+        """Decode kline of ticker message to a 1T row dict."""
+        row = format_current_stream(current_stream, msg_dict.items())
+        return dict((k, v[0]) for k, v in row.items())
+
+    def check_frame(self, freq):
+        """Drop the aggregator and streaming state of freq if its frame was rebuilt.
+
+        Frames are rebuilt when a freq is subscribed to again (see
+        `CryptoKlines.subscribe`).
+        """
+        buf = self.df_klines.buffers[freq]
+        if self.frames.get(freq) is not buf:
+            self.frames[freq] = buf
+            self.aggregators.pop(freq, None)
+            self.streams.pop(freq, None)
+
+    def aggregator(self, freq):
+        """Get (and lazily seed) the open-candle aggregator of a frequency."""
+        self.check_frame(freq)
+        if freq not in self.aggregators:
+            agg = CandleAggregator(freq)
+            agg.reset(self.bucket_rows(agg.bucket_of(self.ws_hist.get('start_t'))))
+            self.aggregators[freq] = agg
+        return self.aggregators[freq]
+
+    def bucket_rows(self, bucket):
+        """Return 1T rows of ws_hist starting at or after bucket (ms)."""
+        ws = self.ws_hist.tail(n=None)
+        i0 = np.searchsorted(ws['start_t'], bucket)
+        return [dict((k, ws[k][i]) for k in msg_dict) for i in range(i0, len(ws['start_t']))]
+
+    def resample_for_update(self, row):
         """Resample updates for the various frequencies of interest.
 
         This script only streams 1T candles. If we are also interested in
         frequencies larger than a 1T, we need to aggregate the 1T candles
-        correctly.
+        correctly. Only the open candle of each frequency is revised (or a new
+        one opened at the bucket boundary), so a tick costs O(len(df_freqs)),
+        where df_freqs are the subscribed frequencies.
+        """
+        candles = self.aggregate(row)
+        if candles is None:
+            candles = self.rebuild_open_buckets(row)
+        self.update_indicators(candles)
+
+    def aggregate(self, row):
+        """Revise the open candle of every frequency with the 1T row.
+
+        Returns {freq: candle} without indicators, or None if row is late (older
+        than the open 1T candle). Only touches the aggregators, not the buffers.
         """
+        if row['start_t'] < self.t_open:
+            return None
+        self.t_open = row['start_t']
+        candles = {}
+        start = time.perf_counter()
         for freq in self.df_klines.df_freqs:
-            start = time.time()
-            df_freq = getattr(self.df_klines, 'df_' + freq)
-            df_freq = df_freq.drop(df_freq.tail(1).index)
-            t_latest = df_freq.tail(1)['end_t'].values.item()
-            df_new = self.ws_hist.loc[self.ws_hist['start_t'] > t_latest]
-            if freq in self.df_klines.df_freqs[1:]:
-                df_new = resample(df_new, freq)
-
-            df_new = self.indicator(df_freq.loc[:, msg_dict.keys()].tail(110).append(df_new), full_df=False, d1=False, d2=False, smooth_periods=[5])
-            df_freq = df_freq.append(df_new)
-            setattr(self.df_klines, 'df_' + freq, df_freq)
-            printv('Resample freq {} time: {}'.format(freq, time.time()-start), self.verbose)
+            candles[freq] = dict(row) if freq == '1T' else self.aggregator(freq).update(row)
+            end = time.perf_counter()
+            self.latency('resample', freq).observe(end - start)
+            start = end
+        return candles
+
+    def rebuild_open_buckets(self, row):
+        """Rebuild the open buckets a late 1T row (already in ws_hist) falls in.
+
+        Late candles of already closed buckets are not re-aggregated.
+        """
+        candles = {}
+        for freq in self.df_klines.df_freqs[1:]:
+            agg = self.aggregator(freq)
+            if agg.bucket_of(row['start_t']) == agg.bucket:
+                candles[freq] = agg.reset(self.bucket_rows(agg.bucket))
+        return candles
+
+    def update_indicators(self, candles):
+        """Compute streaming indicators of candles and upsert them by freq."""
+        for freq, candle in candles.items():
+            if freq not in self.df_klines.buffers:  # unsubscribed meanwhile
+                continue
+            start = time.perf_counter()
+            candle.update(self.stream(freq).update(candle['start_t'], candle['high'],
+                                                   candle['low'], candle['close']))
+            self.df_klines.buffers[freq].upsert(candle)
+            end = time.perf_counter()
+            self.latency('indicators', freq).observe(end - start)
+            printv('Resample freq {} time: {}'.format(freq, end - start), self.verbose)
 
     def start_ticker(self, client, freq='1m'):
         """Start connection to ticker."""
@@ -162,3 +350,156 @@ class KLineTracker():
     def end_ticker(self):
         """Close connection to ticker."""
         self.bm.close()
+
+
+class TickSlot():
+    """Latest-value slot for the kline messages of one symbol.
+
+    Updates of the open candle replace each other while the tracker is busy;
+    candle-close messages (`k.x`) are queued and never dropped. A close also
+    supersedes a pending update of the same candle.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.closed = deque()
+        self.latest = None
+        self.scheduled = False
+        self.n_received, self.n_coalesced, self.n_processed = 0, 0, 0
+
+    def put(self, msg):
+        """Store msg; return True if the slot needs to be scheduled."""
+        with self.lock:
+            self.n_received += 1
+            if msg['k']['x']:
+                if self.latest is not None and self.latest['k']['t'] == msg['k']['t']:
+                    self.latest = None
+                    self.n_coalesced += 1
+                self.closed.append(msg)
+            else:
+                if self.latest is not None:
+                    self.n_coalesced += 1
+                self.latest = msg
+
+            if self.scheduled:
+                return False
+            self.scheduled = True
+            return True
+
+    def take(self):
+        """Pop pending messages in order (closes first, then the latest update)."""
+        with self.lock:
+            msgs = list(self.closed)
+            if self.latest is not None:
+                msgs.append(self.latest)
+            self.closed.clear()
+            self.latest = None
+            self.n_processed += len(msgs)
+            return msgs
+
+    def done(self):
+        """Unschedule if empty; return True if more messages arrived meanwhile."""
+        with self.lock:
+            self.scheduled = bool(self.closed) or self.latest is not None
+            return self.scheduled
+
+    def stats(self):
+        return {'received': self.n_received,
+                'coalesced': self.n_coalesced,
+                'processed': self.n_processed}
+
+
+class KLineDispatcher():
+    """Route one multiplexed kline stream to the trackers of many symbols.
+
+    All `<symbol>@kline_1m` streams share one combined-stream connection (and
+    one reader thread); each decoded message is handed to the tracker of its
+    symbol. Binance allows up to 1024 streams per connection, larger symbol
+    lists are split over several connections of the same socket manager.
+    """
+    max_streams = 1024
+
+    def __init__(self, trackers=(), coalesce=True, n_workers=1, verbose=0):
+        """Initialize dispatcher.
+
+        args:
+            coalesce: process messages on worker threads through per-symbol
+                `TickSlot`s, so a busy tracker only sees the newest update of
+                its open candle. Otherwise trackers run on the socket thread.
+            n_workers: number of worker threads (when coalescing).
+        """
+        self.trackers = {}
+        self.slots = {}
+        self.coalesce = coalesce
+        self.n_workers = n_workers
+        self.ready = queue.Queue()
+        self.verbose = verbose
+        for kt in trackers:
+            self.add(kt)
+
+    def add(self, tracker):
+        """Register tracker (before `start_ticker`)."""
+        self.trackers[tracker.symbol] = tracker
+        self.slots[tracker.symbol] = TickSlot()
+
+    def process_message(self, msg):
+        """Recieve combined stream message {'stream': ..., 'data': ...}."""
+        if msg.get('e') == 'error':
+            print('Stream error: {}'.format(msg.get('m')))
+            return
+
+        tracker, data = self.route(msg)
+        if tracker is None:
+            return
+        if not self.coalesce:
+            tracker.process_message(data)
+        elif self.slots[tracker.symbol].put(data):
+            self.ready.put(tracker)
+
+    def work(self):
+        """Worker loop: drain the slots of trackers with pending messages."""
+        while True:
+            tracker = self.ready.get()
+            slot = self.slots[tracker.symbol]
+            for msg in slot.take():
+                try:
+                    tracker.process_message(msg)
+                except Exception:
+                    traceback.print_exc()
+            if slot.done():
+                self.ready.put(tracker)
+
+    def stats(self):
+        """Return message counters (received/coalesced/processed) per symbol."""
+        return dict((sym, slot.stats()) for sym, slot in self.slots.items())
+
+    def route(self, msg):
+        """Return (tracker, kline event) of a combined stream message."""
+        data = msg.get('data', msg)
+        tracker = self.trackers.get(data.get('s'))
+        if tracker is None:
+            printv('No tracker for stream: {}'.format(msg.get('stream')), self.verbose)
+        return tracker, data
+
+    def start_ticker(self, client, freq='1m', callback=None):
+        """Start one combined-stream connection for all tracked symbols.
+
+        Messages go to `process_message` unless another callback is given.
+        """
+        if freq not in ['1m', '1T']:
+            raise NotImplementedError
+
+        streams = ['{}@kline_{}'.format(sym.lower(), KLINE_INTERVAL_1MINUTE) for sym in self.trackers]
+        self.bm = BinanceSocketManager(client)
+        for i in range(0, len(streams), self.max_streams):
+            self.bm.start_multiplex_socket(streams[i:i + self.max_streams],
+                                           callback or self.process_message)
+
+        if self.coalesce and callback is None:
+            for _ in range(self.n_workers):
+                threading.Thread(target=self.work, daemon=True).start()
+
+        self.bm.start()
+
+    def end_ticker(self):
+        """Close connection to ticker."""
+        self.bm.close()
@@ -13,27 +13,50 @@ import sys
 sys.path.append('./src')
 
 import argparse
+import asyncio
+from functools import partial
+
+import numpy as np
 
-from binance.client import Client
 
 from utils import get_config
-from klinetracker import KLineTracker
-from cryptoklines import CryptoKlines
+from gateway import gateway_client
+from klinetracker import KLineTracker, KLineDispatcher
+from cryptoklines import CryptoKlines, batch_indicators, memory_report
+from klinebuffer import fields
 from indicator import Indicator
 from tradingbot import TradingBot
+from pipeline import AsyncPipeline
+from accountcache import AccountCache
+from shards import ShardedDispatcher
+from metrics import metrics
 
 parser = argparse.ArgumentParser(description='Binance Tracker')
 
 parser.add_argument('--trading_currencies', nargs='+', default=['ETH', 'XRP'], help='List of currencies. Need to be traded with base_currency.')
 parser.add_argument('--trading_freqs', nargs='+', default=['1T', '3T', '5T', '15T', '30T', '1H', '2H', '4H'], help='List of frequencies to track.')
 parser.add_argument('--base_currency', type=str, default='BTC', help='BTC|USDT.')
-parser.add_argument('--load_path', type=str, default=None, help='Path to csv data file(s).')
+parser.add_argument('--load_path', type=str, default=None, help='Path to kline data file(s) (.klines or .csv).')
 parser.add_argument('--client_path', type=str, default=None, help='Path to client key txt.')
+parser.add_argument('--checkpoint_path', type=str, default=None, help='Directory to checkpoint and restore the tracker state (e.g. output/checkpoints).')
+parser.add_argument('--lookback', type=int, default=1440, help='Klines kept in memory per frequency beyond the indicator warmup (-1: all).')
+parser.add_argument('--float32', action='store_true', help='Store indicator columns as float32.')
+parser.add_argument('--async_pipeline', action='store_true', help='Run ingest, indicators, signals and orders as asyncio stages.')
+parser.add_argument('--n_shards', type=int, default=1, help='Worker processes to split the symbols over (>1: see src/shards.py; no --async_pipeline).')
 
 parser.add_argument('--config', type=str, default='configs/indicators.yaml', help='Path to the config file.')
+parser.add_argument('--signals', type=str, default='configs/signals.yaml', help='Path to the signal config file.')
+parser.add_argument('--metrics_port', type=int, default=None, help='Serve latency metrics (Prometheus) on this local port.')
+parser.add_argument('--metrics_path', type=str, default=None, help='Write latency metrics JSON snapshots to this file.')
+parser.add_argument('--metrics_interval', type=int, default=60, help='Seconds between metrics snapshots.')
 
 def main(args, client):
     """Track cryptocurrency pairs."""
+    if args.metrics_port is not None:
+        metrics.serve(args.metrics_port)
+    if args.metrics_path is not None:
+        metrics.start_snapshots(args.metrics_path, args.metrics_interval)
+
     all_symbols = [e['symbol'] for e in client.get_all_tickers()]
     [e for e in all_symbols if e[-3:] == 'BTC']
 
@@ -43,26 +66,68 @@ def main(args, client):
     print('Tracking {}'.format(symbols))
 
     freqs = args.trading_freqs
-    print('Initializing trading bot')
-    bot = TradingBot(symbols, freqs, client, t_sleep=15)
+    print('Following orders and balances')
+    account = AccountCache(client)
+    account.start()
 
     print('Initializing indicator')
     config = get_config(args.config)
     indicator = Indicator(config)
 
+    print('Initializing trading bot')
+    signal_config = get_config(args.signals)
+    # Sharded, signals are evaluated in the shards and the bot only acts on them.
+    bot = TradingBot(symbols, freqs, client, t_sleep=15,
+                     signal_config=signal_config if args.n_shards <= 1 else None, account=account,
+                     known=list(fields) + indicator.names())
+    if args.checkpoint_path is not None:
+        bot.load_state(args.checkpoint_path)
+
+    kwargs = dict(start_time='10 days ago UTC',
+                  load_path=args.load_path,
+                  lookback=None if args.lookback < 0 else args.lookback,
+                  dtype=np.float32 if args.float32 else np.float64)
+
+    if args.n_shards > 1:
+        print('Starting {} shards'.format(args.n_shards))
+        make_client = partial(gateway_client, args.client_path, client.gateway.weight.capacity)
+        dispatcher = ShardedDispatcher(symbols, bot, args.n_shards, config=config,
+                                       signal_config=signal_config, freqs=freqs,
+                                       make_client=make_client,
+                                       checkpoint_path=args.checkpoint_path,
+                                       metrics_port=args.metrics_port, **kwargs)
+        dispatcher.start()
+        dispatcher.start_ticker(client)
+        return
+
     CK, KT = {}, {}
     for sym in symbols:
         print(sym)
         CK[sym] = CryptoKlines(sym, indicator, client,
-                               start_time='10 days ago UTC',
-                               load_path=args.load_path, verbose=0)
+                               indicators=False,
+                               checkpoint_path=args.checkpoint_path,
+                               freqs=freqs, verbose=0, **kwargs)
+
+    # Indicators of all symbols at once (one call per indicator and freq);
+    # symbols restored from a checkpoint already have theirs.
+    batch_indicators([ck for ck in CK.values() if not ck.restored])
+    memory_report(CK.values())
+
+    for sym in symbols:
         KT[sym] = KLineTracker(symbol=sym,
                                indicator=indicator,
                                df_klines=CK[sym],
                                bot=bot,
-                               client=client, verbose=0)
-    for sym in symbols:
-        KT[sym].start_ticker(client)
+                               client=client,
+                               checkpoint_path=args.checkpoint_path, verbose=0)
+
+    # One combined-stream connection for all symbols.
+    dispatcher = KLineDispatcher(KT.values())
+    if args.async_pipeline:
+        pipeline = AsyncPipeline(dispatcher, bot)
+        asyncio.get_event_loop().run_until_complete(pipeline.run(client))
+    else:
+        dispatcher.start_ticker(client)
 
 
 if __name__ == "__main__":
@@ -75,11 +140,9 @@ if __name__ == "__main__":
     if args.client_path is None:
         raise ValueError('`client_path` not provided.')
 
-    client_keys = []
-    with open(args.client_path, 'r') as f:
-        for line in f:
-            client_keys.append(line.rstrip('\n'))
-
-    client = Client(client_keys[0], client_keys[1])
+    # All REST requests of a process share one rate-limited gateway; sharded,
+    # the coordinator and each shard get an equal share of the weight budget.
+    n_processes = args.n_shards + 1 if args.n_shards > 1 else 1
+    client = gateway_client(args.client_path, 1200 // n_processes)
 
     main(args, client)
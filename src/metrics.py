@@ -0,0 +1,169 @@
+"""Latency histograms with a Prometheus endpoint and JSON snapshots.
+
+Recorded (all in seconds, see `metrics.observe` calls):
+
+- stage_latency{symbol, stage[, freq]}: decode, upsert, resample (per freq),
+  indicators (per freq), signals, orders, repair (of missed klines)
+- event_lag{symbol}: exchange event time (`msg['E']`) to evaluated signals
+- rest_latency{method, endpoint}: REST calls through `gateway.RestGateway`
+
+Histograms have fixed log-spaced buckets (10us .. ~100s), so recording is a
+binary search and three additions, without locking; cheap enough to leave
+on. A histogram is meant to have one writer at a time (a tracker is only
+run by one thread at a time); concurrent writers may rarely lose a count.
+
+Expose with `metrics.serve(port)` (GET /metrics: Prometheus text format,
+GET /metrics.json: JSON snapshot) and/or `metrics.start_snapshots(path)`.
+"""
+import os
+import json
+import time
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PREFIX = 'binance_tracker_'
+# 10us * 10^(k/4): 4 buckets per decade up to 100s
+buckets = [1e-5 * 10 ** (k / 4.) for k in range(29)]
+
+
+class Histogram():
+    def __init__(self, bounds=buckets):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, x):
+        self.counts[bisect_left(self.bounds, x)] += 1
+        self.sum += x
+        self.count += 1
+
+    def quantile(self, q):
+        """Estimate quantile q from the buckets (upper bucket bound)."""
+        counts = list(self.counts)
+        n = sum(counts)
+        if n == 0:
+            return None
+        rank, cum = q * n, 0
+        for i, c in enumerate(counts):
+            cum += c
+            if cum >= rank:
+                return self.bounds[i] if i < len(self.bounds) else float('inf')
+        return float('inf')
+
+
+class Metrics():
+    def __init__(self):
+        self.histograms = {}
+        self.lock = threading.Lock()
+        self.server = None
+
+    def histogram(self, name, **labels):
+        """Get (or create) the histogram of name and labels."""
+        # Callers pass labels in a fixed order; sorted when rendered.
+        key = (name, tuple(labels.items()))
+        h = self.histograms.get(key)
+        if h is None:
+            with self.lock:
+                h = self.histograms.setdefault(key, Histogram())
+        return h
+
+    def observe(self, name, seconds, **labels):
+        self.histogram(name, **labels).observe(seconds)
+
+    def since(self, name, t0, **labels):
+        """Observe the time since t0 (`time.perf_counter()`); return now."""
+        t = time.perf_counter()
+        self.histogram(name, **labels).observe(t - t0)
+        return t
+
+    def prometheus(self):
+        """Render all histograms in Prometheus text format."""
+        with self.lock:
+            items = sorted(self.histograms.items())
+        lines = []
+        for name in sorted(set(k[0] for k, _ in items)):
+            metric = PREFIX + name + '_seconds'
+            lines.append('# TYPE {} histogram'.format(metric))
+            for (nm, labels), h in items:
+                if nm != name:
+                    continue
+                labels = sorted(labels)
+                counts, total = list(h.counts), h.sum
+                n = sum(counts)
+                lbl = ','.join('{}="{}"'.format(k, v) for k, v in labels)
+                sep = ',' if lbl else ''
+                cum = 0
+                for bound, c in zip(h.bounds + [float('inf')], counts):
+                    cum += c
+                    le = '+Inf' if bound == float('inf') else '{:.6g}'.format(bound)
+                    lines.append('{}_bucket{{{}{}le="{}"}} {}'.format(metric, lbl, sep, le, cum))
+                lines.append('{}_sum{{{}}} {}'.format(metric, lbl, total))
+                lines.append('{}_count{{{}}} {}'.format(metric, lbl, n))
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        """Summary (count, mean and quantiles in ms) of every histogram."""
+        with self.lock:
+            items = sorted(self.histograms.items())
+        out = []
+        for (name, labels), h in items:
+            if h.count == 0:
+                continue
+            row = {'name': name, 'labels': dict(labels), 'count': h.count,
+                   'mean_ms': 1000 * h.sum / h.count}
+            for q in [0.5, 0.95, 0.99]:
+                row['p{}_ms'.format(int(q * 100))] = 1000 * h.quantile(q)
+            out.append(row)
+        return {'time': time.time(), 'histograms': out}
+
+    def serve(self, port=9108, host='127.0.0.1'):
+        """Serve /metrics (Prometheus) and /metrics.json on a daemon thread."""
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                if self.path.startswith('/metrics.json'):
+                    body, ctype = json.dumps(registry.snapshot()), 'application/json'
+                elif self.path.startswith('/metrics'):
+                    body, ctype = registry.prometheus(), 'text/plain; version=0.0.4'
+                else:
+                    self.send_error(404)
+                    return
+                body = body.encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', ctype)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        print('Serving metrics on http://{}:{}/metrics'.format(host, self.server.server_port))
+        return self.server
+
+    def write_snapshot(self, path):
+        """Write the JSON snapshot to path (atomically)."""
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.snapshot(), f, indent=2)
+        os.replace(tmp, path)
+
+    def start_snapshots(self, path, interval=60):
+        """Write JSON snapshots to path every interval seconds (daemon thread)."""
+        def loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.write_snapshot(path)
+                except Exception as e:
+                    print('Writing metrics snapshot failed: {}'.format(e))
+        threading.Thread(target=loop, daemon=True).start()
+
+
+# Process-wide registry.
+metrics = Metrics()
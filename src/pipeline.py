@@ -0,0 +1,135 @@
+"""Opt-in asyncio runtime for the tick path.
+
+The synchronous path runs everything inside the websocket callback
+(`KLineTracker.process_message`). Here the stages are separate coroutines
+joined by bounded queues:
+
+    ingest -> indicators -> signals -> orders
+
+- ingest: decode the kline messages of a symbol. The socket thread only
+  routes a message to the `TickSlot` of its symbol and, if the slot was
+  idle, queues the symbol, so network reads never wait on computation.
+  While the stages are busy, open-candle updates of a symbol replace each
+  other in its slot (closes are kept), so memory stays bounded.
+- indicators: upsert the 1T candle, revise the open candle of every
+  frequency and compute streaming indicators, plus periodic saves. All
+  tracker state (buffers, aggregators, streams) is only touched on this one
+  worker thread. Hands a `KlinesSnapshot` downstream.
+- signals: `TradingBot.evaluate` on the snapshot.
+- orders: REST order-state refresh on its own thread; at most one pending
+  refresh per symbol.
+
+Start with `python src/main.py ... --async_pipeline`.
+"""
+import time
+import asyncio
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from cryptoklines import KlinesSnapshot
+from metrics import metrics
+
+
+class AsyncPipeline():
+    def __init__(self, dispatcher, bot, maxsize=100, save_iter=100,
+                 save_path='./output/data', verbose=0):
+        """Initialize pipeline over the trackers of dispatcher."""
+        self.dispatcher = dispatcher
+        self.bot = bot
+        self.maxsize = maxsize
+        self.save_iter = save_iter
+        self.save_path = save_path
+        self.verbose = verbose
+
+        self.compute = ThreadPoolExecutor(max_workers=1)
+        self.io = ThreadPoolExecutor(max_workers=1)
+        self.pending_orders = set()
+        self.loop = None
+
+    def process_message(self, msg):
+        """Websocket callback (socket thread): hand msg to the ingest stage."""
+        if msg.get('e') == 'error':
+            print('Stream error: {}'.format(msg.get('m')))
+            return
+        tracker, data = self.dispatcher.route(msg)
+        if tracker is not None and self.dispatcher.slots[tracker.symbol].put(data):
+            self.loop.call_soon_threadsafe(self.inbox.put_nowait, (tracker,))
+
+    async def ingest(self, tracker):
+        slot = self.dispatcher.slots[tracker.symbol]
+        for data in slot.take():
+            start = time.perf_counter()
+            row = tracker.parse(data['k'])
+            tracker.latency('decode').observe(time.perf_counter() - start)
+            await self.q_ind.put((tracker, row, data))
+        if slot.done():
+            self.inbox.put_nowait((tracker,))
+
+    async def indicators(self, tracker, row, data):
+        snapshot = await self.loop.run_in_executor(self.compute, self._compute, tracker, row)
+        await self.q_sig.put((tracker, snapshot, data))
+
+    def _compute(self, tracker, row):
+        """Indicator stage body (compute thread), as `KLineTracker.process_klines`."""
+        start = time.perf_counter()
+        repaired = tracker.upsert(row)
+        tracker.latency('upsert').observe(time.perf_counter() - start)
+        if repaired:
+            tracker.update_indicators(tracker.rebuild_open_buckets(row))
+        else:
+            tracker.resample_for_update(row)
+
+        tracker.count_and_save(self.save_iter, self.save_path)
+        return KlinesSnapshot(tracker.df_klines, self.bot.freqs)
+
+    def _seed(self):
+        """Seed the aggregators of all trackers (compute thread)."""
+        for tracker in self.dispatcher.trackers.values():
+            for freq in tracker.df_klines.df_freqs[1:]:
+                tracker.aggregator(freq)
+
+    async def signals(self, tracker, snapshot, data):
+        start = time.perf_counter()
+        self.bot.evaluate(snapshot, tracker.symbol_nm, tracker.verbose)
+        tracker.latency('signals').observe(time.perf_counter() - start)
+        metrics.observe('event_lag', time.time() - data['E'] / 1000., symbol=tracker.symbol)
+        if data['k']['x']:
+            print('{} candle closed at {}'.format(tracker.symbol, pd.to_datetime(data['E'], unit='ms')))
+
+        if tracker.symbol_nm not in self.pending_orders:
+            self.pending_orders.add(tracker.symbol_nm)
+            await self.q_io.put((tracker.symbol_nm,))
+
+    async def orders(self, symbol):
+        self.pending_orders.discard(symbol)
+        start = time.perf_counter()
+        await self.loop.run_in_executor(self.io, self.bot.update_orders, symbol)
+        metrics.since('stage_latency', start, symbol=symbol.replace('_', ''), stage='orders')
+
+    async def _worker(self, queue, stage):
+        """Feed queue items to stage, logging (not raising) its errors."""
+        while True:
+            item = await queue.get()
+            try:
+                await stage(*item)
+            except Exception:
+                traceback.print_exc()
+
+    async def run(self, client):
+        """Seed aggregators, open the market-data connection and run all stages."""
+        self.loop = asyncio.get_event_loop()
+        # At most one inbox entry per symbol (see `process_message`).
+        self.inbox = asyncio.Queue()
+        self.q_ind, self.q_sig, self.q_io = [asyncio.Queue(self.maxsize) for _ in range(3)]
+        await self.loop.run_in_executor(self.compute, self._seed)
+
+        self.dispatcher.start_ticker(client, callback=self.process_message)
+        try:
+            await asyncio.gather(self._worker(self.inbox, self.ingest),
+                                 self._worker(self.q_ind, self.indicators),
+                                 self._worker(self.q_sig, self.signals),
+                                 self._worker(self.q_io, self.orders))
+        finally:
+            self.dispatcher.end_ticker()
@@ -0,0 +1,239 @@
+"""Shard the tracked symbols over worker processes.
+
+In one process, all trackers share one interpreter (and its GIL), so adding
+symbols adds latency to every tick. Here:
+
+- the coordinator (main process) owns the market-data connection, the
+  `TradingBot` (cooldowns, notifications, orders) and the account cache,
+- each `Shard` process owns the `CryptoKlines`, `KLineTracker`s and a
+  `SignalBook` of a subset of the symbols (round-robin), so their warmup,
+  indicators and signals run in parallel on separate cores.
+
+Kline events go to the inbox (a `multiprocessing.Queue`) of the shard of their
+symbol. A shard drains its inbox in batches through per-symbol `TickSlot`s, so
+a busy shard only processes the newest update of each open candle, and sends
+back one message per batch: [(symbol, event time, closed, fired signals)].
+Only raw kline events and small tuples of strings cross processes, never
+frames.
+
+Each shard downloads its own backfill; every process gets an equal share of
+the REST weight budget (see `gateway_client`). With `metrics_port`, shard i
+serves its latency metrics on `metrics_port + 1 + i`.
+
+Start with `python src/main.py ... --n_shards 4`.
+"""
+import time
+import queue
+import traceback
+import threading
+import multiprocessing
+from collections import OrderedDict
+
+import pandas as pd
+
+from utils import printv
+from indicator import Indicator
+from cryptoklines import CryptoKlines, batch_indicators, memory_report
+from klinebuffer import fields
+from klinetracker import KLineTracker, KLineDispatcher, TickSlot
+from signalspec import SignalBook
+from metrics import metrics
+
+
+class Shard():
+    """Trackers and signals of a subset of symbols (run in a worker process)."""
+    def __init__(self, symbols, config, signal_config, freqs, make_client, save_iter=100,
+                 save_path='./output/data', max_batch=1000, metrics_port=None, verbose=0,
+                 **kwargs):
+        """Initialize shard (built in the coordinator, run in the worker).
+
+        args:
+            make_client: picklable callable returning the REST client of the
+                worker, e.g. `functools.partial(gateway_client, path, weight)`.
+            kwargs: passed on to `CryptoKlines` (start_time, load_path,
+                checkpoint_path, lookback, dtype).
+        """
+        self.symbols = symbols
+        self.config = config
+        self.signal_config = signal_config
+        self.freqs = freqs
+        self.make_client = make_client
+        self.save_iter = save_iter
+        self.save_path = save_path
+        self.max_batch = max_batch
+        self.metrics_port = metrics_port
+        self.verbose = verbose
+        self.kwargs = kwargs
+
+    def setup(self):
+        """Warm up the klines and trackers of the symbols; return bytes held."""
+        client = self.make_client()
+        indicator = Indicator(self.config)
+        CK = OrderedDict()
+        for sym in self.symbols:
+            CK[sym] = CryptoKlines(sym, indicator, client, freqs=self.freqs,
+                                   indicators=False, verbose=0, **self.kwargs)
+        batch_indicators([ck for ck in CK.values() if not ck.restored])
+
+        self.trackers = dict((sym.replace('_', ''), KLineTracker(
+            sym, indicator, ck, None, client=client,
+            checkpoint_path=self.kwargs.get('checkpoint_path'), verbose=0)) for sym, ck in CK.items())
+        self.slots = dict((sym, TickSlot()) for sym in self.trackers)
+        self.signal_book = SignalBook(self.signal_config, self.symbols, self.freqs,
+                                      list(fields) + indicator.names())
+        return memory_report(CK.values())
+
+    def process(self, msgs):
+        """Process a batch of kline events; return [(symbol, E, closed, fired)]."""
+        for msg in msgs:
+            self.slots[msg['s']].put(msg)
+
+        out = []
+        for sym in OrderedDict.fromkeys(msg['s'] for msg in msgs):
+            tracker, slot = self.trackers[sym], self.slots[sym]
+            for msg in slot.take():
+                try:
+                    tracker.process_klines(msg['k'])
+                    start = time.perf_counter()
+                    self.signal_book.update(tracker.symbol_nm, tracker.df_klines)
+                    fired = self.signal_book.fired([tracker.symbol_nm])
+                    tracker.latency('signals').observe(time.perf_counter() - start)
+                    tracker.count_and_save(self.save_iter, self.save_path)
+                except Exception:
+                    traceback.print_exc()
+                    continue
+                out.append((tracker.symbol_nm, msg['E'], msg['k']['x'], fired))
+            slot.done()
+        return out
+
+    def run(self, index, inbox, outbox):
+        """Worker process: set up, then process inbox batches until None."""
+        if self.metrics_port is not None:
+            metrics.serve(self.metrics_port + 1 + index)
+        try:
+            n_bytes = self.setup()
+        except Exception:
+            outbox.put(('error', index, traceback.format_exc()))
+            return
+        outbox.put(('ready', index, n_bytes))
+
+        stop = False
+        while not stop:
+            msgs = [inbox.get()]
+            while len(msgs) < self.max_batch:
+                try:
+                    msgs.append(inbox.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in msgs
+            msgs = [msg for msg in msgs if msg is not None]
+            if msgs:
+                outbox.put(('signals', index, self.process(msgs)))
+
+        for tracker in self.trackers.values():
+            tracker.df_klines.save(self.save_path)
+            tracker.checkpoint()
+        outbox.put(('stopped', index, None))
+
+
+class ShardedDispatcher(KLineDispatcher):
+    """Coordinator: route the combined kline stream to `Shard` processes.
+
+    Signals fired in the shards are acted on by bot (cooldown, notification,
+    order state) on a collector thread of this process.
+    """
+    def __init__(self, symbols, bot, n_shards, save_iter=100, checkpoint_path=None,
+                 verbose=0, **kwargs):
+        """Initialize dispatcher and its shards.
+
+        args:
+            symbols: e.g. ['ETH_BTC', 'XRP_BTC'].
+            kwargs: passed on to `Shard`.
+        """
+        super(ShardedDispatcher, self).__init__(coalesce=False, verbose=verbose)
+        n_shards = max(1, min(n_shards, len(symbols)))
+        self.shards = [Shard(symbols[i::n_shards], checkpoint_path=checkpoint_path,
+                             save_iter=save_iter, verbose=verbose, **kwargs)
+                       for i in range(n_shards)]
+        # symbol (e.g. 'ETHBTC') -> shard index, used as the "tracker".
+        self.trackers = dict((sym.replace('_', ''), i) for i, shard in enumerate(self.shards)
+                             for sym in shard.symbols)
+        self.bot = bot
+        self.save_iter = save_iter
+        self.checkpoint_path = checkpoint_path
+        self.counter = 0
+        self.processes = []
+
+    def start(self, timeout=None):
+        """Start the shard processes and wait until all are warmed up."""
+        # spawn: the coordinator already runs socket and gateway threads.
+        ctx = multiprocessing.get_context('spawn')
+        self.inboxes = [ctx.Queue() for _ in self.shards]
+        self.outbox = ctx.Queue()
+        for i, shard in enumerate(self.shards):
+            p = ctx.Process(target=shard.run, args=(i, self.inboxes[i], self.outbox),
+                            name='shard-{}'.format(i), daemon=True)
+            p.start()
+            self.processes.append(p)
+
+        n_bytes = 0
+        for _ in self.shards:
+            kind, i, res = self.outbox.get(timeout=timeout)
+            if kind == 'error':
+                self.stop()
+                raise RuntimeError('Shard {} failed to start:\n{}'.format(i, res))
+            print('Shard {} ready: {}'.format(i, self.shards[i].symbols))
+            n_bytes += res
+        print('Total: {:.1f} MB in {} shards'.format(n_bytes / 1e6, len(self.shards)))
+
+        self.collector = threading.Thread(target=self.collect, daemon=True)
+        self.collector.start()
+
+    def process_message(self, msg):
+        """Recieve combined stream message; hand its kline event to the shard."""
+        if msg.get('e') == 'error':
+            print('Stream error: {}'.format(msg.get('m')))
+            return
+
+        i, data = self.route(msg)
+        if i is not None:
+            self.inboxes[i].put(data)
+
+    def collect(self):
+        """Collector loop: act on the signals of the shards."""
+        while True:
+            kind, i, results = self.outbox.get()
+            if kind == 'stopped':
+                printv('Shard {} stopped'.format(i), self.verbose)
+                continue
+            try:
+                self.on_results(results)
+            except Exception:
+                traceback.print_exc()
+
+    def on_results(self, results):
+        """Notify of fired signals, then refresh the order state once per symbol."""
+        for symbol, event_time, closed, fired in results:
+            self.bot.on_fired(symbol, fired)
+            metrics.observe('event_lag', time.time() - event_time / 1000., symbol=symbol.replace('_', ''))
+            if closed:
+                print('{} candle closed at {}'.format(symbol.replace('_', ''), pd.to_datetime(event_time, unit='ms')))
+
+        for symbol in OrderedDict.fromkeys(e[0] for e in results):
+            start = time.perf_counter()
+            self.bot.update_orders(symbol)
+            metrics.since('stage_latency', start, symbol=symbol.replace('_', ''), stage='orders')
+
+        self.counter += len(results)
+        if self.checkpoint_path is not None and self.counter >= self.save_iter:
+            self.bot.save_state(self.checkpoint_path)
+            self.counter = 0
+
+    def stop(self, timeout=60):
+        """Stop the shards (they save and checkpoint first)."""
+        for inbox in self.inboxes:
+            inbox.put(None)
+        for p in self.processes:
+            p.join(timeout)
+        if self.checkpoint_path is not None:
+            self.bot.save_state(self.checkpoint_path)
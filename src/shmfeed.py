@@ -0,0 +1,302 @@
+"""Shared-memory kline feed for local consumers.
+
+One ingest daemon follows the kline stream of the tracked symbols and writes
+their candles into named shared-memory rings, one per (symbol, freq) of 1T
+and the aggregated frequencies, optionally with their indicator columns.
+Other processes (`stop_loss.py --feed`, a `TradingBot`, notebooks)
+attach to the rings by name and read them without a socket of their own or
+recomputing anything.
+
+Ring layout (`KlineRing`): an int64 header (seq, rows written, capacity,
+number of columns), a json block naming the columns, and a float64 matrix of
+`capacity` rows (one contiguous row per candle, ints are exact in float64).
+The daemon is the only writer of a ring. Each write is guarded by a seqlock:
+`seq` is odd while rows are written, so readers retry a copy if `seq` was odd
+or changed meanwhile. Readers copy only the rows they ask for; `ring.data`
+can also be read in place (zero-copy) between two equal `version()`s.
+
+    from shmfeed import SharedKlines
+    ck = SharedKlines('ETH_BTC', ['1T', '5T'])
+    ck.tail('5T', 100)                 # dataframe, like `CryptoKlines.tail`
+    bot.evaluate(ck, 'ETH_BTC', 0)     # e.g. a `TradingBot` without a socket
+
+cmd:
+cd binance-tracker/
+python src/shmfeed.py --client_path assets/client.txt --trading_currencies ETH XRP --trading_freqs 1T 5T 1H --indicators
+"""
+import sys
+import json
+import time
+import atexit
+import argparse
+sys.path.append('./src')
+from multiprocessing import shared_memory, resource_tracker
+
+import numpy as np
+import pandas as pd
+
+from utils import get_config
+from klinebuffer import fields
+
+PREFIX = 'binance_tracker_'
+SEQ, HI, CAPACITY, N_COLUMNS = range(4)
+HEADER = 64
+META = 4096
+
+
+def ring_name(symbol, freq, prefix=PREFIX):
+    """Name of the shared-memory ring of symbol (e.g. 'ETH_BTC') and freq."""
+    return '{}{}_{}'.format(prefix, symbol.upper().replace('_', ''), freq)
+
+
+def _attach(name):
+    """Attach to an existing segment without handing it to the resource tracker.
+
+    Otherwise the tracker of a reader unlinks the segment when the reader
+    exits (Python < 3.13).
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        pass
+    register = resource_tracker.register
+    resource_tracker.register = lambda name, rtype: None
+    try:
+        return shared_memory.SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
+
+
+class KlineRing():
+    def __init__(self, shm, owner=False):
+        """Map the header, columns and rows of a ring segment (see `create`, `attach`)."""
+        self.shm = shm
+        self.owner = owner
+        self.header = np.ndarray((HEADER // 8,), dtype=np.int64, buffer=shm.buf)
+        meta = bytes(shm.buf[HEADER:HEADER + META]).rstrip(b'\0')
+        self.columns = json.loads(meta.decode('utf-8'))['columns']
+        self.capacity = int(self.header[CAPACITY])
+        self.data = np.ndarray((self.capacity, len(self.columns)), dtype=np.float64,
+                               buffer=shm.buf, offset=HEADER + META)
+        self.index = dict((c, j) for j, c in enumerate(self.columns))
+
+    @classmethod
+    def create(cls, name, columns, capacity=1440):
+        """Create the ring (replacing a stale one of a previous run)."""
+        columns = list(columns)
+        if columns[0] != 'start_t':
+            raise ValueError('The first column must be `start_t`.')
+        meta = json.dumps({'columns': columns}).encode('utf-8')
+        if len(meta) > META:
+            raise ValueError('Too many columns for a ring.')
+
+        size = HEADER + META + capacity * len(columns) * 8
+        try:
+            shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        except FileExistsError:
+            stale = shared_memory.SharedMemory(name=name)
+            stale.close()
+            stale.unlink()
+            shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+
+        header = np.ndarray((HEADER // 8,), dtype=np.int64, buffer=shm.buf)
+        header[:] = 0
+        header[CAPACITY], header[N_COLUMNS] = capacity, len(columns)
+        shm.buf[HEADER:HEADER + len(meta)] = meta
+        return cls(shm, owner=True)
+
+    @classmethod
+    def attach(cls, name):
+        """Attach to the ring of a running daemon (FileNotFoundError if none)."""
+        return cls(_attach(name))
+
+    def __len__(self):
+        return min(int(self.header[HI]), self.capacity)
+
+    def version(self):
+        """Seqlock counter: changes with every write, odd while writing."""
+        return int(self.header[SEQ])
+
+    def write(self, rows):
+        """Write rows (dict of arrays sorted by `start_t`, e.g. `KlineBuffer.tail`).
+
+        Rows of the ring starting at or after the first new row are replaced,
+        so rewriting the open candle(s) revises them in place.
+        """
+        start_t = np.asarray(rows['start_t'])
+        n = min(len(start_t), self.capacity)
+        if n == 0:
+            return
+        block = np.empty((n, len(self.columns)))
+        for j, c in enumerate(self.columns):
+            block[:, j] = np.asarray(rows[c])[-n:] if c in rows else np.nan
+        t0 = block[0, 0]
+
+        hi = int(self.header[HI])
+        k, n_old = 0, min(hi, self.capacity)
+        while k < n_old and self.data[(hi - 1 - k) % self.capacity, 0] >= t0:
+            k += 1
+
+        self.header[SEQ] += 1
+        hi -= k
+        self.data[np.arange(hi, hi + n) % self.capacity] = block
+        self.header[HI] = hi + n
+        self.header[SEQ] += 1
+
+    def read(self, n=1):
+        """Consistent copy of the last n rows: array (rows, columns)."""
+        while True:
+            seq = self.header[SEQ]
+            if seq & 1:
+                time.sleep(0)
+                continue
+            hi = int(self.header[HI])
+            m = min(n, hi, self.capacity)
+            out = self.data[np.arange(hi - m, hi) % self.capacity]
+            if self.header[SEQ] == seq:
+                return out
+
+    def last(self, column='close'):
+        """Value of column in the last row (None if empty)."""
+        row = self.read(1)
+        return row[-1, self.index[column]] if len(row) else None
+
+    def tail(self, n=1, columns=None):
+        """Dataframe of the last n rows, indexed by kline start time."""
+        rows = self.read(n)
+        columns = self.columns if columns is None else columns
+        df = pd.DataFrame(rows[:, [self.index[c] for c in columns]], columns=columns,
+                          index=pd.DatetimeIndex(rows[:, 0].astype(np.int64) * 1000000, name='time'))
+        for c in columns:
+            if c in fields and fields[c] == np.int64:
+                df[c] = df[c].astype(np.int64)
+        return df
+
+    def close(self):
+        """Unmap (and remove, if this process created the ring)."""
+        self.header = self.data = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class SharedKlines():
+    """Read-only `CryptoKlines` stand-in over the rings of one symbol."""
+    def __init__(self, symbol, freqs=('1T',), prefix=PREFIX):
+        self.symbol = symbol
+        self.df_freqs = list(freqs)
+        self.rings = dict((freq, KlineRing.attach(ring_name(symbol, freq, prefix))) for freq in freqs)
+
+    def tail(self, freq='1T', n=1, columns=None):
+        """Dataframe of the last n klines of freq (copied under the seqlock)."""
+        return self.rings[freq].tail(n, columns)
+
+    def version(self):
+        """Sum of the ring versions: changes whenever any ring is written."""
+        return sum(ring.version() for ring in self.rings.values())
+
+    def close(self):
+        for ring in self.rings.values():
+            ring.close()
+
+
+class FeedPublisher():
+    """Write the buffers of `CryptoKlines` into rings after every tick.
+
+    Stands in for the bot of the daemon's trackers (`KLineTracker` calls it
+    with the updated klines after each message).
+    """
+    def __init__(self, crypto_klines, capacity=1440, indicators=False, prefix=PREFIX):
+        """Create the rings of every symbol and freq and write their history.
+
+        args:
+            indicators: publish the indicator columns of every freq (else
+                kline fields only).
+        """
+        self.rings = {}
+        # Number of `CryptoKlines.rewrites` already published, per symbol.
+        self.seen = {}
+        for ck in crypto_klines:
+            self.seen[ck.symbol] = len(ck.rewrites)
+            for freq in ck.df_freqs:
+                buf = ck.buffers[freq]
+                columns = buf.columns() if indicators else list(fields)
+                ring = KlineRing.create(ring_name(ck.symbol, freq, prefix), columns, capacity)
+                ring.write(buf.tail(capacity))
+                self.rings[(ck.symbol, freq)] = ring
+        atexit.register(self.close)
+
+    def __call__(self, crypto_klines, symbol, verbose=0):
+        self.publish(crypto_klines)
+
+    def publish(self, crypto_klines, n=2):
+        """Rewrite the last n rows (closed and open candle) of every freq.
+
+        After klines were repaired (see `CryptoKlines.catch_up`), all rows from
+        the bucket of the earliest recomputed kline on are rewritten.
+        """
+        rewrites = crypto_klines.rewrites[self.seen.get(crypto_klines.symbol, 0):]
+        self.seen[crypto_klines.symbol] = len(crypto_klines.rewrites)
+        for freq, buf in crypto_klines.buffers.items():
+            ring = self.rings.get((crypto_klines.symbol, freq))
+            if ring is None:
+                continue
+            m = n
+            if rewrites:
+                start_t = buf.tail(column='start_t')
+                i = max(int(np.searchsorted(start_t, min(rewrites), side='right')) - 1, 0)
+                m = max(len(start_t) - i, n)
+            ring.write(buf.tail(m))
+
+    def close(self):
+        """Remove the rings."""
+        for ring in self.rings.values():
+            if ring.header is not None:
+                ring.close()
+
+
+parser = argparse.ArgumentParser(description='Shared-memory kline feed.')
+
+parser.add_argument('--trading_currencies', nargs='+', default=['ETH', 'XRP'], help='List of currencies. Need to be traded with base_currency.')
+parser.add_argument('--trading_freqs', nargs='+', default=['1T'], help='List of frequencies to publish.')
+parser.add_argument('--base_currency', type=str, default='BTC', help='BTC|USDT.')
+parser.add_argument('--load_path', type=str, default=None, help='Path to kline data file(s) (.klines or .csv).')
+parser.add_argument('--client_path', type=str, default=None, help='Path to client key txt.')
+parser.add_argument('--config', type=str, default='configs/indicators.yaml', help='Path to the indicator config file.')
+parser.add_argument('--indicators', action='store_true', help='Publish indicator columns (else kline fields only).')
+parser.add_argument('--capacity', type=int, default=1440, help='Klines kept per ring.')
+
+
+def main(args, client):
+    """Follow the kline stream and publish it."""
+    from indicator import Indicator
+    from cryptoklines import CryptoKlines, batch_indicators
+    from klinetracker import KLineTracker, KLineDispatcher
+
+    symbols = ['{}_{}'.format(sym.upper(), args.base_currency) for sym in args.trading_currencies]
+    indicator = Indicator(get_config(args.config))
+    CK = dict((sym, CryptoKlines(sym, indicator, client, start_time='10 days ago UTC',
+                                 load_path=args.load_path, indicators=False,
+                                 freqs=args.trading_freqs, verbose=0)) for sym in symbols)
+    batch_indicators(CK.values())
+
+    publisher = FeedPublisher(CK.values(), args.capacity, args.indicators)
+    print('Publishing {}'.format(sorted(ring.shm.name for ring in publisher.rings.values())))
+    dispatcher = KLineDispatcher([KLineTracker(sym, indicator, ck, publisher, client=client, verbose=0)
+                                  for sym, ck in CK.items()])
+    dispatcher.start_ticker(client)
+    try:
+        while True:
+            time.sleep(60)
+    finally:
+        dispatcher.end_ticker()
+        publisher.close()
+
+
+if __name__ == "__main__":
+    from gateway import gateway_client
+
+    args = parser.parse_args()
+    if args.client_path is None:
+        raise ValueError('`client_path` not provided.')
+    main(args, gateway_client(args.client_path))
@@ -1,10 +1,14 @@
 """Create signals to be imported by the trading bot.
 
-Example signal is provided.
+Example signal is provided. Each signal has a vectorized form that returns
+a boolean series over every row of a kline dataframe (used by the backtest)
+and a live form that evaluates only the last row (used by the bot).
 """
+import pandas as pd
 
-def eg_condition(df, x=['ema_25'], t=20):
-    """If list of indicators is below threshold
+
+def eg_condition_series(df, x=['ema_indicator_25'], t=20):
+    """If list of indicators is below threshold (for every row of df).
 
     if x=['a', 'b'] and t = 20
     a  b
@@ -14,12 +18,19 @@ def eg_condition(df, x=['ema_25'], t=20):
     10 10 <-- signal
     25 10
     """
-
     if not isinstance(x, list):
         x = [x]
 
-    df = df.tail(1)
-    out = True
+    out = pd.Series(True, index=df.index)
     for i in x:
-        out = out and (df[i].values < t)
+        out &= df[i] < t
     return out
+
+
+def eg_condition(df, x=['ema_indicator_25'], t=20):
+    """If list of indicators is below threshold (last row of df)."""
+    return bool(eg_condition_series(df.tail(1), x, t).iloc[-1])
+
+
+# Vectorized signals available to the backtest, by name.
+signal_series = {'eg_condition': eg_condition_series}
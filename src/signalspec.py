@@ -0,0 +1,156 @@
+"""Declarative signals compiled to vectorized NumPy expressions.
+
+Signals are read from a yaml file (see `configs/signals.yaml`):
+
+    signal_name:
+      and:
+        - lt: [rsi_14, 30]                          # column vs threshold
+        - cross_above: [ema_indicator_7, ema_indicator_25]
+        - or:
+          - gt: [close, bollinger_lband_25]
+          - not: {ge: [stoch_14, 80]}
+
+Operators: lt, le, gt, ge (operands are column names or numbers),
+cross_above / cross_below (compares the last and previous candle), and,
+or, not. Columns can be any kline field or indicator name.
+
+Each signal is compiled once into a function f(cur, prev) of ufuncs over
+arrays whose last axis holds the referenced columns. A `SignalBook` keeps the
+latest and previous values of every (symbol, freq, column) in two matrices,
+so all signals of a symbol (or of all tracked pairs) are evaluated in one
+vectorized step. The same functions evaluate full kline dataframes for the
+backtest.
+"""
+from functools import reduce
+
+import numpy as np
+import pandas as pd
+
+comparisons = {'lt': np.less,
+               'le': np.less_equal,
+               'gt': np.greater,
+               'ge': np.greater_equal}
+crossings = {'cross_above': np.greater,
+             'cross_below': np.less}
+logicals = {'and': np.logical_and,
+            'or': np.logical_or}
+
+
+def _parse(spec):
+    """Return (operator, args) of a single-key spec dict."""
+    if not isinstance(spec, dict) or len(spec) != 1:
+        raise ValueError('Signal spec must be a dict with one operator: {}'.format(spec))
+    return list(spec.items())[0]
+
+
+def spec_columns(spec):
+    """Return the column names referenced by spec."""
+    op, args = _parse(spec)
+    if op == 'not':
+        return spec_columns(args)
+    if op in logicals:
+        return [c for a in args for c in spec_columns(a)]
+    return [a for a in args if isinstance(a, str)]
+
+
+def _operand(x, columns):
+    """Return (current, previous) value functions of an operand."""
+    if isinstance(x, str):
+        i = columns.index(x)
+        return (lambda cur, prev: cur[..., i]), (lambda cur, prev: prev[..., i])
+    return (lambda cur, prev: x), (lambda cur, prev: x)
+
+
+def compile_signal(spec, columns):
+    """Compile spec into f(cur, prev) -> boolean array.
+
+    cur and prev hold the latest and previous candle's values, with `columns`
+    along their last axis; the result has their other dimensions.
+    """
+    op, args = _parse(spec)
+    if op in comparisons:
+        (a, _), (b, _) = [_operand(x, columns) for x in args]
+        f = comparisons[op]
+        return lambda cur, prev: f(a(cur, prev), b(cur, prev))
+
+    if op in crossings:
+        (a, a_prev), (b, b_prev) = [_operand(x, columns) for x in args]
+        f = crossings[op]
+        return lambda cur, prev: (f(a(cur, prev), b(cur, prev))
+                                  & ~f(a_prev(cur, prev), b_prev(cur, prev))
+                                  & ~np.isnan(a_prev(cur, prev) - b_prev(cur, prev)))
+
+    if op in logicals:
+        fns = [compile_signal(a, columns) for a in args]
+        f = logicals[op]
+        return lambda cur, prev: reduce(f, [fn(cur, prev) for fn in fns])
+
+    if op == 'not':
+        fn = compile_signal(args, columns)
+        return lambda cur, prev: np.logical_not(fn(cur, prev))
+
+    raise ValueError('Unknown signal operator: {}'.format(op))
+
+
+def spec_series(spec, df):
+    """Evaluate spec over every row of a kline dataframe (boolean series)."""
+    columns = sorted(set(spec_columns(spec)))
+    cur = df.loc[:, columns].values.astype(np.float64)
+    prev = np.vstack([np.full((1, len(columns)), np.nan), cur[:-1]])
+    return pd.Series(compile_signal(spec, columns)(cur, prev), index=df.index)
+
+
+class SignalBook():
+    def __init__(self, config, symbols, freqs, known=None):
+        """Compile signals of config for a (symbol, freq) grid.
+
+        args:
+            config: dict {signal_name: spec}, e.g. read from configs/signals.yaml.
+            known: optional column names of the klines (kline fields and
+                indicator names); signals referencing others raise ValueError.
+        """
+        self.names = list(config.keys())
+        self.columns = sorted(set(c for spec in config.values() for c in spec_columns(spec)))
+        if known is not None:
+            unknown = [c for c in self.columns if c not in known]
+            if unknown:
+                raise ValueError('Signals reference unknown columns: {}'.format(unknown))
+        self.fns = [compile_signal(config[nm], self.columns) for nm in self.names]
+
+        self.symbols = dict((sym, i) for i, sym in enumerate(symbols))
+        self.freqs = list(freqs)
+        shape = (len(self.symbols), len(self.freqs), len(self.columns))
+        self.cur = np.full(shape, np.nan)
+        self.prev = np.full(shape, np.nan)
+
+    def update(self, symbol, crypto_klines):
+        """Copy the last two candles of every freq of symbol into the matrices.
+
+        Reads the kline buffers directly (`crypto_klines.buffer`).
+        """
+        s = self.symbols[symbol]
+        for f, freq in enumerate(self.freqs):
+            buf = crypto_klines.buffer(freq)
+            for c, column in enumerate(self.columns):
+                values = buf.tail(2, column=column)
+                self.cur[s, f, c] = values[-1]
+                self.prev[s, f, c] = values[-2] if len(values) > 1 else np.nan
+
+    def evaluate(self, symbol=None):
+        """Evaluate signals: boolean array (signal, symbol, freq), or (signal, freq) of symbol."""
+        if symbol is None:
+            cur, prev = self.cur, self.prev
+        else:
+            cur, prev = self.cur[self.symbols[symbol]], self.prev[self.symbols[symbol]]
+        return np.stack([fn(cur, prev) for fn in self.fns])
+
+    def fired(self, symbols=None):
+        """Return [(signal, symbol, freq)] of signals that are true.
+
+        Evaluates the rows of symbols only (default: all symbols at once).
+        """
+        if symbols is None:
+            inv = dict((i, sym) for sym, i in self.symbols.items())
+            return [(self.names[n], inv[s], self.freqs[f]) for n, s, f in zip(*np.nonzero(self.evaluate()))]
+        return [(self.names[n], sym, self.freqs[f])
+                for sym in symbols for n, f in zip(*np.nonzero(self.evaluate(sym)))]
@@ -7,19 +7,46 @@ as those that would be input in the Binance stop-loss fields. This script
 monitors the prices in the background and terminates when take-profit or
 stop-loss is fulfilled.
 
+`StopLossService` protects many positions (across symbols) in one process,
+from one all-market price stream. Positions are read from a yaml file that
+is reloaded when it changes, so positions can be added or removed at runtime:
+
+    ADA_BTC:                 # id: symbol and parameters
+      balance: 100
+      p_stop: 0.00031
+      p_limit: 0.0003        # optional, default market sell
+      p_take: 0.00036        # optional, emulated take-profit leg
+    ADA_BTC_2:
+      symbol: ADA_BTC
+      ...
+
+Without p_take, the open sell order of the symbol (the take-profit set on
+binance.com) is canceled when the stop triggers, as before.
+
+With `--feed`, prices are read from the shared-memory rings of a running
+`shmfeed.py` daemon instead of a websocket.
+
 cmd:
 cd binance-tracker/
 python src/stop_loss.py --client_path assets/client.txt --symbol ADA_BTC --p_stop 0.00031 --p_limit 0.0003 --balance 100
+python src/stop_loss.py --client_path assets/client.txt --positions configs/positions.yaml
+python src/stop_loss.py --client_path assets/client.txt --positions configs/positions.yaml --feed
 """
 
+import os
+import time
 import argparse
+import threading
 import datetime as dt
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ThreadPoolExecutor
 
-from binance.client import Client
 from binance.websockets import BinanceSocketManager
-from binance.enums import *
 
-from utils import notify
+from utils import notify, get_config
+from gateway import GatewayClient
+from accountcache import AccountCache
+from shmfeed import KlineRing, ring_name
 
 parser = argparse.ArgumentParser(description='Implement stop-loss.')
 
@@ -28,78 +55,255 @@ parser.add_argument('--symbol', type=str, default=None, help='Symbol to stop los
 parser.add_argument('--p_stop', type=float, default=None, help='Price to trigger order.')
 parser.add_argument('--p_limit', type=float, default=None, help='Price to sell.')
 parser.add_argument('--balance', type=str, default=None, help='Balance of coin.')
+parser.add_argument('--p_take', type=float, default=None, help='Price to take profit (emulated OCO leg).')
+parser.add_argument('--feed', action='store_true', help='Read prices from the shared-memory feed of src/shmfeed.py instead of a websocket.')
+parser.add_argument('--positions', type=str, default=None, help='Path to a positions yaml file (many positions, reloaded on change).')
+
+
+def format_price(p):
+    """Format price (8 decimals, as Binance) without exponent or trailing zeros."""
+    return '{:.8f}'.format(p).rstrip('0').rstrip('.')
+
 
+class _Levels():
+    """Trigger prices of one symbol, kept sorted (bisect arrays)."""
+    def __init__(self):
+        self.prices = []
+        self.ids = []
 
-class StopLoss():
-    def __init__(self, args, client):
-        self.counter = 0
-        self.symbol = args.symbol.upper()
-        self.symbol_nm = self.symbol.replace('_', '')
-        self.balance = args.balance
-        self.p_stop = args.p_stop
+    def __len__(self):
+        return len(self.prices)
 
-        p = '{:.20f}'.format(args.p_limit)
-        while p[-1] == '0':
-            p = p[:-1]
-        self.p_limit = p
+    def add(self, price, pos_id):
+        i = bisect_right(self.prices, price)
+        self.prices.insert(i, price)
+        self.ids.insert(i, pos_id)
 
+    def remove(self, price, pos_id):
+        i = bisect_left(self.prices, price)
+        while i < len(self.ids) and self.ids[i] != pos_id:
+            i += 1
+        if i < len(self.ids):
+            del self.prices[i], self.ids[i]
+
+    def pop_above(self, price):
+        """Remove and return ids of levels >= price (O(log n) if none)."""
+        i = bisect_left(self.prices, price)
+        out = self.ids[i:]
+        del self.prices[i:], self.ids[i:]
+        return out
+
+    def pop_below(self, price):
+        """Remove and return ids of levels <= price (O(log n) if none)."""
+        i = bisect_right(self.prices, price)
+        out = self.ids[:i]
+        del self.prices[:i], self.ids[:i]
+        return out
+
+
+class StopLossService():
+    def __init__(self, client, account=None, n_workers=2, verbose=0):
+        """Initialize stop-loss service for many positions.
+
+        args:
+            account: `AccountCache` (started here if None) to look up and
+                follow the take-profit orders of positions.
+        """
         self.client = client
+        self.verbose = verbose
+        if account is None:
+            account = AccountCache(client)
+            account.start()
+        self.account = account
+
+        self.lock = threading.Lock()
+        self.positions = {}
+        self.stops = {}
+        self.takes = {}
+        self.resting = {}
+        self.executor = ThreadPoolExecutor(max_workers=n_workers)
+        self.bm = None
+        self.polling = False
+        self.done = threading.Event()
 
-        self.order = client.get_open_orders(symbol=self.symbol_nm)
-        assert len(self.order) == 1, 'More than one order on {} \n {}'.format(self.symbol, self.order)
+    def add(self, pos_id, symbol, balance, p_stop, p_limit=None, p_take=None, order_id=None):
+        """Protect a position (replaces the one with the same id).
 
-        self.can_sell = True
+        With p_take, a take-profit is emulated (market sell at p_take).
+        Otherwise order_id (default: the open sell order of symbol) is the
+        take-profit order to cancel when the stop triggers; the position is
+        dropped once that order is gone.
+        """
+        symbol = symbol.upper().replace('_', '')
+        if p_take is None and order_id is None:
+            orders = [o for o in self.account.open_orders(symbol) if o['side'] == 'SELL']
+            assert len(orders) <= 1, 'More than one order on {} \n {}'.format(symbol, orders)
+            order_id = orders[0]['orderId'] if orders else None
 
-        self.t0 = None
+        pos = {'id': pos_id, 'symbol': symbol, 'balance': str(balance),
+               'p_stop': float(p_stop), 'p_limit': p_limit, 'p_take': p_take,
+               'order_id': order_id}
+        with self.lock:
+            self._remove(pos_id)
+            self.positions[pos_id] = pos
+            self.done.clear()
+            self.stops.setdefault(symbol, _Levels()).add(pos['p_stop'], pos_id)
+            if p_take is not None:
+                self.takes.setdefault(symbol, _Levels()).add(float(p_take), pos_id)
+            elif order_id is not None:
+                self.resting.setdefault(symbol, {})[order_id] = pos_id
+        print('Protecting {}: {}'.format(pos_id, pos))
+
+    def remove(self, pos_id):
+        """Stop protecting a position."""
+        with self.lock:
+            self._remove(pos_id)
+
+    def _remove(self, pos_id, popped=None):
+        """Drop a position; popped: its leg ('stop' or 'take') already popped from the levels."""
+        pos = self.positions.pop(pos_id, None)
+        if pos is None:
+            return None
+        if popped != 'stop':
+            self.stops[pos['symbol']].remove(pos['p_stop'], pos_id)
+        if pos['p_take'] is not None and popped != 'take':
+            self.takes[pos['symbol']].remove(float(pos['p_take']), pos_id)
+        self.resting.get(pos['symbol'], {}).pop(pos['order_id'], None)
+        if not self.positions:
+            self.done.set()
+        return pos
+
+    def load(self, path):
+        """Sync positions with a yaml file: add new/changed ones, remove missing ones."""
+        config = get_config(path) or {}
+        with self.lock:
+            current = dict((k, dict(v)) for k, v in self.positions.items())
+        for pos_id in current:
+            if pos_id not in config:
+                self.remove(pos_id)
+        for pos_id, v in config.items():
+            v = dict(v)
+            symbol = v.pop('symbol', pos_id)
+            pos = current.get(pos_id)
+            if pos is None or any(str(pos[k]) != str(v[k]) for k in ['balance', 'p_stop', 'p_limit', 'p_take'] if k in v):
+                self.add(pos_id, symbol, **v)
+
+    def process_price(self, symbol, price):
+        """Fire the legs crossed by price (O(log n) per symbol when none is)."""
+        with self.lock:
+            stops = self.stops.get(symbol)
+            if stops is None or not len(stops):
+                return
+            fired = [(self._remove(i, 'stop'), 'stop') for i in stops.pop_above(price)]
+            if symbol in self.takes:
+                fired += [(self._remove(i, 'take'), 'take') for i in self.takes[symbol].pop_below(price)]
+
+            # Take-profit orders filled (or canceled) on the exchange.
+            gone = []
+            if self.resting.get(symbol):
+                open_ids = set(o['orderId'] for o in self.account.open_orders(symbol))
+                gone = [self._remove(i) for k, i in list(self.resting[symbol].items()) if k not in open_ids]
+
+        for pos, leg in fired:
+            if pos is not None:
+                self.executor.submit(self._execute, pos, leg, price)
+        for pos in gone:
+            notify('Order fulfilled otherwise', pos['id'], '')
+            print('{} closed by its take-profit order.'.format(pos['id']))
 
     def process_message(self, msg):
-        """Cancel take-profit and implement stop-loss if stop-loss is triggered."""
-        p_current = float(msg['k']['c'])
-        if self.counter % 60 == 0:
-            print('Current price: {}'.format(p_current))
-
-        # If ticker value fall to or below args.p_stop
-        if p_current <= self.p_stop and self.can_sell:
-            notify('Stop loss triggered', self.symbol, '')
-            self.t0 = dt.datetime.now()
-            # Cancel existing sell order
-            self.client.cancel_order(symbol=self.symbol_nm,
-                                     orderId=self.order[0]['orderId'])
-            print('Canceled profit sell order.')
-
-            # Create new sell order at p_limit
-            self.client.order_limit_sell(symbol=self.symbol_nm,
-                                         quantity=self.balance,
-                                         price=self.p_limit)
-            print('Made stop loss order.')
-
-            self.order = self.client.get_open_orders(symbol=self.symbol_nm)
-            assert len(self.order) <= 1, 'Something failed with stop loss. \n {}'.format(self.order)
-            self.can_sell = False
-
-        self.order = self.client.get_open_orders(symbol=self.symbol_nm)
-        if len(self.order) == 0:
-            if self.t0 is None:
-                notify('Order fulfilled otherwise', self.symbol, '')
+        """All-market mini ticker callback."""
+        if isinstance(msg, dict):
+            if msg.get('e') == 'error':
+                print('Price stream error: {}'.format(msg.get('m')))
+            return
+        for ticker in msg:
+            if ticker['s'] in self.stops:
+                self.process_price(ticker['s'], float(ticker['c']))
+
+    def _execute(self, pos, leg, price):
+        """Cancel the other leg and sell (executor thread)."""
+        try:
+            t0 = dt.datetime.now()
+            if pos['order_id'] is not None:
+                self.account.apply_order(self.client.cancel_order(symbol=pos['symbol'],
+                                                                  orderId=pos['order_id']))
+                print('Canceled profit sell order of {}.'.format(pos['id']))
+
+            if leg == 'stop' and pos['p_limit'] is not None:
+                order = self.client.order_limit_sell(symbol=pos['symbol'],
+                                                     quantity=pos['balance'],
+                                                     price=format_price(float(pos['p_limit'])))
             else:
-                notify('Stop loss processed', self.symbol, '')
-                print('Sell order active for {}.'.format(dt.datetime.now() - self.t0))
-            self.end_ticker()
+                order = self.client.order_market_sell(symbol=pos['symbol'],
+                                                      quantity=pos['balance'])
+            self.account.apply_order(order)
+            notify('Stop loss triggered' if leg == 'stop' else 'Take profit triggered',
+                   '{} at {}'.format(pos['id'], price), '')
+            print('{} order of {} placed in {}.'.format(leg, pos['id'], dt.datetime.now() - t0))
+        except Exception as e:
+            notify('Stop loss failed', pos['id'], str(e))
+            print('Failed to execute {} of {}: {}'.format(leg, pos, e))
 
-        self.counter += 1
+    def start(self, feed=False):
+        """Follow the prices of all symbols (one connection).
 
-    def start_ticker(self):
-        """Start connection to ticker."""
+        args:
+            feed: read the 1T close prices from the shared-memory rings of a
+                running `shmfeed.py` daemon instead.
+        """
+        if feed:
+            self.polling = True
+            threading.Thread(target=self.poll_feed, daemon=True).start()
+            return
         self.bm = BinanceSocketManager(self.client)
-        conn_key = self.bm.start_kline_socket(self.symbol_nm,
-                                              self.process_message,
-                                              interval=KLINE_INTERVAL_1MINUTE)
-
+        self.bm.start_miniticker_socket(self.process_message)
         self.bm.start()
 
-    def end_ticker(self):
-        """Close connection to ticker."""
-        self.bm.close()
+    def poll_feed(self, t_poll=0.05):
+        """Feed loop: process the close price of every ring written since the last poll."""
+        rings, versions = {}, {}
+        while self.polling:
+            for symbol in list(self.stops):
+                if symbol not in rings:
+                    try:
+                        rings[symbol] = KlineRing.attach(ring_name(symbol, '1T'))
+                    except FileNotFoundError:
+                        continue
+                version = rings[symbol].version()
+                if version != versions.get(symbol):
+                    versions[symbol] = version
+                    price = rings[symbol].last('close')
+                    if price is not None:
+                        self.process_price(symbol, price)
+            time.sleep(t_poll)
+
+    def stop(self):
+        """Close the price connection and the account cache."""
+        self.polling = False
+        if self.bm is not None:
+            self.bm.close()
+        self.account.stop()
+
+    def wait_closed(self, symbol, t_sleep=1):
+        """Block until symbol has no open orders (e.g. the placed sell order filled)."""
+        symbol = symbol.upper().replace('_', '')
+        t0 = dt.datetime.now()
+        if not self.account.open_orders(symbol):
+            return
+        while self.account.open_orders(symbol):
+            time.sleep(t_sleep)
+        notify('Stop loss processed', symbol, '')
+        print('Sell order active for {}.'.format(dt.datetime.now() - t0))
+
+    def watch(self, path, t_sleep=5):
+        """Reload positions from path whenever it changes (blocks)."""
+        mtime = None
+        while True:
+            if os.path.getmtime(path) != mtime:
+                mtime = os.path.getmtime(path)
+                self.load(path)
+            time.sleep(t_sleep)
 
 
 if __name__ == "__main__":
@@ -109,15 +313,28 @@ if __name__ == "__main__":
     if args.client_path is None:
         raise ValueError('`client_path` not provided.')
 
-    if args.symbol is None or args.p_stop is None or args.p_limit is None:
-        raise ValueError('Provide all arguments.')
-
     client_keys = []
     with open(args.client_path, 'r') as f:
         for line in f:
             client_keys.append(line.rstrip('\n'))
 
-    client = Client(client_keys[0], client_keys[1])
+    # All REST requests share one rate-limited gateway.
+    client = GatewayClient(client_keys[0], client_keys[1])
 
-    sl = StopLoss(args, client)
-    sl.start_ticker()
+    if args.positions is not None:
+        service = StopLossService(client)
+        service.load(args.positions)
+        service.start(feed=args.feed)
+        service.watch(args.positions)
+    else:
+        if args.symbol is None or args.p_stop is None or args.p_limit is None:
+            raise ValueError('Provide all arguments.')
+        service = StopLossService(client)
+        service.add(args.symbol.upper(), args.symbol, args.balance, args.p_stop,
+                    p_limit=args.p_limit, p_take=args.p_take)
+        service.start(feed=args.feed)
+        service.done.wait()
+        service.executor.shutdown(wait=True)
+        # Exit once the placed sell order has filled.
+        service.wait_closed(args.symbol)
+        service.stop()
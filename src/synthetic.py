@@ -0,0 +1,60 @@
+"""Synthetic 1T klines and websocket messages.
+
+Reproducible (seeded) stand-ins for Binance data, e.g. for benchmarks:
+
+- `synthetic_klines`: 1T kline dataframe (as `utils.klines_2_df`) from a
+  geometric random walk, ending at the current minute.
+- `kline_messages`: websocket kline messages (as the ticker stream, see
+  `klinetracker`) replaying klines: a few open-candle updates per candle,
+  then the closing message.
+"""
+import time
+
+import numpy as np
+
+from utils import dict_2_df
+
+
+def synthetic_klines(n, end_t=None, p0=3e-4, vol=0.002, seed=0):
+    """Return n 1T klines ending at end_t (ms, default: the current minute)."""
+    rng = np.random.RandomState(seed)
+    if end_t is None:
+        end_t = int(time.time() * 1000)
+    end_t = end_t - end_t % 60000
+    start_t = end_t - np.arange(n)[::-1] * 60000
+
+    close = p0 * np.exp(np.cumsum(rng.normal(0, vol, n)))
+    open_ = np.concatenate([[p0], close[:-1]])
+    spread = np.abs(rng.normal(0, vol / 2, (2, n)))
+    klines = {'start_t': start_t.astype(np.int64),
+              'end_t': (start_t + 59999).astype(np.int64),
+              'open': open_,
+              'high': np.maximum(open_, close) * (1 + spread[0]),
+              'low': np.minimum(open_, close) * (1 - spread[1]),
+              'close': close,
+              'volume': rng.lognormal(3, 1, n),
+              'n_trades': rng.poisson(50, n).astype(np.int64)}
+    return dict_2_df(klines)
+
+
+def kline_messages(df, symbol, ticks_per_candle=4, seed=0):
+    """Yield websocket kline messages replaying the klines of df.
+
+    Each candle gets ticks_per_candle messages: open-candle updates moving
+    towards its close and the closing message (`k.x` true).
+    """
+    rng = np.random.RandomState(seed)
+    for row in df.itertuples(index=False):
+        high, low = row.open, row.open
+        for i in range(1, ticks_per_candle + 1):
+            frac = float(i) / ticks_per_candle
+            closed = i == ticks_per_candle
+            close = row.close if closed else row.open + (row.close - row.open) * frac * rng.uniform(0.5, 1.5)
+            high = row.high if closed else max(high, close)
+            low = row.low if closed else min(low, close)
+            yield {'e': 'kline', 'E': int(row.start_t + 59999 * frac), 's': symbol,
+                   'k': {'t': int(row.start_t), 'T': int(row.end_t), 's': symbol, 'i': '1m',
+                         'o': '{:.8f}'.format(row.open), 'c': '{:.8f}'.format(close),
+                         'h': '{:.8f}'.format(high), 'l': '{:.8f}'.format(low),
+                         'v': '{:.2f}'.format(row.volume * frac),
+                         'n': int(row.n_trades * frac), 'x': closed}}
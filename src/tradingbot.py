@@ -1,12 +1,20 @@
 """TODO."""
+import os
+import json
 import time
 import webbrowser
 
-from utils import notify, get_holding
+from utils import notify
+from accountcache import AccountCache
+from metrics import metrics
 from signals import eg_condition
+from signalspec import SignalBook
 
 from binance.client import Client
 
+# Per-symbol state kept across restarts (see `save_state`).
+state_attrs = ['t_notify', 'can_trigger_buy', 'can_trigger_sell', 'buy_price', 'orders']
+
 
 class TradingBot():
     """Trading bot.
@@ -17,7 +25,17 @@ class TradingBot():
     [ ] Import conditions
     [ ] Implement take profit: can_trigger_sell = coin_holding > epsilon
     """
-    def __init__(self, symbols, freqs, client, t_sleep=5, log_path=None):
+    def __init__(self, symbols, freqs, client, t_sleep=5, log_path=None, signal_config=None,
+                 account=None, known=None):
+        """Initialize trading bot.
+
+        args:
+            known: column names of the klines, to check the signals of
+                signal_config against (see `SignalBook`).
+            account: `AccountCache` holding open orders and balances (started by
+                the caller to follow the user-data stream). If None, a cache is
+                filled once by REST.
+        """
         self.t_notify = dict((k, 0) for k in symbols)
         self.t_sleep = t_sleep
         self.can_trigger_buy = dict((k, True) for k in symbols)
@@ -25,22 +43,72 @@ class TradingBot():
         self.client = client
         self.freqs = freqs
 
+        # Compiled signals (configs/signals.yaml); else the eg_condition example.
+        self.signal_book = None
+        if signal_config is not None:
+            self.signal_book = SignalBook(signal_config, symbols, freqs, known)
+
         if log_path is None:
             self.log = {}
         else:
             raise NotImplementedError('Read json.')
 
+        if account is None:
+            account = AccountCache(client)
+            account.reconcile()
+        self.account = account
+
         self.buy_price = dict((k, []) for k in symbols)
-        self.orders = dict((sym, client.get_open_orders(symbol=sym.replace('_', ''))) for sym in symbols)
-        self.holdings = dict((sym.replace('_BTC', ''), get_holding(client, sym)) for sym in symbols)
+        self.orders = dict((sym, account.open_orders(sym)) for sym in symbols)
+        self.holdings = dict((sym.replace('_BTC', ''), account.get_holding(sym)) for sym in symbols)
+
+    def state(self):
+        """Cooldown and order state of the tracked symbols (json-serializable)."""
+        return dict((k, dict(getattr(self, k))) for k in state_attrs)
+
+    def save_state(self, path):
+        """Save `state` to <path>/bot.json (atomically)."""
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        file = os.path.join(path, 'bot.json')
+        with open(file + '.tmp', 'w') as f:
+            json.dump(self.state(), f)
+        os.replace(file + '.tmp', file)
+
+    def load_state(self, path):
+        """Restore the state saved by `save_state` (of symbols still tracked)."""
+        file = os.path.join(path, 'bot.json')
+        if not os.path.isfile(file):
+            return
+        with open(file, 'r') as f:
+            state = json.load(f)
+        for k in state_attrs:
+            attr = getattr(self, k)
+            attr.update((sym, v) for sym, v in state.get(k, {}).items() if sym in attr)
+        print('Restored trading bot state from {}'.format(file))
 
     def __call__(self, crypto_klines, symbol, verbose):
         """Trading bot call."""
+        start = time.perf_counter()
+        self.evaluate(crypto_klines, symbol, verbose)
+        start = metrics.since('stage_latency', start, symbol=symbol.replace('_', ''), stage='signals')
+        self.update_orders(symbol)
+        metrics.since('stage_latency', start, symbol=symbol.replace('_', ''), stage='orders')
+
+    def evaluate(self, crypto_klines, symbol, verbose):
+        """Evaluate buy/sell signals (no order state refresh)."""
+        if self.signal_book is not None:
+            self.signal_book.update(symbol, crypto_klines)
+
         self.can_trigger_buy[symbol] = time.time() - self.t_notify[symbol] > self.t_sleep * 60
-        if self.can_trigger_buy[symbol]:
+        if self.can_trigger_buy[symbol] and self.signal_book is not None:
+            print('Buy path: {}.'.format(symbol))
+            self.notify_fired(self.signal_book.fired([symbol]))
+
+        elif self.can_trigger_buy[symbol]:
             print('Buy path: {}.'.format(symbol))
             for freq in self.freqs:
-                df = getattr(crypto_klines, 'df_' + freq)
+                df = crypto_klines.tail(freq, 100)
 
                 if eg_condition(df):
                     self.notify(symbol, crypto_klines, notify_cond='eg_condition')
@@ -53,10 +121,24 @@ class TradingBot():
                 order = self.sell(symbol, self.buy_price[symbol][2])
                 self.update_log(order, freq, df.tail(100))
 
-        self.update_orders(symbol)
+    def on_fired(self, symbol, fired):
+        """Notify of signals of symbol evaluated elsewhere (e.g. in a `shards.Shard`).
+
+        Subject to the same cooldown as `evaluate`; no order state refresh.
+        """
+        self.can_trigger_buy[symbol] = time.time() - self.t_notify[symbol] > self.t_sleep * 60
+        if self.can_trigger_buy[symbol]:
+            self.notify_fired(fired)
+
+    def notify_fired(self, fired):
+        """Notify of fired [(signal, symbol, freq)]."""
+        for nm, symbol, freq in fired:
+            self.notify(symbol, None, notify_cond=nm)
+            notify(nm, '{} {}'.format(symbol, freq), '')
 
     def update_orders(self, symbol):
-        orders = self.client.get_open_orders(symbol=symbol.replace('_', ''))
+        """Compare cached open orders of symbol to the last seen ones (no REST)."""
+        orders = self.account.open_orders(symbol)
         n_open_0 = len(self.orders[symbol])
         n_open_1 = len(orders)
 
@@ -100,7 +182,7 @@ class TradingBot():
         self.log.update(order)
 
     def buy(self, symbol, freq, price, type='limit', portion=0.5):
-        BTC_balance = float(get_holding(self.client, 'BTC'))
+        BTC_balance = float(self.account.get_holding('BTC'))
         # TODO(lpupp) buy, set stop loss
         # Get upper BB at cross and set buy limits
 
@@ -116,6 +198,7 @@ class TradingBot():
                 symbol=symbol.replace('_', ''),
                 quantity=str(q))
             notify('Market buy order placed', 'sym:{}_{}; q:{}'.format(symbol, freq, q), '')
+        self.account.apply_order(order)
 
         self.orders[symbol].append(order)
         self.can_trigger_buy[symbol] = False
@@ -125,11 +208,12 @@ class TradingBot():
         # TODO(lpupp) when order filled:
         # TODO(lpupp) call this in KLineTracker in "track order" with "if order_filled:"
         # and with order = client.get_order(symbol='BNBBTC', orderId='orderId')
-        q = get_holding(self.client, symbol)
+        q = self.account.get_holding(symbol)
         order = self.client.order_limit_sell(
             symbol=symbol.replace('_', ''),
             quantity=q,
             price=str(float(price)*1.031))
+        self.account.apply_order(order)
         notify('Take profit order placed', 'sym:{}; q:{}; p{}, '.format(symbol, freq, q, price), '')
 
         self.update_log(order, None, None)
@@ -139,15 +223,17 @@ class TradingBot():
         # client.get_all_orders(symbol='BNBBTC', limit=10)
 
         # TODO(lpupp) if all are sold
-        orders = self.client.get_open_orders(symbol=symbol)
+        orders = self.account.open_orders(symbol)
         result = self.client.cancel_order(
             symbol=symbol,
             orderId=orders[-1]['orderId'])
+        self.account.apply_order(result)
         self.update_log(result, None, None)
 
-        balance = get_holding(self.client, symbol)
+        balance = self.account.get_holding(symbol)
         order = self.client.order_limit_sell(
             symbol=symbol.replace('_', ''),
             quantity=balance,
             price=str(price))
+        self.account.apply_order(order)
         return order
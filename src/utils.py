@@ -9,17 +9,26 @@ TODO LR:
 """
 import os
 import time
+import threading
 import yaml
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
+
+import requests
+from requests.adapters import HTTPAdapter
 
 import pandas as pd
 import numpy as np
 
 from binance.client import Client
+from binance.helpers import date_to_milliseconds
+
+API_URL = 'https://api.binance.com/api/v3'
 
 
 def get_config(config):
     with open(config, 'r') as stream:
-        return yaml.load(stream)
+        return yaml.safe_load(stream)
 
 
 def get_holding(client, symbol):
@@ -80,41 +89,59 @@ def dict_2_df(dt_dict):
     """Convert dict to pd.DataFrame with time index."""
     df = pd.DataFrame(dt_dict, columns=dt_dict.keys())
     if 'start_t' in dt_dict.keys():
-        df['time'] = pd.to_datetime(df['start_t'], unit='ms')
-        df.set_index('time', inplace=True)
-        df.sort_index(inplace=True)
+        df.index = pd.DatetimeIndex(pd.to_datetime(np.asarray(df['start_t']), unit='ms'), name='time')
+        if not df.index.is_monotonic_increasing:
+            df.sort_index(inplace=True)
     return df
 
 
-def get_klines(symbol, time, client=None, freq=Client.KLINE_INTERVAL_1MINUTE):
-    """Get historical klines."""
+def get_klines(symbol, time, client=None, freq=Client.KLINE_INTERVAL_1MINUTE, parse=False):
+    """Get historical klines since time (through the client's `RestGateway`, if any).
+
+    time is a start timestamp (ms) or a date string (e.g. '10 days ago UTC').
+    With parse, return columns (see `process_klines`) instead of raw klines.
+    """
     if isinstance(time, str):
-        return client.get_historical_klines(symbol, freq, time)
-    elif isinstance(time, int):
-        return get_historical_klines(symbol, freq, time)
+        time = date_to_milliseconds(time)
+    if isinstance(time, int):
+        return get_historical_klines(symbol, freq, time, gateway=getattr(client, 'gateway', None), parse=parse)
     else:
         raise NotImplementedError('`time` is of type:', type(time))
 
 
+# Position of each kline field in a REST kline.
+kline_fields = OrderedDict([('start_t', 0), ('end_t', 6), ('open', 1), ('high', 2),
+                            ('low', 3), ('close', 4), ('volume', 5), ('n_trades', 8)])
+kline_ints = ['start_t', 'end_t', 'n_trades']
+
+
 def process_klines(klines):
-    """Process klines."""
-    klines_dict = {'start_t': np.array([e[0] for e in klines]),
-                   'end_t': np.array([e[6] for e in klines]),
-                   'open': np.array([float(e[1]) for e in klines]),
-                   'high': np.array([float(e[2]) for e in klines]),
-                   'low': np.array([float(e[3]) for e in klines]),
-                   'close': np.array([float(e[4]) for e in klines]),
-                   'volume': np.array([float(e[5]) for e in klines]),
-                   'n_trades': np.array([e[8] for e in klines])}
-    return klines_dict
+    """Process klines: dict of column arrays.
+
+    klines is the list of REST klines or the raw response body (bytes). A body
+    is parsed by NumPy in one pass, without building python lists: the json
+    punctuation is dropped and all numbers are converted at once (timestamps
+    and counts are exact as float64).
+    """
+    if isinstance(klines, bytes):
+        width = klines[:klines.find(b']') + 1].count(b',') + 1
+        text = klines.translate(None, b'[]"')
+        a = np.array(text.split(b','), dtype=np.float64).reshape(-1, width) if text.strip() else np.zeros((0, 12))
+    else:
+        a = np.array(klines, dtype=object).reshape(len(klines), -1) if len(klines) else np.zeros((0, 12))
+    return OrderedDict((k, a[:, j].astype(np.int64 if k in kline_ints else np.float64))
+                       for k, j in kline_fields.items())
 
 
 def klines_2_df(symbol, time, client=None, freq=Client.KLINE_INTERVAL_1MINUTE):
     """Wrapper for get_klines, process_klines, and dict_2_df."""
-    klines = get_klines(symbol, time, client, freq)
-    klines = process_klines(klines)
-    klines = dict_2_df(klines)
-    return klines
+    return dict_2_df(get_klines(symbol, time, client, freq, parse=True))
+
+
+def kline_ranges_2_df(symbol, ranges, client=None, freq=Client.KLINE_INTERVAL_1MINUTE):
+    """Klines of [(start_ms, end_ms)] ranges, fetched together (see `get_kline_ranges`)."""
+    return dict_2_df(get_kline_ranges(symbol, freq, ranges, gateway=getattr(client, 'gateway', None),
+                                      parse=True))
 
 
 def printv(string, verbose):
@@ -123,33 +150,6 @@ def printv(string, verbose):
         print(string)
 
 
-def create_fn_hl(fn):
-    """Repackage indicator functions to only take hl as args."""
-    def f1(period):
-        def f2(high, low, close):
-            return fn(high, low, period)
-        return f2
-    return f1
-
-
-def create_fn_hlc(fn):
-    """Repackage indicator functions to only take ohl as args."""
-    def f1(period):
-        def f2(high, low, close):
-            return fn(high, low, close, period)
-        return f2
-    return f1
-
-
-def create_fn_c(fn):
-    """Repackage indicator functions to only take closing price as arg."""
-    def f1(period):
-        def f2(high, low, close):
-            return fn(close, period)
-        return f2
-    return f1
-
-
 def notify(title, subtitle, message):
     """Notify (through notifaction window) of event."""
     t = '-title {!r}'.format(title)
@@ -187,74 +187,191 @@ def _interval_to_milliseconds(interval):
     return ms
 
 
-def get_historical_klines(symbol, interval, start_ts, end_str=None):
-    """Get Historical Klines from Binance.
-
-    See dateparse docs for valid start and end string formats http://dateparser.readthedocs.io/en/latest/
-    If using offset strings for dates add "UTC" to date string e.g. "now UTC", "11 hours ago UTC"
+class WeightBudget():
+    """Token bucket over Binance request weight (refilled per `period` seconds)."""
+    def __init__(self, weight_per_minute=600, period=60.):
+        self.rate = weight_per_minute / float(period)
+        self.capacity = weight_per_minute
+        self.tokens = float(weight_per_minute)
+        self.t = time.time()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(self.capacity, self.tokens + (now - self.t) * self.rate)
+        self.t = now
+
+    def acquire(self, weight=1, reserve=0):
+        """Block until weight can be spent without exceeding the budget.
+
+        With reserve, at least that much weight is left for other callers.
+        """
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= weight + reserve:
+                    self.tokens -= weight
+                    return
+                wait = (weight + reserve - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def sync(self, used):
+        """Lower the budget to the weight the server reports as used."""
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.tokens, self.capacity - float(used))
+
+
+def pooled_session(pool_size=4):
+    """Create keep-alive HTTP session with pool_size connections per host."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def _get_klines_page(session, base_url, params, budget, weight, retries=5, raw=False):
+    """Fetch one page of klines, backing off when rate limited (429/418)."""
+    for i in range(retries):
+        budget.acquire(weight)
+        r = session.get(base_url + '/klines', params=params, timeout=30)
+        if r.status_code in [418, 429]:
+            time.sleep(float(r.headers.get('Retry-After', 2 ** i)))
+            continue
+        r.raise_for_status()
+        return r.content if raw else r.json()
+    raise IOError('Rate limited fetching klines {}.'.format(params))
+
+
+def get_historical_klines(symbol, interval, start_ts, end_ts=None, limit=1000,
+                          n_workers=4, weight_per_minute=600, weight=2,
+                          base_url=API_URL, session=None, gateway=None, parse=False):
+    """Get historical klines from Binance with parallel, range-sharded requests.
+
+    [start_ts, end_ts] is split into pages of `limit` klines, which are fetched
+    concurrently over a pooled keep-alive session while staying within a
+    request-weight budget. Pages are stitched in order and deduplicated on
+    kline open time. Ranges longer than a page start at their first kline (one
+    more request), so no empty pages before the symbol was listed are fetched.
 
     :param symbol: Name of symbol pair e.g BNBBTC
     :type symbol: str
-    :param interval: Biannce Kline interval
+    :param interval: Binance kline interval e.g. 1m
     :type interval: str
-    :param start_str: Start date string in UTC format
-    :type start_str: str
-    :param end_str: optional - end date string in UTC format
-    :type end_str: str
-    :return: list of OHLCV values
-
-    source: https://sammchardy.github.io/binance/2018/01/08/historical-data-download-binance.html
+    :param start_ts: Start timestamp (ms)
+    :type start_ts: int
+    :param end_ts: optional - end timestamp (ms), default now
+    :type end_ts: int
+    :param limit: klines per request (Binance allows up to 1000)
+    :param n_workers: number of concurrent requests
+    :param weight_per_minute: request weight budget (Binance: 1200 per minute)
+    :param weight: request weight of one klines call
+    :param base_url: REST endpoint, e.g. a local stand-in server for testing
+    :param session: optional requests session to reuse
+    :param gateway: optional `gateway.RestGateway`; pages are then queued as
+        backfill requests on it (its session, workers and weight budget
+        replace the ones above)
+    :param parse: parse each page (see `process_klines`) as it arrives, so
+        the raw klines of the whole range are never held at once
+    :return: list of OHLCV values (with parse: dict of column arrays)
+
+    adapted from: https://sammchardy.github.io/binance/2018/01/08/historical-data-download-binance.html
     """
-    # create the Binance client, no need for api key
-    client = Client("", "")
+    if end_ts is None:
+        end_ts = int(time.time() * 1000)
+    if gateway is None:
+        session = session or pooled_session(n_workers)
+    if end_ts - start_ts > limit * _interval_to_milliseconds(interval):
+        # Skip the pages before the first kline (e.g. before the listing).
+        start_ts = _first_open_time(symbol, interval, start_ts, end_ts, base_url, session, gateway)
+    return get_kline_ranges(symbol, interval, [(start_ts, end_ts)], limit, n_workers,
+                            weight_per_minute, weight, base_url, session, gateway, parse)
+
+
+def get_kline_ranges(symbol, interval, ranges, limit=1000, n_workers=4, weight_per_minute=600,
+                     weight=2, base_url=API_URL, session=None, gateway=None, parse=False):
+    """Get the klines of several [(start_ts, end_ts)] ranges (ms) in one batch.
+
+    The pages of all ranges are fetched concurrently, e.g. to fill the gaps of
+    a kline series (see `get_historical_klines` for the other arguments).
+    """
+    timeframe = _interval_to_milliseconds(interval)
+    shards = []
+    for start_ts, end_ts in sorted(ranges):
+        for a in range(int(start_ts), int(end_ts) + 1, limit * timeframe):
+            shards.append({'symbol': symbol, 'interval': interval, 'limit': limit,
+                           'startTime': a, 'endTime': min(a + limit * timeframe - 1, int(end_ts))})
+
+    stitch = _stitch_columns if parse else _stitch
+    if gateway is not None:
+        from gateway import BACKFILL
+        futures = [gateway.request('get', base_url + '/klines', p, priority=BACKFILL, weight=weight, raw=parse)
+                   for p in shards]
+        if parse:
+            futures = [_then(f, process_klines) for f in futures]
+        return stitch(f.result() for f in futures)
+
+    session = session or pooled_session(n_workers)
+    budget = WeightBudget(weight_per_minute)
+
+    def fetch(p):
+        page = _get_klines_page(session, base_url, p, budget, weight, raw=parse)
+        return process_klines(page) if parse else page
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        return stitch(executor.map(fetch, shards))
+
+
+def _first_open_time(symbol, interval, start_ts, end_ts, base_url, session, gateway):
+    """Open time of the first kline in [start_ts, end_ts] (one request); end_ts + 1 if none."""
+    params = {'symbol': symbol, 'interval': interval, 'limit': 1, 'startTime': start_ts, 'endTime': end_ts}
+    if gateway is not None:
+        from gateway import BACKFILL
+        klines = gateway.request('get', base_url + '/klines', params, priority=BACKFILL, weight=1).result()
+    else:
+        klines = _get_klines_page(session, base_url, params, WeightBudget(), 1)
+    return int(klines[0][0]) if klines else end_ts + 1
 
-    # init our list
-    output_data = []
 
-    # setup the max limit
-    limit = 500
+def _then(future, fn):
+    """Future of fn(result of future), computed as soon as future is done.
 
-    # convert interval to useful value in seconds
-    timeframe = _interval_to_milliseconds(interval)
+    Only the new future is kept, so the result of future can be freed then.
+    """
+    out = Future()
+
+    def done(f):
+        try:
+            out.set_result(fn(f.result()))
+        except Exception as e:
+            out.set_exception(e)
+    future.add_done_callback(done)
+    return out
 
-    # if an end time was passed convert it
-    end_ts = None
-
-    idx = 0
-    # it can be difficult to know when a symbol was listed on Binance so allow start time to be before list date
-    symbol_existed = False
-    while True:
-        # fetch the klines from start_ts up to max 500 entries or the end_ts if set
-        temp_data = client.get_klines(
-            symbol=symbol,
-            interval=interval,
-            limit=limit,
-            startTime=start_ts,
-            endTime=end_ts
-        )
-
-        # handle the case where our start date is before the symbol pair listed on Binance
-        if not symbol_existed and len(temp_data):
-            symbol_existed = True
-
-        if symbol_existed:
-            # append this loops data to our output data
-            output_data += temp_data
-
-            # update our start timestamp using the last value in the array and add the interval timeframe
-            start_ts = temp_data[len(temp_data) - 1][0] + timeframe
-        else:
-            # it wasn't listed yet, increment our start date
-            start_ts += timeframe
-
-        idx += 1
-        # check if we received less than the required limit and exit the loop
-        if len(temp_data) < limit:
-            # exit the while loop
-            break
-
-        # sleep after every 3rd call to be kind to the API
-        if idx % 3 == 0:
-            time.sleep(1)
 
+def _stitch(pages):
+    """Concatenate kline pages in order, deduplicated on kline open time."""
+    output_data = []
+    for page in pages:
+        for kline in page:
+            if output_data and kline[0] <= output_data[-1][0]:
+                if kline[0] == output_data[-1][0]:
+                    output_data[-1] = kline
+                continue
+            output_data.append(kline)
     return output_data
+
+
+def _stitch_columns(pages):
+    """`_stitch` of parsed pages (dicts of column arrays), vectorized."""
+    pages = list(pages) or [process_klines([])]
+    out = OrderedDict((k, np.concatenate([page[k] for page in pages])) for k in kline_fields)
+    start_t = out['start_t']
+    if len(start_t) and (len(pages) > 1 or np.any(np.diff(start_t) <= 0)):
+        # Sort by open time (stable: later pages last), keep the last of equal ones.
+        order = np.argsort(start_t, kind='stable')
+        start_t = start_t[order]
+        keep = order[np.append(start_t[1:] != start_t[:-1], True)]
+        out = OrderedDict((k, a[keep]) for k, a in out.items())
+    return out
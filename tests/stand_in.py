@@ -0,0 +1,54 @@
+"""Offline stand-in for the REST API: serves synthetic klines without network."""
+import json
+from concurrent.futures import Future
+
+import numpy as np
+
+
+def raw_klines(df):
+    """Convert kline dataframe to REST kline lists."""
+    return [[int(r.start_t), '{:.8f}'.format(r.open), '{:.8f}'.format(r.high),
+             '{:.8f}'.format(r.low), '{:.8f}'.format(r.close), '{:.8f}'.format(r.volume),
+             int(r.end_t), '0', int(r.n_trades), '0', '0', '0']
+            for r in df.itertuples(index=False)]
+
+
+class SyntheticClient():
+    """Offline stand-in for the python-binance `Client` (klines only)."""
+    def __init__(self, klines):
+        """klines: dict {symbol (e.g. 'ETHBTC'): kline dataframe}."""
+        self.klines = klines
+        self.gateway = self
+
+    def _range(self, symbol, start_t=None, end_t=None, limit=None):
+        df = self.klines[symbol.replace('_', '')]
+        t = df['start_t'].values
+        i0 = 0 if start_t is None else np.searchsorted(t, int(start_t))
+        i1 = len(t) if end_t is None else np.searchsorted(t, int(end_t), side='right')
+        if limit is not None:
+            i1 = min(i1, i0 + int(limit))
+        return raw_klines(df.iloc[i0:i1])
+
+    def get_klines(self, symbol, interval='1m', limit=500, startTime=None, endTime=None, **kwargs):
+        return self._range(symbol, startTime, endTime, limit)
+
+    def request(self, method, url, params=None, raw=False, **kwargs):
+        """`RestGateway.request` for /klines (used by `utils.get_historical_klines`)."""
+        klines = self._range(params['symbol'], params.get('startTime'),
+                             params.get('endTime'), params.get('limit'))
+        future = Future()
+        future.set_result(json.dumps(klines).encode('utf-8') if raw else klines)
+        return future
+
+    def get_all_tickers(self):
+        return [{'symbol': k, 'price': '{:.8f}'.format(df['close'].values[-1])}
+                for k, df in self.klines.items()]
+
+    def get_open_orders(self, symbol=None):
+        return []
+
+    def get_account(self):
+        return {'balances': []}
+
+    def get_asset_balance(self, asset):
+        return {'asset': asset, 'free': '0', 'locked': '0'}
@@ -0,0 +1,32 @@
+import numpy as np
+
+from utils import resample
+from aggregator import CandleAggregator
+from synthetic import synthetic_klines
+
+columns = ['start_t', 'end_t', 'open', 'high', 'low', 'close', 'volume', 'n_trades']
+
+
+def test_aggregator_matches_resample():
+    df = synthetic_klines(500)
+    rows = [dict((k, df[k].values[i]) for k in columns) for i in range(len(df.index))]
+    for freq in ['3T', '5T', '15T', '1H']:
+        agg = CandleAggregator(freq)
+        candles = {}
+        for r in rows:
+            # An open-candle update first, then its final values.
+            agg.update(dict(r, close=r['open'], high=r['open'], low=r['open']))
+            candle = agg.update(r)
+            candles[candle['start_t']] = candle
+        ref = resample(df, freq).dropna(subset=['start_t'])
+        assert list(candles) == list(ref['start_t'].values)
+        for k in columns:
+            np.testing.assert_allclose([c[k] for c in candles.values()], ref[k].values, err_msg=k)
+
+
+def test_stale_row_ignored():
+    df = synthetic_klines(3)
+    rows = [dict((k, df[k].values[i]) for k in columns) for i in range(3)]
+    agg = CandleAggregator('15T')
+    agg.reset(rows[1:])
+    assert agg.update(rows[0]) is None
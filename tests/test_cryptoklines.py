@@ -0,0 +1,161 @@
+import os
+from concurrent.futures import wait
+
+import numpy as np
+
+from indicator import Indicator
+from klinestore import KlineStore
+from cryptoklines import CryptoKlines
+from klinetracker import KLineTracker
+from synthetic import synthetic_klines, kline_messages
+from stand_in import SyntheticClient
+
+config = {'rsi': [14], 'ema_indicator': [7, 25]}
+
+
+class CountingClient(SyntheticClient):
+    """`SyntheticClient` recording the params of its kline requests."""
+    def __init__(self, klines):
+        super(CountingClient, self).__init__(klines)
+        self.params = []
+
+    def request(self, method, url, params=None, **kwargs):
+        self.params.append(params)
+        return super(CountingClient, self).request(method, url, params, **kwargs)
+
+
+def klines(n):
+    """Synthetic 1T klines with the 8 decimals the (stand-in) exchange serves."""
+    return synthetic_klines(n).round(dict((k, 8) for k in ['open', 'high', 'low', 'close', 'volume']))
+
+
+def holey_klines(tmp_path, holes, n=600):
+    """Kline file missing the rows of holes ([(i0, i1)]), the klines without them
+    and the (start, end) times of the holes."""
+    df = klines(n)
+    t = df['start_t'].values
+    keep = np.ones(n, dtype=bool)
+    for i0, i1 in holes:
+        keep[i0:i1] = False
+    path = os.path.join(str(tmp_path), 'ETHBTC.klines')
+    KlineStore(path).append(df[keep])
+    return path, df[keep], [(int(t[i0]), int(t[i1 - 1])) for i0, i1 in holes]
+
+
+def test_unfillable_gaps_are_kept_across_checkpoints(tmp_path):
+    path, df, gaps = holey_klines(tmp_path, [(100, 110), (300, 305)])
+    client = CountingClient({'ETHBTC': df})  # the exchange has no klines for the holes either
+    indicator = Indicator(config)
+
+    ck = CryptoKlines('ETH_BTC', indicator, client, load_path=path, freqs=['1T', '5T'], verbose=0)
+    assert ck.gaps() == gaps
+    assert sorted(ck.gap_map.items()) == gaps
+    assert ck.repair_gaps() is None
+
+    checkpoint_path = os.path.join(str(tmp_path), 'checkpoints')
+    ck.checkpoint(checkpoint_path)
+    client.params = []
+    ck = CryptoKlines('ETH_BTC', indicator, client, load_path=path, freqs=['1T', '5T'],
+                      checkpoint_path=checkpoint_path, verbose=0)
+    assert ck.restored
+    assert sorted(ck.gap_map.items()) == gaps
+    # Only the klines since the checkpoint were requested, not the gaps again.
+    assert all(p['startTime'] > gaps[-1][1] for p in client.params)
+
+
+def assert_frames_equal(a, b, n=150):
+    """Last n rows of a and b match (volumes as served, with 8 decimals)."""
+    if n is not None:
+        a, b = a.tail(n), b.tail(n)
+    assert list(a.columns) == list(b.columns)
+    assert list(a.index) == list(b.index)
+    for c in a.columns:
+        np.testing.assert_allclose(a[c].values, b[c].values, rtol=1e-7, atol=1e-8, err_msg=c)
+
+
+def test_checkpoint_round_trip(tmp_path):
+    path, df, _ = holey_klines(tmp_path, [])
+    indicator = Indicator(config)
+    client = SyntheticClient({'ETHBTC': df.iloc[:-30]})
+    ck = CryptoKlines('ETH_BTC', indicator, client, load_path=path, freqs=['1T', '5T', '15T'], verbose=0)
+    checkpoint_path = os.path.join(str(tmp_path), 'checkpoints')
+    ck.checkpoint(checkpoint_path)
+
+    restored = CryptoKlines('ETH_BTC', indicator, client, load_path=path, freqs=['1T', '5T', '15T'],
+                            checkpoint_path=checkpoint_path, verbose=0)
+    assert restored.restored and restored.df_freqs == ck.df_freqs
+    for freq in ck.df_freqs:
+        assert_frames_equal(restored.buffers[freq].to_frame(), ck.buffers[freq].to_frame(), None)
+
+    # Klines since the checkpoint are caught up, as if computed from scratch.
+    client = SyntheticClient({'ETHBTC': df})
+    restored = CryptoKlines('ETH_BTC', indicator, client, load_path=path, freqs=['1T', '5T', '15T'],
+                            checkpoint_path=checkpoint_path, verbose=0)
+    fresh = CryptoKlines('ETH_BTC', indicator, client, load_path=path, freqs=['1T', '5T', '15T'], verbose=0)
+    for freq in fresh.df_freqs:
+        assert_frames_equal(restored.buffers[freq].to_frame(), fresh.buffers[freq].to_frame())
+
+    # Other indicators: only the 1T klines are reused.
+    other = CryptoKlines('ETH_BTC', Indicator({'rsi': [7]}), client, load_path=path, freqs=['1T', '5T'],
+                         checkpoint_path=checkpoint_path, verbose=0)
+    assert not other.restored and 'rsi_7' in other.df_5T.columns
+
+
+def test_gaps_repaired_from_client(tmp_path):
+    path, df, gaps = holey_klines(tmp_path, [(100, 110), (300, 305), (590, 595)])
+    full = klines(600)
+    indicator = Indicator(config)
+    client = CountingClient({'ETHBTC': full})
+    ck = CryptoKlines('ETH_BTC', indicator, client, load_path=path, freqs=['1T', '5T'], verbose=0)
+    assert ck.gaps() == [] and ck.gap_map == {}
+
+    full_path = os.path.join(str(tmp_path), 'full')
+    os.makedirs(full_path)
+    KlineStore(os.path.join(full_path, 'ETHBTC.klines')).append(full)
+    ref = CryptoKlines('ETH_BTC', indicator, client, load_path=full_path, freqs=['1T', '5T'], verbose=0)
+    for freq in ref.df_freqs:
+        assert_frames_equal(ck.buffers[freq].to_frame(), ref.buffers[freq].to_frame(), None)
+
+
+def test_tracker_repairs_missed_klines(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)  # the tracker saves to ./output/data
+    os.makedirs(os.path.join('output', 'data'))
+    full = klines(700)
+    path, _, _ = holey_klines(tmp_path, [(500, 700)], n=700)
+    indicator = Indicator(config)
+
+    def run(skip):
+        client = SyntheticClient({'ETHBTC': full.iloc[:500]})
+        ck = CryptoKlines('ETH_BTC', indicator, client, load_path=path, freqs=['1T', '5T'], verbose=0)
+        client.klines['ETHBTC'] = full
+        tracker = KLineTracker('ETH_BTC', indicator, ck, lambda *args: None, client=client, verbose=0)
+        live = full.iloc[500:]
+        t = live['start_t'].values
+        for msg in kline_messages(live, 'ETHBTC'):
+            if skip and t[100] <= msg['k']['t'] < t[120]:  # disconnected
+                continue
+            tracker.process_message(msg)
+            if tracker.pending is not None:
+                wait([tracker.pending[1]])
+        return ck
+
+    ck, ref = run(True), run(False)
+    assert len(ck.rewrites) == 1 and ck.gaps() == []
+    for freq in ref.df_freqs:
+        assert_frames_equal(ck.buffers[freq].to_frame().drop(columns='volume'),
+                            ref.buffers[freq].to_frame().drop(columns='volume'))
+
+
+def test_tracker_follows_replaced_frame(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)  # the tracker saves to ./output/data
+    os.makedirs(os.path.join('output', 'data'))
+    full = klines(301)
+    client = SyntheticClient({'ETHBTC': full.iloc[:300]})
+    ck = CryptoKlines('ETH_BTC', Indicator(config), client, start_time=int(full['start_t'].values[0]),
+                      freqs=['1T', '5T'], verbose=0)
+    tracker = KLineTracker('ETH_BTC', ck.indicator, ck, lambda *args: None, client=client, verbose=0)
+    ck.set_frame('1T', ck.tail('1T', None).copy())
+    for msg in kline_messages(full.iloc[300:], 'ETHBTC'):
+        tracker.process_message(msg)
+    assert tracker.ws_hist is ck.buffers['1T']
+    assert ck.buffers['1T'].get('start_t') == full['start_t'].values[-1]
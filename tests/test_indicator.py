@@ -0,0 +1,51 @@
+import numpy as np
+import pandas as pd
+
+from utils import get_config
+from indicator import Indicator
+from synthetic import synthetic_klines
+
+config = get_config('configs/indicators.yaml')
+
+
+def assert_frames_close(a, b, columns, start=0):
+    for c in columns:
+        np.testing.assert_allclose(a[c].values[start:], b[c].values[start:], rtol=1e-9, atol=1e-12, err_msg=c)
+
+
+def test_stream_matches_batch():
+    indicator = Indicator(config)
+    df = synthetic_klines(400)
+    ref = indicator(df, full_df=True, smooth_periods=[5])
+
+    si = indicator.stream(smooth_periods=[5])
+    rows = []
+    for r in df.itertuples(index=False):
+        # Revisions of the open candle leave no trace once its final values arrive.
+        si.update(r.start_t, r.open, r.open, r.open)
+        si.update(r.start_t, max(r.open, r.close), min(r.open, r.close), r.close)
+        rows.append(dict(si.update(r.start_t, r.high, r.low, r.close)))
+    out = pd.DataFrame(rows, index=df.index)
+    # The streaming values are nan until a candle has `period` klines before it.
+    assert_frames_close(out, ref, out.columns, start=max(indicator.periods.values()) + 5)
+
+
+def test_stream_warmup_matches_batch():
+    indicator = Indicator(config)
+    df = synthetic_klines(400)
+    ref = indicator(df, full_df=True, smooth_periods=[5])
+    si = indicator.stream(df.iloc[:300], smooth_periods=[5])
+    for r in df.iloc[300:].itertuples(index=False):
+        values = si.update(r.start_t, r.high, r.low, r.close)
+    for k, v in values.items():
+        np.testing.assert_allclose(v, ref[k].values[-1], rtol=1e-9, err_msg=k)
+
+
+def test_batch_matches_call():
+    indicator = Indicator(config)
+    dfs = [synthetic_klines(n, seed=n) for n in [300, 120, 10]]
+    out = indicator.batch(dfs, smooth_periods=[5])
+    for df, got in zip(dfs, out):
+        ref = indicator(df, full_df=True, smooth_periods=[5])
+        assert list(got.index) == list(ref.index)
+        assert_frames_close(got, ref, ref.columns)
@@ -0,0 +1,50 @@
+import numpy as np
+
+from klinebuffer import KlineBuffer, fields
+from synthetic import synthetic_klines
+
+
+def row(df, i, **kwargs):
+    out = dict((k, df[k].values[i]) for k in fields)
+    out.update(kwargs)
+    return out
+
+
+def test_upsert_open_new_and_late():
+    df = synthetic_klines(10)
+    buf = KlineBuffer.from_frame(df.iloc[:8], capacity=20)
+
+    assert not buf.upsert(row(df, 7, close=1.))  # open candle, in place
+    assert len(buf) == 8 and buf.get('close') == 1.
+    assert buf.upsert(row(df, 8))  # new candle
+    assert len(buf) == 9 and buf.get('start_t') == df['start_t'].values[8]
+    assert not buf.upsert(row(df, 3, close=2.))  # late candle, located
+    assert buf.get('close', 3) == 2.
+
+
+def test_insert_fills_hole():
+    df = synthetic_klines(10)
+    buf = KlineBuffer.from_frame(df.drop(df.index[[4, 6]]), capacity=20)
+    assert buf.upsert(row(df, 6))
+    assert buf.upsert(row(df, 4))
+    np.testing.assert_array_equal(buf.tail(column='start_t'), df['start_t'].values)
+    np.testing.assert_array_equal(buf.tail(column='close'), df['close'].values)
+    assert list(buf.to_frame().index) == list(df.index)
+
+
+def test_compaction_keeps_last_rows():
+    df = synthetic_klines(53)
+    buf = KlineBuffer(capacity=5, columns=['rsi_14'])
+    for i in range(len(df.index)):
+        buf.upsert(row(df, i))
+        buf.update(-1, {'rsi_14': float(i)})
+        assert len(buf) == min(i + 1, 5)
+    assert buf.hi <= buf.size
+    np.testing.assert_array_equal(buf.tail(column='start_t'), df['start_t'].values[-5:])
+    np.testing.assert_array_equal(buf.tail(column='rsi_14'), np.arange(48, 53))
+    assert list(buf.to_frame().index) == list(df.index[-5:])
+
+    buf.extend(synthetic_klines(3, end_t=int(df['start_t'].values[-1]) + 3 * 60000))
+    assert len(buf) == 5 and np.isnan(buf.tail(column='rsi_14')[-3:]).all()
+    buf.truncate(2)
+    assert buf.get('start_t') == df['start_t'].values[-1] + 60000
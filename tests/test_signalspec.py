@@ -0,0 +1,41 @@
+import os
+
+import numpy as np
+import pytest
+
+from indicator import Indicator
+from klinebuffer import fields
+from cryptoklines import CryptoKlines, KlinesSnapshot
+from signalspec import SignalBook, spec_series
+from synthetic import synthetic_klines
+from stand_in import SyntheticClient
+
+config = {'rsi': [14], 'ema_indicator': [7, 25]}
+signal_config = {'oversold': {'lt': ['rsi_14', 50]},
+                 'cross': {'cross_above': ['ema_indicator_7', 'ema_indicator_25']},
+                 'up': {'gt': ['close', 'open']}}
+
+
+def test_signal_book_matches_spec_series(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)  # CryptoKlines saves to ./output/data
+    os.makedirs(os.path.join('output', 'data'))
+    df = synthetic_klines(500)
+    indicator = Indicator(config)
+    ck = CryptoKlines('ETH_BTC', indicator, SyntheticClient({'ETHBTC': df}),
+                      start_time=int(df['start_t'].values[0]), freqs=['1T', '5T'], verbose=0)
+    book = SignalBook(signal_config, ['ETH_BTC', 'XRP_BTC'], ['1T', '5T'], list(fields) + indicator.names())
+    for source in [ck, KlinesSnapshot(ck, ['1T', '5T'])]:
+        book.update('ETH_BTC', source)
+        expected = [(nm, 'ETH_BTC', freq) for nm, spec in signal_config.items() for freq in ['1T', '5T']
+                    if spec_series(spec, ck.tail(freq, 10)).values[-1]]
+        assert expected and sorted(book.fired(['ETH_BTC'])) == sorted(expected)
+        # Only the updated symbol's row; XRP_BTC (all nan) never fires.
+        assert sorted(book.fired()) == sorted(expected)
+        assert book.fired(['XRP_BTC']) == []
+
+
+def test_unknown_column():
+    with pytest.raises(ValueError):
+        SignalBook({'typo': {'lt': ['rsi_41', 30]}}, ['ETH_BTC'], ['1T'], list(fields) + ['rsi_14'])
+    book = SignalBook({'typo': {'lt': ['rsi_41', 30]}}, ['ETH_BTC'], ['1T'])
+    assert np.isnan(book.cur).all()
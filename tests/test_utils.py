@@ -0,0 +1,114 @@
+import threading
+
+import numpy as np
+
+import utils
+
+from utils import process_klines, _stitch_columns, get_kline_ranges, get_historical_klines, \
+    klines_2_df, kline_fields, kline_ints
+from synthetic import synthetic_klines
+from stand_in import SyntheticClient
+
+
+def test_stitch_empty_pages():
+    out = _stitch_columns([process_klines(b'[]') for _ in range(3)])
+    assert list(out) == list(kline_fields)
+    assert all(len(a) == 0 for a in out.values())
+    assert out['start_t'].dtype == np.int64
+
+
+def test_kline_ranges_without_klines():
+    df = synthetic_klines(100, end_t=1500000000000)
+    client = SyntheticClient({'ETHBTC': df})
+    t0 = int(df['start_t'].values[0])
+    # Two ranges before the first kline, each spanning two pages.
+    ranges = [(t0 - 4000 * 60000, t0 - 3000 * 60000), (t0 - 2000 * 60000, t0 - 1000 * 60000)]
+    out = get_kline_ranges('ETHBTC', '1m', ranges, limit=600, gateway=client, parse=True)
+    assert all(len(a) == 0 for a in out.values())
+
+
+class StandInServer():
+    """Local HTTP stand-in for the /klines endpoint of the REST API."""
+    def __init__(self, client):
+        from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+        from urllib.parse import urlparse, parse_qs
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                params = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+                body = client.request('get', url.path, params, raw=True).result()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def assert_klines_equal(out, df):
+    """Klines equal to df (prices and volumes as served, with 8 decimals)."""
+    for k in kline_fields:
+        if k in kline_ints:
+            np.testing.assert_array_equal(out[k], df[k].values, err_msg=k)
+        else:
+            np.testing.assert_allclose(out[k], df[k].values, rtol=0, atol=5e-9, err_msg=k)
+
+
+def test_multi_page_stitching():
+    df = synthetic_klines(1000, end_t=1500000000000)
+    client = SyntheticClient({'ETHBTC': df})
+    t0, t1 = int(df['start_t'].values[0]), int(df['start_t'].values[-1])
+    # Ranges overlap and start before the first kline, pages are uneven.
+    ranges = [(t0 - 50 * 60000, t0 + 400 * 60000), (t0 + 300 * 60000, t1)]
+    assert_klines_equal(get_kline_ranges('ETHBTC', '1m', ranges, limit=170, gateway=client, parse=True), df)
+    raw = get_kline_ranges('ETHBTC', '1m', ranges, limit=170, gateway=client)
+    assert_klines_equal(process_klines(raw), df)
+
+
+def test_historical_klines_from_stand_in_server():
+    df = synthetic_klines(2500, end_t=1500000000000)
+    server = StandInServer(SyntheticClient({'ETHBTC': df}))
+    try:
+        t0, t1 = int(df['start_t'].values[0]), int(df['start_t'].values[-1])
+        for parse in [False, True]:
+            out = get_historical_klines('ETHBTC', '1m', t0 - 30 * 60000, t1, limit=500, n_workers=3,
+                                        weight_per_minute=10000, base_url=server.url, parse=parse)
+            assert_klines_equal(out if parse else process_klines(out), df)
+    finally:
+        server.close()
+
+
+def test_date_string_parses_per_page(monkeypatch):
+    df = synthetic_klines(2500)
+    client = SyntheticClient({'ETHBTC': df})
+    requests = []
+    request = client.request
+
+    def counting_request(method, url, params=None, raw=False, **kwargs):
+        requests.append(raw)
+        return request(method, url, params, raw=raw, **kwargs)
+
+    parsed = []
+
+    def counting_process_klines(klines):
+        parsed.append(len(klines))
+        return process_klines(klines)
+
+    monkeypatch.setattr(client, 'request', counting_request)
+    monkeypatch.setattr(utils, 'process_klines', counting_process_klines)
+    out = klines_2_df('ETHBTC', '3 days ago UTC', client)
+    # One request for the first kline, then pages fetched raw and parsed one by one.
+    assert requests[0] is False and all(requests[1:])
+    assert len(parsed) == len(requests) - 1 > 1
+    assert_klines_equal(dict((k, out[k].values) for k in kline_fields), df)